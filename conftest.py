@@ -0,0 +1,25 @@
+#Shared pytest fixtures: a simulated ODB in place of the DAQ (see pyODBsim)
+
+import pytest
+import numpy as np
+
+import pyodbedit
+import pyODBsim
+
+#A SimBackend installed as the pyodbedit backend for the test
+@pytest.fixture
+def sim():
+	backend=pyODBsim.SimBackend(pyODBsim.tower(4))
+	pyodbedit.set_backend(backend)
+	yield backend
+	pyodbedit.set_backend(None)
+
+#A linear 0-100 V calibration file, 20 V per DCRC setting unit
+@pytest.fixture
+def calFile(tmp_path):
+	path=tmp_path/'cal.txt'
+	with open(str(path),'w') as f:
+		f.write('DCRC setting\tHV\n')
+		for setting in np.linspace(0,5,11):
+			f.write(str(setting)+'\t'+str(20*setting)+'\n')
+	return str(path)
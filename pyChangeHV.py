@@ -6,79 +6,272 @@
 #Nick Mast 7/2019
 #
 
+import os
 import sys
 import time
+import numpy as np
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser, ArgumentTypeError
 
-import flashandflash
 import pyodbedit
+import pyFlash
+import pyODBpaths
+
+#Shortest HV update period allowed (s). Periods much shorter than the time an
+#ODB write takes will just show up as lag in the ramp log.
+MIN_UPDATE_PERIOD=0.05
+
+#Closed-loop ramps (see runAdaptiveRamp): how far (V) the readback may be from
+#the setpoint and still count as keeping up, how much the rate goes up or down
+#per step, and how long (s) to hold for the readback before giving up
+RAMP_TOLERANCE=0.5
+RAMP_SPEEDUP=1.25
+RAMP_BACKOFF=0.5
+SETTLE_TIMEOUT=60.0
 
 #Ramp the HV settings appropriately
 #Uses "calcBiasSetting", so heed all warnings therin
 #iDCRC = MIDAS DCRC number
-def changeHVFromTo(iDCRC,HVstart,HVend,HVrampRate,HVrampUpdatePeriod,calTable):
-	HVcurr=HVstart
-	HVincrement=HVrampRate*float(HVrampUpdatePeriod)
-	#Increase HV by [HVincrement] every [HVrampUpdatePeriod] seconds
-	while HVcurr!=HVend:
-		if (abs(HVend-HVcurr) < HVincrement):
-			HVcurr=HVend
+#With HVmaxRate the ramp is closed loop, going as fast as the readback keeps
+#up with, up to HVmaxRate (see runAdaptiveRamp)
+#Returns the ramp log, see runRampSchedule
+def changeHVFromTo(iDCRC,HVstart,HVend,HVrampRate,HVrampUpdatePeriod,calTable,
+		HVmaxRate=None,tolerance=RAMP_TOLERANCE,readback=None):
+	if HVmaxRate is not None:
+		return runAdaptiveRamp(iDCRC,HVstart,HVend,calTable,HVrampRate,HVmaxRate,HVrampUpdatePeriod,tolerance,readback)
+	schedule=rampSchedule(HVstart,HVend,HVrampRate,HVrampUpdatePeriod)
+	return runRampSchedule(iDCRC,schedule,calTable)
+
+#Work out the whole ramp up front
+#Returns a list of (t, HV) steps, t in s from the start of the ramp, changing HV
+#by [HVrampRate*HVrampUpdatePeriod] every [HVrampUpdatePeriod] seconds. The last
+#step lands exactly on HVend and is followed by one more period of settling, so
+#the ramp ends at len(schedule)*HVrampUpdatePeriod.
+def rampSchedule(HVstart,HVend,HVrampRate,HVrampUpdatePeriod):
+	HVrampUpdatePeriod=float(HVrampUpdatePeriod)
+	if HVrampRate<=0 or HVrampUpdatePeriod<=0:
+		raise ValueError('HV ramp rate and update period must be positive')
+	HVincrement=HVrampRate*HVrampUpdatePeriod
+	#Small tolerance so rounding in the division doesn't add a tiny extra step
+	nSteps=int(np.ceil(abs(HVend-HVstart)/HVincrement-1e-9))
+	sign=1.0 if HVend>HVstart else -1.0
+	HVs=HVstart+sign*HVincrement*np.arange(1,nSteps+1)
+	if nSteps>0:
+		HVs[-1]=HVend
+	return [(i*HVrampUpdatePeriod,float(HV)) for i,HV in enumerate(HVs)]
+
+#Step through a ramp schedule against the monotonic clock
+#Each write is made at its deadline rather than a fixed sleep after the last
+#one, so the time the ODB writes take doesn't slow the ramp down. No write is
+#made less than a period after the one before, though: after a slow write the
+#rest of the schedule runs late rather than catching up with steps back to
+#back, so the ramp never goes faster than requested.
+#Returns a list of (t, HV, lag) for each step, lag in s behind its deadline.
+#If stop (a threading.Event) is set, the ramp ends early wherever it has got to.
+def runRampSchedule(iDCRC,schedule,calTable,verbose=False,stop=None):
+	if len(schedule)==0:
+		return []
+	#Look up all the settings at once. This raises CalibrationError before
+	#anything is changed if any part of the ramp is outside the calibration.
+	settings=calcBiasSetting(np.array([HV for t,HV in schedule]),calTable)
+	period=schedule[1][0]-schedule[0][0] if len(schedule)>1 else 0.0
+
+	rampLog=[]
+	t0=time.monotonic()
+	lastWrite=None
+	for (t,HV),setting in zip(schedule,settings):
+		deadline=t0+t if lastWrite is None else max(t0+t,lastWrite+period)
+		wait=deadline-time.monotonic()
+		if stop is not None:
+			if stop.wait(max(0.0,wait)):
+				print('Ramp stopped at HV = '+str(round(rampLog[-1][1] if rampLog else schedule[0][1],3))+' V')
+				return rampLog
+		elif wait>0:
+			time.sleep(wait)
+		lastWrite=time.monotonic()
+		lag=lastWrite-(t0+t)
+		setDCRCQI(iDCRC,round(float(setting),3))
+		rampLog.append((t,HV,lag))
+		if verbose:
+			print('HV = '+str(round(HV,3))+' V, '+str(round(1000*lag,1))+' ms late')
+	#Settle for one period after the last step
+	wait=lastWrite+period-time.monotonic()
+	if stop is not None:
+		stop.wait(max(0.0,wait))
+	elif wait>0:
+		time.sleep(wait)
+
+	lags=[lag for t,HV,lag in rampLog]
+	print('Ramp: '+str(len(lags))+' steps, lag mean '+str(round(1000*np.mean(lags),1))+' ms, max '+str(round(1000*np.max(lags),1))+' ms')
+	return rampLog
+
+#Run several ramps at once, e.g. on DCRCs on different towers
+#ramps is a list of (iDCRC, schedule, calTable); each runs in its own thread
+#over the shared pyodbedit connections. Returns each ramp's log, in order.
+def runRampSchedules(ramps,verbose=False,stop=None):
+	ramps=list(ramps)
+	if not ramps:
+		return []
+	with ThreadPoolExecutor(max_workers=len(ramps)) as pool:
+		futures=[pool.submit(runRampSchedule,iDCRC,schedule,calTable,verbose,stop) for iDCRC,schedule,calTable in ramps]
+		return [future.result() for future in futures]
+
+#Raised for unusable calibration files and for HVs outside the calibration
+class CalibrationError(ValueError):
+	pass
+
+#Raised when the HV readback doesn't follow a closed-loop ramp
+class ReadbackError(RuntimeError):
+	pass
+
+#The HV as read back from the ODB (never the cache)
+#readback is the path of a monitor giving the HV in V, e.g. the supply's; by
+#default the DCRC's charge bias monitor is read and turned into HV with calTable
+def readHV(iDCRC,calTable,readback=None):
+	if readback is not None:
+		return float(pyodbedit.read_value(readback,fresh=True))
+	return calTable.HV(float(pyodbedit.read_value(pyODBpaths.path(iDCRC,'chargeBiasReadback',0),fresh=True)))
+
+#Ramp from HVstart to HVend in closed loop, watching the HV readback
+#Every HVrampUpdatePeriod the readback is compared with the last setpoint:
+#  - within tolerance (V): the rate goes up by RAMP_SPEEDUP, up to HVmaxRate
+#  - within 2*tolerance: the rate backs off by RAMP_BACKOFF, down to HVrampRate
+#  - further behind: the setpoint holds, and the rate drops back to HVrampRate,
+#    until the readback catches up
+#The ramp starts at HVrampRate and finishes once the readback is within
+#tolerance of HVend. ReadbackError is raised (leaving the HV where it is) if
+#the readback is stuck for SETTLE_TIMEOUT s.
+#readback is as for readHV. Returns the ramp log, as for runRampSchedule.
+def runAdaptiveRamp(iDCRC,HVstart,HVend,calTable,HVrampRate,HVmaxRate,HVrampUpdatePeriod,
+		tolerance=RAMP_TOLERANCE,readback=None,verbose=False,stop=None):
+	period=float(HVrampUpdatePeriod)
+	if HVrampRate<=0 or period<=0 or tolerance<=0:
+		raise ValueError('HV ramp rate, update period and tolerance must be positive')
+	if HVmaxRate<HVrampRate:
+		raise ValueError('HVmaxRate ('+str(HVmaxRate)+' V/s) is below HVrampRate ('+str(HVrampRate)+' V/s)')
+	#Check both ends against the calibration before anything is changed
+	calcBiasSetting(np.array([HVstart,HVend]),calTable)
+	sign=1.0 if HVend>HVstart else -1.0
+
+	rampLog=[]
+	rate=HVrampRate
+	HV=float(HVstart)
+	worst=0.0
+	t0=time.monotonic()
+	deadline=t0
+	waiting=None
+	while True:
+		wait=deadline-time.monotonic()
+		if stop is not None:
+			if stop.wait(max(0.0,wait)):
+				print('Ramp stopped at HV = '+str(round(HV,3))+' V')
+				return rampLog
+		elif wait>0:
+			time.sleep(wait)
+		now=time.monotonic()
+		error=abs(HV-readHV(iDCRC,calTable,readback))
+		worst=max(worst,error)
+		if HV==HVend and error<=tolerance:
+			break
+		if HV==HVend or error>2*tolerance:
+			#Wait for the readback
+			rate=HVrampRate
+			if waiting is None:
+				waiting=now
+			elif now-waiting>SETTLE_TIMEOUT:
+				raise ReadbackError('HV readback on DCRC '+pyODBpaths.name(iDCRC)+' is '+str(round(error,3))
+					+' V from the '+str(round(HV,3))+' V setpoint after '+str(SETTLE_TIMEOUT)+' s')
 		else:
-			sign=(1.0*(HVcurr<HVend)-0.5)/0.5
-			HVcurr=HVcurr+sign*HVincrement
-
-		setting=calcBiasSetting(HVcurr,calTable)
-		if setting==None:
-			#Something went wrong
-			sys.exit("****Bad bias setting****")
-		setDCRCQI(iDCRC,round(setting,3))
-		time.sleep(HVrampUpdatePeriod)
-	return
+			waiting=None
+			if error<=tolerance:
+				rate=min(rate*RAMP_SPEEDUP,HVmaxRate)
+			else:
+				rate=max(rate*RAMP_BACKOFF,HVrampRate)
+			HV=HVend if abs(HVend-HV)<=rate*period else HV+sign*rate*period
+			setDCRCQI(iDCRC,round(float(calcBiasSetting(HV,calTable)),3))
+			rampLog.append((now-t0,HV,now-deadline))
+			if verbose:
+				print('HV = '+str(round(HV,3))+' V at '+str(round(rate,3))+' V/s, readback '+str(round(error,3))+' V behind')
+		deadline+=period
+		if now>deadline:
+			deadline=now
+
+	dt=time.monotonic()-t0
+	print('Ramp: '+str(len(rampLog))+' steps in '+str(round(dt,1))+' s ('+str(round(abs(HVend-HVstart)/dt,3) if dt>0 else 0)
+		+' V/s), readback at most '+str(round(worst,3))+' V behind')
+	return rampLog
+
+#DCRCQI setting vs HV calibration, kept as numpy arrays sorted by HV
+class CalTable(object):
+	def __init__(self,settings,HVs,source='calibration table'):
+		settings=np.asarray(settings,dtype=float)
+		HVs=np.asarray(HVs,dtype=float)
+		if len(HVs)<2:
+			raise CalibrationError(source+': need at least two calibration points')
+		order=np.argsort(HVs,kind='stable')
+		self.settings=settings[order]
+		self.HVs=HVs[order]
+		self.source=source
+		dHV=np.diff(self.HVs)
+		if np.any(dHV==0):
+			raise CalibrationError(source+': duplicate HV entries '+str(sorted(set(float(x) for x in self.HVs[1:][dHV==0]))))
+		dset=np.diff(self.settings)
+		if not (np.all(dset>0) or np.all(dset<0)):
+			raise CalibrationError(source+': DCRC setting is not monotonic in HV')
+
+	def __len__(self):
+		return len(self.HVs)
+
+	#Interpolated DCRC setting(s) for HV (a number or an array of them)
+	def setting(self,HV):
+		HVarr=np.asarray(HV,dtype=float)
+		bad=(HVarr<self.HVs[0])|(HVarr>self.HVs[-1])
+		if np.any(bad):
+			raise CalibrationError('HV '+str(np.atleast_1d(HVarr)[np.atleast_1d(bad)][0])+' V is outside the range of '
+				+self.source+' ('+str(self.HVs[0])+' to '+str(self.HVs[-1])+' V)')
+		settings=np.interp(HVarr,self.HVs,self.settings)
+		if np.ndim(settings)==0:
+			return float(settings)
+		return settings
+
+	#HV produced by a DCRC setting (the inverse of setting), clipped to the table
+	def HV(self,setting):
+		if self.settings[0]<self.settings[-1]:
+			HVs=np.interp(setting,self.settings,self.HVs)
+		else:
+			HVs=np.interp(setting,self.settings[::-1],self.HVs[::-1])
+		if np.ndim(HVs)==0:
+			return float(HVs)
+		return HVs
 
 #Calculate the DCRCQI setting needed for a given HV bias
 #Interpolate based on calibration table
+#HV may be a single value or an array (e.g. a whole ramp)
+#Raises CalibrationError if the requested HV is outside the calibration region
 def calcBiasSetting(HV,calTable):
-	#Assume cal table has DCRC setting as first entry and HV value as second
-	#Also assume the list is ordered
-	setA=calTable[0][0]
-	HVA=calTable[0][1]
-	if(HVA==HV):
-		#We've found the entry exactly
-		return setA
-	
-	for entry in calTable:
-		setB=entry[0]
-		HVB=entry[1]
-		if (HVB==HV):
-			#We've found the entry exactly
-			return setB
-		elif (HVA<HV and HV<HVB) or (HVA>HV and HV>HVB):
-			#We've found the surrounding entries
-			m=(setB-setA)/(HVB-HVA)
-			setting = setA + m*(HV-HVA)
-			return setting
-		setA=setB
-		HVA=HVB
-	
-	#If we make it here, the requested HV was outside the calibration region.
-	return None
+	if not isinstance(calTable,CalTable):
+		#Old style list of [DCRC setting, HV] entries
+		calTable=CalTable([entry[0] for entry in calTable],[entry[1] for entry in calTable])
+	return calTable.setting(HV)
 
 #Set DCRCQI bias
+#Raises pyodbedit.OdbeditError if the write doesn't take, which ends the ramp there
 def setDCRCQI(iDCRC,V):	
-	pyodbedit.write('/Equipment/Tower01/Settings/DCRC'+str(iDCRC)+'/Charge/Bias (V)[0]',str(V))
+	pyFlash.requireSettings({pyODBpaths.path(iDCRC,'chargeBias',0):str(V)})
 	return
 
 #Turn the HV power supply on or off
 #state=1 is on, state=0 is off
+#Raises pyodbedit.OdbeditError if the write doesn't take
 def setHVpowerOnOff(iDCRC,state):
 	if state==1 or str(state).lower()=='on':
 		print('Turn HV power supply ON')
-		pyodbedit.write('/Equipment/Tower01/Settings/DCRC'+str(iDCRC)+'/Charge/Bias (V)[1]', str(10))
+		pyFlash.requireSettings({pyODBpaths.path(iDCRC,'chargeBias',1):str(10)})
 		time.sleep(5)
 	elif state==0 or str(state).lower()=='off':
 		print('Turn HV power supply OFF')
-		pyodbedit.write('/Equipment/Tower01/Settings/DCRC'+str(iDCRC)+'/Charge/Bias (V)[1]', str(0))
+		pyFlash.requireSettings({pyODBpaths.path(iDCRC,'chargeBias',1):str(0)})
 		time.sleep(5)
 	else:
 		#Something went wrong
@@ -86,15 +279,37 @@ def setHVpowerOnOff(iDCRC,state):
 	return
 
 #Load the HV setting calibration table
-#Assume the first row is a header
+#Tab separated, DCRC setting in the first column and HV in the second
+#A first row that isn't numbers is treated as a header
+#Tables are cached by file and modification time, so repeat calls are free
+_calCache={}
 def loadCalTable(HVcalFile):
-	cals=[]
-	with open(HVcalFile,'r') as f:
-		header=next(f)
-		for line in f:
+	path=os.path.abspath(HVcalFile)
+	mtime=os.path.getmtime(path)
+	if path in _calCache and _calCache[path][0]==mtime:
+		return _calCache[path][1]
+
+	settings=[]
+	HVs=[]
+	with open(path,'r') as f:
+		for iline,line in enumerate(f):
 			entries=line.strip().split('\t')
-			#First entry is DCRC setting, second is HV
-			cals.append([float(entries[0]),float(entries[1])])
+			if line.strip()=='':
+				continue
+			try:
+				if len(entries)<2:
+					raise ValueError
+				setting,HV=float(entries[0]),float(entries[1])
+			except ValueError:
+				if iline==0:
+					#Header
+					continue
+				raise CalibrationError(HVcalFile+' line '+str(iline+1)+': expected <DCRC setting>\t<HV>, got '+repr(line.strip()))
+			settings.append(setting)
+			HVs.append(HV)
+
+	cals=CalTable(settings,HVs,HVcalFile)
+	_calCache[path]=(mtime,cals)
 	return cals
 
 
@@ -111,15 +326,18 @@ def main(args):
 	###############################################
 	parser = argparse.ArgumentParser(description='Get run info')
 	
-	parser.add_argument('-iDCRC',type=int,help='MIDAS DCRC number of board controlling HV')
+	parser.add_argument('-iDCRC',type=str,help='MIDAS DCRC number of board controlling HV, or Tower:DCRC (e.g. Tower02:4) for a board on another tower than '+pyODBpaths.DEFAULT_TOWER)
 	parser.add_argument('-HVstart',type=str,help='Current HV setting')
 	parser.add_argument('-HVend',type=str,help='Desired HV setting')
 
-	parser.add_argument('-HVcalFile',type=str,help='Calibration file. Should be a tab-separated file with the first column being the DCRCQI control voltage and the second being the resulting HV output voltage. These values should be in numerical order. The first row is reserved for column headers. Note: This code is very stupid, so make sure the format is correct!')
+	parser.add_argument('-HVcalFile',type=str,help='Calibration file. Should be a tab-separated file with the first column being the DCRCQI control voltage and the second being the resulting HV output voltage. The first row may be column headers.')
 
 	parser.add_argument('-HVrampRate',type=float,default=1.0,help='Rate limit for HV voltage changes in V/s (default is 1 V/s)')
-	parser.add_argument('-HVrampUpdatePeriod',type=int,default=1,help='Period of time (in s) to wait between HV voltage changes while ramping. Default is 1 s.')
+	parser.add_argument('-HVrampUpdatePeriod',type=float,default=1,help='Period of time (in s) to wait between HV voltage changes while ramping. Default is 1 s.')
 	parser.add_argument('-HVpreBias',type=str,help='Prebias settings for HV. Should be in the form (Overbias %%)/(wait time min). As in 15/5 to overbias by 15%% for 5 minutes. No prebias by default')
+	parser.add_argument('-HVmaxRate',type=float,help='Ramp in closed loop, speeding up from HVrampRate to at most this many V/s while the HV readback keeps up. Default is to ramp at HVrampRate without looking.')
+	parser.add_argument('-HVrampTolerance',type=float,default=RAMP_TOLERANCE,help='How far (V) the readback may lag the setpoint in a closed-loop ramp. Default is '+str(RAMP_TOLERANCE)+' V.')
+	parser.add_argument('-HVreadback',type=str,help='ODB key to read the HV back from, in V. Default is the DCRC charge bias monitor, converted with the calibration file.')
 
 	args = parser.parse_args(args)
 
@@ -130,15 +348,15 @@ def main(args):
 	if (args.iDCRC is None) or (args.HVstart is None) or (args.HVend is None) or (args.HVcalFile is None):
 		parser.error('Error: missing required input. See changeHV -h for info.')
 
-	iDCRC=int(args.iDCRC)
+	iDCRC=args.iDCRC
 	HVstart=float(args.HVstart)
 	HVend=float(args.HVend)
 	HVcalFile=args.HVcalFile
 
 	HVrampRate=args.HVrampRate
 	
-	if args.HVrampUpdatePeriod<1.0:
-		parser.error('Minimum HVrampUpdatePeriod is 1 s')
+	if args.HVrampUpdatePeriod<MIN_UPDATE_PERIOD:
+		parser.error('Minimum HVrampUpdatePeriod is '+str(MIN_UPDATE_PERIOD)+' s')
 	else:
 		HVrampUpdatePeriod=args.HVrampUpdatePeriod
 	
@@ -146,6 +364,10 @@ def main(args):
 		HVpreBiasPercent=float(args.HVpreBias.split('/')[0])
 		HVpreBiasWait_sec=int(60.0*float(args.HVpreBias.split('/')[1]))
 
+	if args.HVmaxRate is not None and args.HVmaxRate<HVrampRate:
+		parser.error('HVmaxRate must be at least HVrampRate')
+	adaptive=(args.HVmaxRate,args.HVrampTolerance,args.HVreadback)
+
 	###########################
 	#Load calibration lookup table
 	###########################
@@ -154,7 +376,7 @@ def main(args):
 	###########################
 	#Output Sequence
 	###########################
-	print('Change HV bias from ' + str(HVstart) + ' V to ' + str(HVend) +' V using DCRC'+str(iDCRC))
+	print('Change HV bias from ' + str(HVstart) + ' V to ' + str(HVend) +' V using DCRC '+pyODBpaths.name(iDCRC))
 	print('')
 	###########
 	#Set HV
@@ -162,19 +384,19 @@ def main(args):
 	if args.HVpreBias is None:
 		#Just ramp to new HV
 		print('Set HV = '+str(HVend))
-		changeHVFromTo(iDCRC,HVstart,HVend,HVrampRate,HVrampUpdatePeriod,cals)
+		changeHVFromTo(iDCRC,HVstart,HVend,HVrampRate,HVrampUpdatePeriod,cals,*adaptive)
 	else:
 		print('Prebias by ' + str(HVpreBiasPercent) + '% for ' + str(HVpreBiasWait_sec/60.) + ' minutes')
 		#Ramp to prebias
 		HVpre=round((1.0+HVpreBiasPercent/100.)*HVend,2)
 		print('Set HVpre = '+str(HVpre))
-		changeHVFromTo(iDCRC,HVstart,HVpre,HVrampRate,HVrampUpdatePeriod,cals)
+		changeHVFromTo(iDCRC,HVstart,HVpre,HVrampRate,HVrampUpdatePeriod,cals,*adaptive)
 		#Wait
 		print('Waiting '+str(HVpreBiasWait_sec)+' sec')
 		time.sleep(HVpreBiasWait_sec)
 		#Ramp down to desired HV
 		print('Set HV = '+str(HVend))
-		changeHVFromTo(iDCRC,HVpre,HVend,HVrampRate,HVrampUpdatePeriod,cals)
+		changeHVFromTo(iDCRC,HVpre,HVend,HVrampRate,HVrampUpdatePeriod,cals,*adaptive)
 
 	print('')
 
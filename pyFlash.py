@@ -1,47 +1,116 @@
 #Commands to flash detectors by issuing odbedit commands
 #This is based on some commands in the flashandflash.py code which creates MIDAS Sequencer scripts to do the same thing
+#
+#Operations on a list of DCRCs talk to all the boards at the same time, so the
+#LED on/off edges line up across detectors. They return {board: (start, end)}
+#timing (time.monotonic() seconds, also kept in lastTiming) so the spread
+#between the first and last board can be checked with boardSpread().
 
 #NM 7/2019
 
 import os
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
 import pyodbedit as poe
+import pyODBpaths as paths
+
+#Most boards talked to at once
+MAX_WORKERS=8
+
+#{board: (start, end)} for the last multi-board operation
+lastTiming={}
+
+_pool=None
+_poolLock=threading.Lock()
+
+#Write a batch of {path: value} settings in one odbedit round trip and
+#complain about any keys that didn't take
+def writeSettings(values):
+	failed=poe.write_many(values)
+	for path in failed:
+		print('****Failed to set '+path+': '+failed[path]+'****')
+	return failed
+
+#writeSettings for settings that mustn't be taken as set when they weren't,
+#like HV setpoints: raises OdbeditError naming the keys that didn't take
+def requireSettings(values):
+	failed=writeSettings(values)
+	if failed:
+		raise poe.OdbeditError('Failed to set '+', '.join(sorted(failed)),
+			output='\n'.join(path+': '+failed[path] for path in sorted(failed)))
+	return failed
+
+#Run fn(board) for every board at once and wait until all of them are done
+#Returns (results in board order, {board: (start, end)})
+def forEachBoard(pdcrc,fn):
+	global _pool
+	with _poolLock:
+		if _pool is None:
+			_pool=ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+	#The workers run in the caller's context, so ODB traces see its phase
+	context=contextvars.copy_context()
+	def timed(board):
+		start=time.monotonic()
+		result=context.copy().run(fn,board)
+		return result,start,time.monotonic()
+
+	results=list(_pool.map(timed,pdcrc))
+	timing=dict((board,(start,end)) for board,(result,start,end) in zip(pdcrc,results))
+	lastTiming.clear()
+	lastTiming.update(timing)
+	return [result for result,start,end in results],timing
+
+#Time (s) between the first and last board finishing
+def boardSpread(timing=None):
+	if timing is None:
+		timing=lastTiming
+	if not timing:
+		return 0.0
+	ends=[end for start,end in timing.values()]
+	return max(ends)-min(ends)
 
 def turnQBiasOff(pdcrc):
-	#loop over the DCRC list and turn off Qbias
-	for board in pdcrc:
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(board)+'/Charge/Bias (V)[0]','0')
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(board)+'/Charge/Bias (V)[1]','0')
+	#turn off Qbias on every DCRC in the list
+	def off(board):
+		return writeSettings({
+			paths.path(board,'chargeBias',0):'0',
+			paths.path(board,'chargeBias',1):'0'})
 	
-	return 
+	return forEachBoard(pdcrc,off)[1]
 
 def get15VPowerEnable(pdcrc):
-	#loop over the DCRC list and save 15V power states
-	state=[]
-	for board in pdcrc:
-		state.append(poe.read('/Equipment/Tower01/Settings/DCRC'+str(board)+'/LED/Enable15VPower'))
+	#read the 15V power states of all the DCRCs (as bools)
+	def get(board):
+		return poe.read_value(paths.path(board,'enable15V'))
 	
-	return state 
+	return forEachBoard(pdcrc,get)[0]
 
 def set15VPowerEnable(pdcrc, dcrcSettings):
-	#loop over the DCRC and settings lists and set appropriate settings
-	for board,setting in zip(pdcrc,dcrcSettings):
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(board)+'/LED/Enable15VPower',str(setting))
+	#set each DCRC to its entry in the settings list
+	settings=dict(zip([paths.board(board) for board in pdcrc],dcrcSettings))
+	def restore(board):
+		return writeSettings({paths.path(board,'enable15V'):settings[paths.board(board)]})
 	
-	return 
+	return forEachBoard(pdcrc,restore)[1]
 
 def turn15VPowerEnableOn(pdcrc):
-	#loop over the DCRC list and enable 15V power
-	for board in pdcrc:
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(board)+'/LED/Enable15VPower','y')
+	#enable 15V power on every DCRC in the list
+	def on(board):
+		return writeSettings({paths.path(board,'enable15V'):'y'})
 	
-	return 
+	return forEachBoard(pdcrc,on)[1]
 
 def setUpLEDs(pdcrc,pcur,pwidth,prep):
 	#set durations and stuff
-	poe.write('/Equipment/Tower01/Settings/DCRC'+str(pdcrc)+'/LED/LEDPulseWidth (us)',str(pwidth))
-	poe.write('/Equipment/Tower01/Settings/DCRC'+str(pdcrc)+'/LED/LEDRepRate (us)',str(prep))
-	poe.write('/Equipment/Tower01/Settings/DCRC'+str(pdcrc)+'/LED/LED1Current (mA)',str(pcur))
-	poe.write('/Equipment/Tower01/Settings/DCRC'+str(pdcrc)+'/LED/LED2Current (mA)',str(pcur))
+	writeSettings({
+		paths.path(pdcrc,'ledPulseWidth'):str(pwidth),
+		paths.path(pdcrc,'ledRepRate'):str(prep),
+		paths.path(pdcrc,'led1Current'):str(pcur),
+		paths.path(pdcrc,'led2Current'):str(pcur)})
 	
 	return 
 
@@ -51,8 +120,9 @@ def enableLEDs(pdcrc,onoff):
 	else:
 		state='y'
 
-	for board in pdcrc:
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(board)+'/LED/EnableLED1',state)
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(board)+'/LED/EnableLED2',state)
+	def enable(board):
+		return writeSettings({
+			paths.path(board,'enableLED1'):state,
+			paths.path(board,'enableLED2'):state})
 	
-	return 
+	return forEachBoard(pdcrc,enable)[1]
@@ -11,7 +11,115 @@ from argparse import ArgumentParser, ArgumentTypeError
 
 import pyChangeHV
 import pyodbedit
-import pyflash
+import pyODBpaths
+import pyScan
+
+#The HV bias side of an HV scan on one detector: the steps that take the HV
+#to each point in HVlist and back to 0, and drift it during runs
+#pyMultiScan interleaves these for several detectors.
+class HVBias(object):
+	def __init__(self,iDCRC,HVlist,HVcalFile,HVrampRate=1.0,HVrampUpdatePeriod=1.0,
+			HVdriftRate=0.0,HVdriftUpdatePeriod=10.0,HVpreBiasPercent=None,HVpreBiasWait_sec=0,
+			HVmaxRate=None,HVrampTolerance=pyChangeHV.RAMP_TOLERANCE,HVreadback=None):
+		self.iDCRC=iDCRC
+		self.HVlist=list(HVlist)
+		self.HVcalFile=HVcalFile
+		self.HVrampRate=HVrampRate
+		self.HVrampUpdatePeriod=HVrampUpdatePeriod
+		self.HVdriftRate=HVdriftRate
+		self.HVdriftUpdatePeriod=HVdriftUpdatePeriod
+		self.HVpreBiasPercent=HVpreBiasPercent
+		self.HVpreBiasWait_sec=HVpreBiasWait_sec
+		#Closed-loop ramps to and from the points (not drifts), if HVmaxRate is set
+		self.adaptive={'HVmaxRate':HVmaxRate,'HVrampTolerance':HVrampTolerance,'HVreadback':HVreadback}
+		self.points=len(self.HVlist)
+		#Where the HV is after the steps made so far
+		self.HV=0.0
+
+	def describe(self):
+		return 'HV on DCRC '+pyODBpaths.name(self.iDCRC)
+
+	#DCRCs the scan sets
+	def boards(self):
+		return [self.iDCRC]
+
+	#Turn on the supply and ramp up to point i (via a prebias if
+	#HVpreBiasPercent is set and HV!=0)
+	def setSteps(self,i,label):
+		HV=self.HVlist[i]
+		steps=[pyScan.HVPower(self.iDCRC,'ON')]
+		#Prebias if it was called for and this is not a 0V series
+		if (self.HVpreBiasPercent is not None) and HV!=0:
+			HVpre=round((1.0+self.HVpreBiasPercent/100.)*HV,2)
+			steps.append(pyScan.Ramp(self.iDCRC,self.HV,HVpre,self.HVrampRate,self.HVrampUpdatePeriod,self.HVcalFile,'prebias',**self.adaptive))
+			steps.append(pyScan.Wait(self.HVpreBiasWait_sec,'prebias'))
+			steps.append(pyScan.Ramp(self.iDCRC,HVpre,HV,self.HVrampRate,self.HVrampUpdatePeriod,self.HVcalFile,label,**self.adaptive))
+		else:
+			steps.append(pyScan.Ramp(self.iDCRC,self.HV,HV,self.HVrampRate,self.HVrampUpdatePeriod,self.HVcalFile,label,**self.adaptive))
+		self.HV=HV
+		return steps
+
+	#The step drifting the HV at HVdriftRate V/s through a run of tSeries_sec,
+	#or None if it doesn't drift
+	def driftStep(self,tSeries_sec,label):
+		if self.HVdriftRate==0.0:
+			return None
+		HVfinal=self.HV+self.HVdriftRate*tSeries_sec
+		step=pyScan.Ramp(self.iDCRC,self.HV,HVfinal,abs(self.HVdriftRate),self.HVdriftUpdatePeriod,self.HVcalFile,'drift '+label)
+		self.HV=HVfinal
+		return step
+
+	#Ramp back to 0
+	def unsetSteps(self):
+		step=pyScan.Ramp(self.iDCRC,self.HV,0.0,self.HVrampRate,self.HVrampUpdatePeriod,self.HVcalFile,'to 0',**self.adaptive)
+		#pyChangeHV.setHVpowerOnOff('OFF') # This seems to cause channels to rail. Just dial it down to 0
+		self.HV=0.0
+		return [step]
+
+#Build the list of pyScan steps for an HV scan
+#For each HV: turn on the supply, ramp up (via a prebias if HVpreBiasPercent is
+#set and HV!=0), take nSubSeries runs of tSeries_sec each (drifting the HV at
+#HVdriftRate V/s if that isn't 0), ramp back to 0, then flash and cool down.
+#Assumes we start at HV=0 with the power supply off.
+def hvScanSteps(iDCRC,HVlist,HVcalFile,tSeries_sec,DCRCs2Flash,nSubSeries=1,
+		HVrampRate=1.0,HVrampUpdatePeriod=1.0,HVdriftRate=0.0,HVdriftUpdatePeriod=10.0,
+		HVpreBiasPercent=None,HVpreBiasWait_sec=0,FlashDuration=30.0,CoolDuration_sec=1800,
+		HVmaxRate=None,HVrampTolerance=pyChangeHV.RAMP_TOLERANCE,HVreadback=None):
+	bias=HVBias(iDCRC,HVlist,HVcalFile,HVrampRate,HVrampUpdatePeriod,HVdriftRate,HVdriftUpdatePeriod,
+		HVpreBiasPercent,HVpreBiasWait_sec,HVmaxRate,HVrampTolerance,HVreadback)
+	steps=[pyScan.Settings({pyODBpaths.WRITE_DATA:'y',pyODBpaths.RUN_DURATION:'0'},'logger on')]
+	for iHV in range(bias.points):
+		label='set '+str(iHV+1)+'/'+str(bias.points)
+		###########
+		#Set HV
+		###########
+		steps+=bias.setSteps(iHV,label)
+
+		###########
+		#Take data
+		###########
+		steps.append(pyScan.Settings({pyODBpaths.SERIES_DURATION:str(tSeries_sec)},label))
+		for iSubSeries in range(nSubSeries):
+			subLabel=label+(' subseries '+str(iSubSeries+1)+'/'+str(nSubSeries) if nSubSeries>1 else '')
+			steps.append(pyScan.StartRun(subLabel,iHV,iSubSeries))
+			#Drift HV during data taking, or just take data
+			steps.append(bias.driftStep(tSeries_sec,subLabel) or pyScan.TakeData(tSeries_sec,subLabel))
+			steps.append(pyScan.StopRun(subLabel))
+
+		###########
+		#Set HV=0
+		###########
+		steps+=bias.unsetSteps()
+
+		###########
+		#Flash & cooldown
+		###########
+		steps.append(pyScan.Flash(DCRCs2Flash,FlashDuration,label))
+		steps.append(pyScan.Cool(CoolDuration_sec,label))
+
+	#Return to normal settings
+	steps.append(pyScan.Settings({pyODBpaths.WRITE_DATA:'n'},'logger off'))
+	return steps
 
 #the stuff below is so this functionality can be used as a script
 ########################################################################
@@ -23,26 +131,37 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Get run info')
 
 	#DCRC number	
-	parser.add_argument('-iDCRC',type=int,help='MIDAS DCRC number of board controlling HV')
+	parser.add_argument('-iDCRC',type=str,help='MIDAS DCRC number of board controlling HV, or Tower:DCRC (e.g. Tower02:4) for a board on another tower than '+pyODBpaths.DEFAULT_TOWER)
 	#Voltage Biases
 	parser.add_argument('-HVs',type=str,help='Comma-separated list of bias voltages in desired run order.')
 	parser.add_argument('-HVcalFile',type=str,help='Calibration file. Should be a tab-separated file with the first column being the DCRC4QI control voltage and the second being the resulting HV output voltage. These values should be in numerical order. The first row is reserved for column headers. Note: This code is very stupid, so make sure the format is correct!')
 	parser.add_argument('-HVrampRate',type=float,default=1.0,help='Rate for fast HV voltage changes in V/s (default is 1 V/s). This is used when turning the HV up/down before/after data taking.')
-	parser.add_argument('-HVrampUpdatePeriod',type=int,default=1,help='Period of time (in s) to wait between HV voltage changes while ramping. Default is 1 s. This is used when turning the HV up/down before/after data taking.')
+	parser.add_argument('-HVrampUpdatePeriod',type=float,default=1,help='Period of time (in s) to wait between HV voltage changes while ramping. Default is 1 s. This is used when turning the HV up/down before/after data taking.')
 	parser.add_argument('-HVdriftRate',type=float,default=0.0,help='Rate for HV voltage drifts in V/s (default is 0 V/s). This is used for slow HV changes during data taking.')
-	parser.add_argument('-HVdriftUpdatePeriod',type=int,default=10,help='Period of time (in s) to wait between HV voltage changes while drifting. Default is 10 s. This is used for slow HV changes during data taking.')
+	parser.add_argument('-HVdriftUpdatePeriod',type=float,default=10,help='Period of time (in s) to wait between HV voltage changes while drifting. Default is 10 s. This is used for slow HV changes during data taking.')
+	parser.add_argument('-HVmaxRate',type=float,help='Ramp in closed loop, speeding up from HVrampRate to at most this many V/s while the HV readback keeps up (drifts stay open loop). Default is to ramp at HVrampRate without looking.')
+	parser.add_argument('-HVrampTolerance',type=float,default=pyChangeHV.RAMP_TOLERANCE,help='How far (V) the readback may lag the setpoint in a closed-loop ramp. Default is '+str(pyChangeHV.RAMP_TOLERANCE)+' V.')
+	parser.add_argument('-HVreadback',type=str,help='ODB key to read the HV back from, in V, for closed-loop ramps. Default is the DCRC charge bias monitor, converted with the calibration file.')
 	parser.add_argument('-HVpreBias',type=str,default='None',help='Prebias settings for HV. Should be in the form (Overbias %%)/(wait time min). As in 15/5 to overbias by 15%% for 5 minutes. Default is None.')
 	#Series time	
 	parser.add_argument('-tSeries',type=float,help='Run time for each data series in minutes')
 	parser.add_argument('-NsubSeries',type=int,help='Number of subseries (individual MIDAS runs) to break each series into. This feature is for mitigating various DCRC issues which are reset by stopping/starting a new run. Default is None.')
 	#Flashing
-	parser.add_argument('-DCRCs2Flash',type=str,help='Comma-separated list of DCRC MIDAS numbers to use for flashing')
+	parser.add_argument('-DCRCs2Flash',type=str,help='Comma-separated list of DCRC MIDAS numbers to use for flashing. Boards on other towers can be given as Tower:DCRC, e.g. 1,2,Tower02:1.')
 	parser.add_argument('-FlashDuration',type=float,default=30,help='Flash time in seconds. Default is 30 s.')
 	parser.add_argument('-CoolDuration',type=float,default=30,help='Post flash cooldown time in minutes. Default is 30 min.')
 
-	#So far this only has the oldMidas paths hardcoded
+	#Timing
+	parser.add_argument('-trace',type=str,help='Record every ODB call to this file (.jsonl, or .json for a Chrome trace) and print where the time went at the end.')
+	parser.add_argument('-journal',type=str,help='Journal file recording the scan\'s progress, so an interrupted scan can be carried on with -resume. Default is no journal.')
+	parser.add_argument('-resume',action='store_true',default=False,help='Carry on an interrupted scan from its -journal, after putting the hardware back where the scan expects it.')
+	parser.add_argument('-runLog',type=str,help='Record every run with the biases it was taken at in this file (.db for SQLite, or .csv). See pyRunLog.')
+
+	#ODB paths come from pyODBpaths (the oldMidas layout unless PYODB_LAYOUT says otherwise)
 	
 	args = parser.parse_args()
+	if args.resume and args.journal is None:
+		parser.error('-resume needs the -journal of the scan to carry on')
 
 	###########################
 	#Parse command line inputs
@@ -51,25 +170,29 @@ if __name__ == "__main__":
 	if (args.iDCRC is None) or (args.HVs is None) or (args.HVcalFile is None) or (args.HVrampRate is None) or (args.tSeries is None) or (args.DCRCs2Flash is None):
 		parser.error('Error: missing required input. See pyChangeHV -h for info.')
 
-	iDCRC = int(args.iDCRC)
+	iDCRC = args.iDCRC
 	HVlist=[float(x) for x in args.HVs.split(',')]
 
 	HVcalFile=args.HVcalFile
 	
 	HVrampRate=args.HVrampRate
-	if args.HVrampUpdatePeriod<1.0:
-		parser.error('Minimum HVrampUpdatePeriod is 1 s')
+	if args.HVmaxRate is not None and args.HVmaxRate<HVrampRate:
+		parser.error('HVmaxRate must be at least HVrampRate')
+	if args.HVrampUpdatePeriod<pyChangeHV.MIN_UPDATE_PERIOD:
+		parser.error('Minimum HVrampUpdatePeriod is '+str(pyChangeHV.MIN_UPDATE_PERIOD)+' s')
 	else:
 		HVrampUpdatePeriod=args.HVrampUpdatePeriod
 	
 	HVdriftRate=args.HVdriftRate
-	if args.HVdriftUpdatePeriod<1.0:
-		parser.error('Minimum HVdriftUpdatePeriod is 1 s')
+	if args.HVdriftUpdatePeriod<pyChangeHV.MIN_UPDATE_PERIOD:
+		parser.error('Minimum HVdriftUpdatePeriod is '+str(pyChangeHV.MIN_UPDATE_PERIOD)+' s')
 	else:
 		HVdriftUpdatePeriod=args.HVdriftUpdatePeriod
 
 	if args.HVpreBias=='None':
 		args.HVpreBias=None
+	HVpreBiasPercent=None
+	HVpreBiasWait_sec=0
 	if not (args.HVpreBias is None):
 		HVpreBiasPercent=float(args.HVpreBias.split('/')[0])
 		HVpreBiasWait_sec=int(60.0*float(args.HVpreBias.split('/')[1]))
@@ -90,88 +213,26 @@ if __name__ == "__main__":
 	###########################
 	print('HV bias Scan')
 	print('COMMENT "Command to produce this script was: python '+" ".join(sys.argv[:])+'"')
-	pyodbedit.write('/Logger/Write data','y')
-	pyodbedit.write('/Logger/Run duration','0')
-
-	print('run/flash/cooldown loop')
-	#Assume we start at HV=0 with the power supply off	
-	HVcurr=0.0
-	for iHV, HV in enumerate(HVlist):
-		###########
-		#Set HV
-		###########
-		#Just have the pyChangeHV function handle this
-		pyChangeHV.setHVpowerOnOff(iDCRC,'ON')
-
-		changeHVargs=["-iDCRC",str(iDCRC),"-HVstart","0.0","-HVend",str(HV),"-HVcalFile",str(HVcalFile),\
-				"-HVrampRate",str(HVrampRate),"-HVrampUpdatePeriod",str(HVrampUpdatePeriod)]
-		#Prebias if it was called for and this is not a 0V series
-		if (not (args.HVpreBias is None)) and HV!=0:
-			changeHVargs.append("-HVpreBias")
-			changeHVargs.append(str(args.HVpreBias))
-		pyChangeHV.main(changeHVargs)
-		###########
-		#Take data
-		###########
-		print('Take Data. Set '+str(iHV+1)+'/'+str(len(HVlist)))
-		pyodbedit.write('/Seriesinfo/Duration (s)',str(tSeries_sec))
-
-		for iSubSeries in range(nSubSeries):
-			if nSubSeries>1:
-				print('SubSeries '+str(iSubSeries+1)+'/'+str(nSubSeries))
-
-			print('Start Run')
-			pyodbedit.runstart()
-
-			if HVdriftRate==0.0:
-				#No HV drifting
-				print('Waiting'+ str(tSeries_sec))
-				time.sleep(tSeries_sec)
-			else:
-				#Drift HV during data taking
-				print('Drifting HV at '+str(HVdriftRate)+' V/s')
-				HVfinal=HV+HVdriftRate*tSeries_sec
-				changeHVargs=["-iDCRC",str(iDCRC),"-HVstart",str(HV),"-HVend",str(HVfinal),"-HVcalFile",str(HVcalFile),\
-							"-HVrampRate",str(HVdriftRate),"-HVrampUpdatePeriod",str(HVdriftUpdatePeriod)]
-				pyChangeHV.main(changeHVargs)
-				HV=HVfinal
-
-			print('Stop Run')
-			pyodbedit.runstop()
-			
-
-		###########
-		#Set HV=0
-		###########
-		changeHVargs=["-iDCRC",str(iDCRC),"-HVstart",str(HV),"-HVend","0.0","-HVcalFile",str(HVcalFile),\
-				"-HVrampRate",str(HVrampRate),"-HVrampUpdatePeriod",str(HVrampUpdatePeriod)]
-		pyChangeHV.main(changeHVargs)
-		#pyChangeHV.setHVpowerOnOff('OFF') # This seems to cause channels to rail. Just dial it down to 0
+	pyodbedit.enable_cache()
+	if args.trace is not None:
+		pyodbedit.enable_trace(args.trace)
+
+	steps=hvScanSteps(iDCRC,HVlist,HVcalFile,tSeries_sec,DCRCs2FlashList,nSubSeries,
+		HVrampRate,HVrampUpdatePeriod,HVdriftRate,HVdriftUpdatePeriod,
+		HVpreBiasPercent,HVpreBiasWait_sec,FlashDuration,CoolDuration_sec,
+		args.HVmaxRate,args.HVrampTolerance,args.HVreadback)
+	scan=pyScan.Scan(steps,tasks=[pyScan.progress(300)],name='HV bias Scan',journal=args.journal,runLog=args.runLog)
+	print('run/flash/cooldown loop. Expected duration '+str(round(scan.expectedDuration()/3600.,2))+' h')
+	start=0
+	if args.resume:
+		start=scan.recover()
+	try:
+		scan.run(start)
+	except pyScan.ScanAborted as e:
+		sys.exit('****Scan aborted: '+str(e)+('. Run again with -resume to carry on.' if args.journal else '')+'****')
 
-		###########
-		#Flash & cooldown
-		###########
-		print('Flash and cooldown')
-		#Save 15V power settings and enable
-		DCRC_15VPowerList=pyflash.get15VPowerEnable(DCRCs2FlashList)
-		pyflash.turn15VPowerEnableOn(DCRCs2FlashList)
-
-		#Flash
-		pyflash.enableLEDs(DCRCs2FlashList,1)
-		print('Wait '+ str(FlashDuration)+ ' sec')
-		time.sleep(FlashDuration)
-		pyflash.enableLEDs(DCRCs2FlashList,0)
-		
-		#Restore previous 15V power state
-		pyflash.set15VPowerEnable(DCRCs2FlashList,DCRC_15VPowerList)
-		#Cooldown
-		print('Cooldown '+ str(CoolDuration_sec)+' sec')
-		time.sleep(CoolDuration)
-		print('')
-
-	
-	#Return to normal settings
 	print('')
 	print('Restore normal settings')
-	pyodbedit.write('/Logger/Write data','n')
-
+	print('ODB cache: '+str(pyodbedit.cache_stats()))
+	if args.trace is not None:
+		pyodbedit.print_trace_summary()
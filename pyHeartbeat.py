@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#Write the current unix time to the ODB every second, as a heartbeat
+#This replaces write_time.sh, which started a new odbedit (and a shell) for
+#every tick and drifted by however long each odbedit took. Here the writes go
+#over one persistent pyodbedit connection and the ticks are on fixed deadlines
+#of the monotonic clock, so a slow write doesn't push the later ticks back.
+#
+#Standalone:
+#  python pyHeartbeat.py [-path /Playground/time] [-period 1] [-report 3600]
+#
+#In another script, in a background thread:
+#  hb=pyHeartbeat.Heartbeat(); hb.start(); ... hb.stop(); print(hb.summary())
+#
+#or as a scan background task: pyScan.heartbeat()
+#
+#A tick that can't happen on time because the previous write was still going
+#is skipped and counted as missed, rather than written late in a burst.
+
+import sys
+import time
+import asyncio
+import argparse
+import threading
+import collections
+
+import pyodbedit as poe
+
+#Number of write latencies kept for the statistics
+HISTORY=3600
+
+class Heartbeat(object):
+	def __init__(self,path='/Playground/time',period=1.0):
+		if period<=0:
+			raise ValueError('Heartbeat period must be positive, not '+str(period))
+		self.path=path
+		self.period=float(period)
+		self.ticks=0
+		self.missed=0
+		self.failures=0
+		#Recent write times and how late each tick started (s)
+		self.latency=collections.deque(maxlen=HISTORY)
+		self.lateness=collections.deque(maxlen=HISTORY)
+		self.stopping=threading.Event()
+		self.thread=None
+
+	#Write the time once, returning how long the write took
+	def tick(self):
+		t0=time.monotonic()
+		try:
+			failed=poe.write(self.path,int(time.time()))
+			if failed:
+				self.failures+=1
+				print('****Heartbeat write failed: '+failed+'****')
+		except Exception as e:
+			self.failures+=1
+			print('****Heartbeat write failed: '+str(e)+'****')
+		dt=time.monotonic()-t0
+		self.ticks+=1
+		self.latency.append(dt)
+		return dt
+
+	#The deadline after a tick that was due at deadline, skipping (and
+	#counting) any that have already gone by
+	def _next(self,deadline):
+		deadline+=self.period
+		now=time.monotonic()
+		if now>deadline:
+			skipped=int((now-deadline)//self.period)+1
+			self.missed+=skipped
+			deadline+=skipped*self.period
+		return deadline
+
+	#Tick until stop() is called, or for duration s
+	def run(self,duration=None):
+		deadline=time.monotonic()
+		end=None if duration is None else deadline+duration
+		while end is None or deadline<end:
+			wait=deadline-time.monotonic()
+			if wait>0 and self.stopping.wait(wait):
+				break
+			if self.stopping.is_set():
+				break
+			self.lateness.append(max(0.0,time.monotonic()-deadline))
+			self.tick()
+			deadline=self._next(deadline)
+
+	#The same loop for an asyncio program. write(fn, *args) runs a blocking call
+	#off the event loop, e.g. pyScan.Scan.odb
+	async def runAsync(self,write):
+		deadline=time.monotonic()
+		while True:
+			await asyncio.sleep(max(0.0,deadline-time.monotonic()))
+			self.lateness.append(max(0.0,time.monotonic()-deadline))
+			await write(self.tick)
+			deadline=self._next(deadline)
+
+	#Run in a background thread
+	#A stop() from here on ends it, even if the thread hasn't got going yet
+	def start(self,duration=None):
+		self.stopping.clear()
+		self.thread=threading.Thread(target=self.run,args=(duration,),name='heartbeat')
+		self.thread.daemon=True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopping.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread=None
+
+	#Counts and timing so far: ticks, missed, failures, and write latency /
+	#start lateness in s over the last HISTORY ticks
+	def stats(self):
+		latency=sorted(self.latency)
+		lateness=sorted(self.lateness)
+		return {'ticks':self.ticks,'missed':self.missed,'failures':self.failures,
+			'latencyMean':sum(latency)/len(latency) if latency else 0.0,
+			'latencyP99':poe.percentile(latency,99),'latencyMax':poe.percentile(latency,100),
+			'latenessMax':poe.percentile(lateness,100)}
+
+	def summary(self):
+		s=self.stats()
+		return ('Heartbeat: '+str(s['ticks'])+' ticks, '+str(s['missed'])+' missed, '+str(s['failures'])+' failed. '
+			+'Write latency mean '+str(round(1000*s['latencyMean'],1))+' ms, p99 '+str(round(1000*s['latencyP99'],1))
+			+' ms, max '+str(round(1000*s['latencyMax'],1))+' ms. Latest start '+str(round(1000*s['latenessMax'],1))+' ms')
+
+########################################################################
+def main(args):
+	parser = argparse.ArgumentParser(description='Write the unix time to the ODB every period seconds')
+	parser.add_argument('-path',type=str,default='/Playground/time',help='ODB key to write. Default is /Playground/time.')
+	parser.add_argument('-period',type=float,default=1.0,help='Time between writes in s. Default is 1 s.')
+	parser.add_argument('-report',type=float,default=3600,help='Print the tick statistics every this many s (0 for never). Default is 3600 s.')
+	parser.add_argument('-duration',type=float,help='Stop after this many s. Default is to run until interrupted.')
+	args = parser.parse_args(args)
+
+	hb=Heartbeat(args.path,args.period)
+	print('Writing the time to '+hb.path+' every '+str(hb.period)+' s')
+	hb.start(args.duration)
+	nextReport=time.monotonic()+args.report
+	try:
+		while hb.thread.is_alive():
+			hb.thread.join(1.0)
+			if args.report>0 and time.monotonic()>=nextReport and hb.thread.is_alive():
+				print(hb.summary())
+				nextReport+=args.report
+	except KeyboardInterrupt:
+		pass
+	hb.stop()
+	print(hb.summary())
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,98 @@
+#Scan several detectors at once, sharing the runs, flashes and cooldowns
+#
+#Each detector's bias scan is an HVBias (pyHVscan) or QBias (pyQscan). Point i
+#of every scan is set at the same time (in parallel), then the runs are taken
+#once for all of them, then every bias goes back to 0 together and one flash
+#and cooldown covers all the flashed DCRCs. N detectors are scanned in about
+#the time of the longest single scan instead of N times as long.
+#
+#  biases=[pyHVscan.HVBias(4,[0,10,20],'cal.txt'),pyQscan.QBias(3,1,[[0,0],[5,-5]])]
+#  steps=pyMultiScan.multiScanSteps(biases,3600,[1,2,3])
+#
+#A scan with fewer points than the others sits at 0 for the points after its last.
+#Two scans can't set the same DCRC (see checkConflicts).
+#
+#pyScanPlan runs these from plan files with type: multi.
+
+import pyODBpaths
+import pyScan
+
+#Raised when two scans would set the same DCRC
+class ConflictError(ValueError):
+	pass
+
+#Make sure no DCRC is set by more than one of the biases
+def checkConflicts(biases):
+	owner={}
+	for bias in biases:
+		for board in bias.boards():
+			board=pyODBpaths.board(board)
+			if board in owner and owner[board] is not bias:
+				raise ConflictError('DCRC '+pyODBpaths.name(board)+' is set by both '
+					+owner[board].describe()+' and '+bias.describe())
+			owner[board]=bias
+
+#One step (or nothing) running the chains of steps at the same time
+#Chains that are just a batch of settings are merged into a single write
+def _together(chains,label=''):
+	chains=[chain for chain in chains if chain]
+	values={}
+	rest=[]
+	for chain in chains:
+		if len(chain)==1 and isinstance(chain[0],pyScan.Settings):
+			values.update(chain[0].values)
+		else:
+			rest.append(chain)
+	if values:
+		rest.insert(0,[pyScan.Settings(values,label)])
+	if not rest:
+		return []
+	if len(rest)==1:
+		return rest[0]
+	return [pyScan.Parallel(rest,label)]
+
+#Build the list of pyScan steps scanning all the biases together
+#For each point: set every bias, take nSubSeries runs of tSeries_sec each
+#(drifting any HVs that drift), set every bias back to 0, then flash DCRCs2Flash
+#and cool down. debug leaves /Logger/Write data alone.
+def multiScanSteps(biases,tSeries_sec,DCRCs2Flash,nSubSeries=1,FlashDuration=30.0,CoolDuration_sec=1800,debug=False):
+	biases=list(biases)
+	checkConflicts(biases)
+	logger={pyODBpaths.RUN_DURATION:'0'}
+	if not debug:
+		logger[pyODBpaths.WRITE_DATA]='y'
+	steps=[pyScan.Settings(logger,'logger on')]
+	points=max([bias.points for bias in biases]+[0])
+	for i in range(points):
+		label='set '+str(i+1)+'/'+str(points)
+		active=[bias for bias in biases if i<bias.points]
+		###########
+		#Set biases
+		###########
+		steps+=_together([bias.setSteps(i,label) for bias in active],label)
+
+		###########
+		#Take data
+		###########
+		steps.append(pyScan.Settings({pyODBpaths.SERIES_DURATION:str(tSeries_sec)},label))
+		for iSubSeries in range(nSubSeries):
+			subLabel=label+(' subseries '+str(iSubSeries+1)+'/'+str(nSubSeries) if nSubSeries>1 else '')
+			steps.append(pyScan.StartRun(subLabel,i,iSubSeries))
+			drifts=[bias.driftStep(tSeries_sec,subLabel) for bias in active]
+			steps+=_together([[pyScan.TakeData(tSeries_sec,subLabel)]]+[[step] for step in drifts if step is not None],subLabel)
+			steps.append(pyScan.StopRun(subLabel))
+
+		###########
+		#Biases to 0
+		###########
+		steps+=_together([bias.unsetSteps() for bias in active],'to 0')
+
+		###########
+		#Flash & cooldown
+		###########
+		steps.append(pyScan.Flash(DCRCs2Flash,FlashDuration,label))
+		steps.append(pyScan.Cool(CoolDuration_sec,label))
+
+	#Return to normal settings
+	steps.append(pyScan.Settings({pyODBpaths.WRITE_DATA:'n'},'logger off'))
+	return steps
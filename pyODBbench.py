@@ -0,0 +1,167 @@
+# Benchmarks for the control scripts, run against the simulated ODB in pyODBsim
+# No DAQ needed. Each benchmark drives the real code paths and prints what it measured:
+#   backend  - time per read/write for the odbedit session pool, one odbedit per call,
+#              and the in-memory backend (the odbedit ones use pyODBsim.py as odbedit)
+#   calls    - ODB reads/writes/transitions made by each kind of scan step
+#   ramp     - how closely an HV ramp keeps to the requested rate when writes are slow
+#   flash    - skew between the first and last DCRC's LED edge
+#   scan     - a whole HV scan with time compressed, compared with its estimate
+#
+# e.g. python pyODBbench.py -latency 0.02 -nDCRC 12 -compress 3600
+#
+# These only measure. What the code should do is checked by the tests
+# (test_*.py, run with python -m pytest), which use the same simulated ODB.
+#
+# The scan benchmark runs a 10 point HV scan plan (about 14 hours) in seconds
+# by compressing time. Anything the computer spends real time on is stretched
+# by the same factor, so its overhead figure is an upper bound.
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import collections
+import numpy as np
+
+import pyodbedit
+import pyFlash
+import pyChangeHV
+import pyScan
+import pyHVscan
+import pyODBsim
+
+#Write a linear 0-100 V calibration file to use in the benchmarks
+def _calFile():
+	f=tempfile.NamedTemporaryFile('w',suffix='.txt',delete=False)
+	f.write('DCRC setting\tHV\n')
+	for setting in np.linspace(0,5,11):
+		f.write(str(setting)+'\t'+str(20*setting)+'\n')
+	f.close()
+	return f.name
+
+#Time reads and writes through each backend
+def benchBackend(n=200):
+	print('== Backend call time ==')
+	state=tempfile.NamedTemporaryFile(suffix='.json',delete=False).name
+	os.remove(state)
+	os.environ['PYODBSIM_STATE']=state
+	odbedit=os.path.abspath(pyODBsim.__file__)
+	backends=[('odbedit session pool',pyodbedit.OdbeditBackend(odbedit=odbedit,persistent=True),n),
+		('odbedit per call',pyodbedit.OdbeditBackend(odbedit=odbedit,persistent=False),max(1,n//20)),
+		('memory',pyodbedit.MemoryBackend(pyODBsim.tower()),n)]
+	for name,backend,count in backends:
+		t0=time.monotonic()
+		for i in range(count):
+			backend.write_many([('/Playground/time',str(i))])
+			backend.read('/Playground/time')
+		dt=(time.monotonic()-t0)/(2*count)
+		batch=[('/Equipment/Tower01/Settings/DCRC1/LED/EnableLED1','y')]*8
+		t0=time.monotonic()
+		backend.write_many(batch)
+		dtBatch=time.monotonic()-t0
+		backend.close()
+		print('%-22s %8.3f ms/call  %8.3f ms for 8 batched writes'%(name,1000*dt,1000*dtBatch))
+	os.remove(state)
+
+#Count the ODB traffic of each kind of step in a small HV scan
+def benchCalls(sim,calFile):
+	print('== ODB calls per scan step ==')
+	steps=pyHVscan.hvScanSteps(4,[10.0,20.0],calFile,600,[1,2,3],nSubSeries=2,
+		HVpreBiasPercent=15,HVpreBiasWait_sec=300,CoolDuration_sec=1800)
+	scan=pyScan.Scan(steps)
+	perKind=collections.defaultdict(collections.Counter)
+	nKind=collections.Counter()
+	estimated=collections.defaultdict(lambda: [0,0])
+	for scan.index,step in enumerate(steps):
+		before=collections.Counter(sim.counts)
+		asyncio.run(step.run(scan))
+		perKind[step.kind].update(sim.counts-before)
+		nKind[step.kind]+=1
+		reads,writes=step.odbCalls()
+		estimated[step.kind][0]+=reads
+		estimated[step.kind][1]+=writes
+	print('%-10s %5s %9s %9s %9s %12s'%('step','n','calls','reads','writes','est r/w'))
+	for kind in nKind:
+		c=perKind[kind]
+		n=float(nKind[kind])
+		print('%-10s %5d %9.1f %9.1f %9.1f %6.1f/%-5.1f'%(kind,n,c['calls']/n,c['reads']/n,
+			(c['writes']+c['transitions'])/n,estimated[kind][0]/n,estimated[kind][1]/n))
+
+#Ramp at HVrampRate and compare the achieved rate and step lag with what was asked for
+def benchRamp(sim,calFile,HVrampRate=10.0,HVrampUpdatePeriod=0.1,HVend=20.0):
+	print('== Ramp timing (write latency '+str(round(1000*sim.latency,1))+' ms) ==')
+	cals=pyChangeHV.loadCalTable(calFile)
+	t0=time.monotonic()
+	rampLog=pyChangeHV.changeHVFromTo(1,0.0,HVend,HVrampRate,HVrampUpdatePeriod,cals)
+	dt=time.monotonic()-t0
+	lags=np.array([lag for t,HV,lag in rampLog])
+	print('Requested %.2f V/s, achieved %.2f V/s (%.2f s for %.1f V)'%(HVrampRate,HVend/dt,dt,HVend))
+	print('Step lag mean %.1f ms, p99 %.1f ms, max %.1f ms'%(1000*lags.mean(),1000*np.percentile(lags,99),1000*lags.max()))
+	print('A fixed sleep after each write would have managed %.2f V/s'
+		%(HVrampRate*HVrampUpdatePeriod/(HVrampUpdatePeriod+sim.latency)))
+
+#Turn LEDs on across nDCRC boards and measure the spread of the edges
+def benchFlash(sim,nDCRC):
+	print('== Flash edge skew across '+str(nDCRC)+' DCRCs ==')
+	boards=list(range(1,nDCRC+1))
+	for onoff,name in ((1,'on'),(0,'off')):
+		t0=time.monotonic()
+		pyFlash.enableLEDs(boards,onoff)
+		dt=time.monotonic()-t0
+		print('LEDs %-3s took %.1f ms, board spread %.1f ms (one board after another: ~%.1f ms)'
+			%(name,1000*dt,1000*pyFlash.boardSpread(),1000*nDCRC*sim.latency))
+
+#Run a full HV scan in compressed time and compare with its estimate
+def benchScan(sim,calFile,factor):
+	print('== Whole scan, time compressed x'+str(factor)+' ==')
+	steps=pyHVscan.hvScanSteps(4,[float(HV) for HV in range(0,50,5)],calFile,1800,[1,2,3],nSubSeries=2,
+		HVpreBiasPercent=15,HVpreBiasWait_sec=300,FlashDuration=30,CoolDuration_sec=1200)
+	scan=pyScan.Scan(steps)
+	est=scan.estimate()
+	before=collections.Counter(sim.counts)
+	t0=time.monotonic()
+	with pyODBsim.compressedTime(factor):
+		scan.run()
+	real=time.monotonic()-t0
+	counts=sim.counts-before
+	print('Expected %.2f h, took %.2f h simulated in %.1f s real'%(est['duration']/3600.,scan.elapsed/3600.,real))
+	print('Overhead %.1f s (%.2f%%)'%(scan.elapsed-est['duration'],100*(scan.elapsed-est['duration'])/est['duration']))
+	print('Live fraction %.1f%% (expected %.1f%%)'%(100*scan.liveTime/scan.elapsed,100*est['liveFraction']))
+	print('ODB calls %d: %d reads, %d writes + %d transitions (estimated %d reads, %d writes + transitions)'
+		%(counts['calls'],counts['reads'],counts['writes'],counts['transitions'],est['reads'],est['writes']))
+	print('(run state polling while waiting for transitions accounts for the extra reads)')
+
+########################################################################
+def main(args):
+	parser = argparse.ArgumentParser(description='Benchmark the control scripts against a simulated ODB')
+	parser.add_argument('benchmarks',nargs='*',default=['backend','calls','ramp','flash','scan'],help='Which benchmarks to run (backend, calls, ramp, flash, scan). Default is all.')
+	parser.add_argument('-latency',type=float,default=0.02,help='Simulated time per ODB call in s. Default is 0.02 s.')
+	parser.add_argument('-jitter',type=float,default=0.005,help='Extra random time per ODB call, up to this many s. Default is 0.005 s.')
+	parser.add_argument('-transitionDelay',type=float,default=0.5,help='Simulated run start/stop time in s. Default is 0.5 s.')
+	parser.add_argument('-nDCRC',type=int,default=12,help='Number of DCRCs to flash. Default is 12.')
+	parser.add_argument('-compress',type=float,default=3600,help='Time compression for the whole scan benchmark. Default is 3600.')
+	args = parser.parse_args(args)
+
+	calFile=_calFile()
+	sim=pyODBsim.SimBackend(pyODBsim.tower(max(4,args.nDCRC)),latency=args.latency,
+		jitter=args.jitter,transitionDelay=args.transitionDelay,seed=1)
+	pyodbedit.set_backend(sim)
+	try:
+		if 'backend' in args.benchmarks:
+			benchBackend()
+		if 'calls' in args.benchmarks:
+			with pyODBsim.compressedTime(1000):
+				benchCalls(sim,calFile)
+		if 'ramp' in args.benchmarks:
+			benchRamp(sim,calFile)
+		if 'flash' in args.benchmarks:
+			benchFlash(sim,args.nDCRC)
+		if 'scan' in args.benchmarks:
+			benchScan(sim,calFile,args.compress)
+	finally:
+		os.remove(calFile)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+#A local gateway that all the control tools' ODB traffic goes through
+#
+#When a scan, the heartbeat and an operator's pyChangeHV ramp all run at once,
+#each of them talking to the ODB on its own slows everything down, run
+#transitions included. Run this once on the DAQ host instead:
+#
+#  python pyODBgateway.py [-socket path] [-rate 50] [-window 0.05]
+#
+#and pyodbedit in every other tool talks to it over the Unix socket (it is
+#used automatically while it is running; see pyodbedit.GatewayBackend). The
+#socket is only usable by the user running the gateway, and by default is in
+#their own runtime directory (see pyodbedit.GATEWAY_SOCKET). Tools run as
+#another user don't use it. The gateway
+#  - makes the ODB calls one at a time, at most rate calls/s
+#  - holds writes for window s and sends them on as one batch, so repeated
+#    writes to the same key (from any tool) become a single write of the last value
+#  - serves run transitions and /Runinfo reads before anything else queued
+#  - answers 'metrics' requests with its queue depth, latencies and counts:
+#
+#  python pyODBgateway.py -metrics
+#
+#The gateway itself uses pyodbedit.direct_backend(), or -backend.
+#A tool waits for each reply, so its own calls still happen in the order it makes them.
+
+import os
+import sys
+import json
+import time
+import heapq
+import signal
+import argparse
+import itertools
+import threading
+import collections
+import socketserver
+
+import pyodbedit
+
+#Default maximum ODB calls per s, and how long (s) writes are held to be merged
+RATE=50.0
+WINDOW=0.05
+#Number of requests kept for the latency statistics
+HISTORY=10000
+
+#Queue priorities: run control first, then everything else in arrival order
+RUN_CONTROL=0
+NORMAL=1
+
+#One request waiting for the ODB
+class Request(object):
+	def __init__(self,op,args):
+		self.op=op
+		self.args=args
+		self.arrived=time.monotonic()
+		self.started=None
+		self.done=threading.Event()
+		self.result=None
+		self.error=None
+
+	def finish(self,result=None,error=None):
+		self.result=result
+		self.error=error
+		self.done.set()
+
+def _priority(op,args):
+	if op in ('runstart','runstop'):
+		return RUN_CONTROL
+	paths=args.get('paths') or [args.get('path') or '']
+	if all(path.startswith('/Runinfo/') for path in paths):
+		return RUN_CONTROL
+	return NORMAL
+
+#Serialises, rate limits and merges the ODB calls of all the clients
+#submit() is called from the client threads; run() is the one thread making
+#the calls on backend
+class Gateway(object):
+	def __init__(self,backend,rate=RATE,window=WINDOW):
+		self.backend=backend
+		self.interval=1.0/rate if rate else 0.0
+		self.window=window
+		self.cond=threading.Condition()
+		self.queue=[]
+		self.seq=itertools.count()
+		#Writes being held: {path: value}, the write requests they came from,
+		#when the batch goes, and its place in the queue
+		self.pending={}
+		self.writers=[]
+		self.due=None
+		self.batchSeq=None
+		self.stopping=False
+		self.lastCall=0.0
+		self.started=time.monotonic()
+		self.counts=collections.Counter()
+		#(op, s queued, s in the backend) for recent requests
+		self.history=collections.deque(maxlen=HISTORY)
+
+	#Queue a request and wait for its result
+	def submit(self,op,args):
+		request=Request(op,args)
+		with self.cond:
+			self.counts['requests']+=1
+			if op=='write_many':
+				if not self.writers:
+					self.due=request.arrived+self.window
+					self.batchSeq=next(self.seq)
+				for path,val in args['items']:
+					if path in self.pending:
+						self.counts['coalesced']+=1
+					self.pending[path]=val
+				self.writers.append(request)
+			else:
+				heapq.heappush(self.queue,(_priority(op,args),next(self.seq),request))
+			self.cond.notify()
+		request.done.wait()
+		if request.error is not None:
+			raise request.error
+		return request.result
+
+	#The next request (or batch of writes) to make, waiting until there is one
+	def _next(self):
+		with self.cond:
+			while not self.stopping:
+				now=time.monotonic()
+				batchReady=self.writers and now>=self.due
+				if self.queue and (not batchReady or self.queue[0][:2]<(NORMAL,self.batchSeq)):
+					return heapq.heappop(self.queue)[2]
+				if batchReady:
+					batch=Request('write_many',{'items':list(self.pending.items())})
+					batch.writers=self.writers
+					self.pending={}
+					self.writers=[]
+					return batch
+				self.cond.wait(self.due-now if self.writers else None)
+		return None
+
+	def _call(self,request):
+		args=request.args
+		if request.op=='read':
+			return self.backend.read(args['path'])
+		if request.op=='read_values':
+			return self.backend.read_values(args['paths'])
+		if request.op=='read_tree':
+			return self.backend.read_tree(args['path'])
+		if request.op=='write_many':
+			return self.backend.write_many(args['items'])
+		if request.op=='runstart':
+			return self.backend.runstart()
+		if request.op=='runstop':
+			return self.backend.runstop()
+		raise ValueError('unknown request '+repr(request.op))
+
+	#Make the calls until stop()
+	def run(self):
+		while True:
+			request=self._next()
+			if request is None:
+				return
+			if request.op not in ('runstart','runstop'):
+				wait=self.lastCall+self.interval-time.monotonic()
+				if wait>0:
+					time.sleep(wait)
+			request.started=time.monotonic()
+			self.lastCall=request.started
+			result=error=None
+			try:
+				result=self._call(request)
+			except Exception as e:
+				error=e
+			end=time.monotonic()
+			with self.cond:
+				self.counts['calls']+=1
+				if error is not None:
+					self.counts['errors']+=1
+			writers=getattr(request,'writers',None)
+			if writers is None:
+				self.history.append((request.op,request.started-request.arrived,end-request.started))
+				request.finish(result,error)
+				continue
+			#Each writer gets the failures of its own keys
+			for writer in writers:
+				self.history.append(('write_many',request.started-writer.arrived,end-request.started))
+				if error is not None:
+					writer.finish(error=error)
+				else:
+					writer.finish(dict((path,result[path]) for path,val in writer.args['items'] if path in result))
+
+	def stop(self):
+		with self.cond:
+			self.stopping=True
+			self.cond.notify()
+
+	#Queue depth, counts, and latency (ms) per kind of request over the last HISTORY
+	#requests, split into time queued and time in the backend
+	def metrics(self):
+		with self.cond:
+			out={'queued':len(self.queue),'pendingWrites':len(self.pending),'waitingWriters':len(self.writers),
+				'uptime':time.monotonic()-self.started}
+			out.update(self.counts)
+			history=list(self.history)
+		latency={}
+		for op in sorted(set(op for op,queued,busy in history)):
+			for name,index in (('queued',1),('backend',2)):
+				values=sorted(entry[index] for entry in history if entry[0]==op)
+				latency.setdefault(op,{'n':len(values)})[name]={
+					'mean':round(1000*sum(values)/len(values),3),
+					'p50':round(1000*pyodbedit.percentile(values,50),3),
+					'p99':round(1000*pyodbedit.percentile(values,99),3),
+					'max':round(1000*values[-1],3)}
+		out['latency']=latency
+		return out
+
+#One client connection: a JSON request per line, a JSON reply per line
+class Handler(socketserver.StreamRequestHandler):
+	def handle(self):
+		gateway=self.server.gateway
+		for line in self.rfile:
+			try:
+				request=json.loads(line.decode('utf-8'))
+				op=request.pop('op')
+				if op=='metrics':
+					reply={'result':gateway.metrics()}
+				else:
+					reply={'result':gateway.submit(op,request)}
+			except Exception as e:
+				reply={'error':str(e.args[0]) if isinstance(e,KeyError) and e.args else str(e),'type':type(e).__name__}
+			self.wfile.write((json.dumps(reply)+'\n').encode('utf-8'))
+			self.wfile.flush()
+
+class Server(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+	daemon_threads=True
+	#Room for every tool on the host connecting at once
+	request_queue_size=128
+
+#Serve on path until interrupted (or until server.shutdown() is called),
+#making its directory (owner-only) if there isn't one
+def serve(path,gateway,report=0):
+	directory=os.path.dirname(os.path.abspath(path))
+	if not os.path.isdir(directory):
+		os.makedirs(directory,0o700)
+	if os.stat(directory).st_uid not in (os.getuid(),0):
+		raise RuntimeError(directory+' belongs to another user')
+	if os.path.exists(path):
+		#Only replace the socket of a gateway that has gone away
+		try:
+			pyodbedit.GatewayBackend(path).close()
+			raise RuntimeError('a gateway is already running on '+path)
+		except (OSError,pyodbedit.GatewayError):
+			os.remove(path)
+	#The socket is made owner-only, so no one else can talk to the ODB through it
+	umask=os.umask(0o077)
+	try:
+		server=Server(path,Handler)
+	finally:
+		os.umask(umask)
+	server.gateway=gateway
+	worker=threading.Thread(target=gateway.run,name='gateway')
+	worker.daemon=True
+	worker.start()
+	if report>0:
+		def reporter():
+			while not gateway.stopping:
+				time.sleep(report)
+				print(json.dumps(gateway.metrics()))
+		reporting=threading.Thread(target=reporter,name='gateway metrics')
+		reporting.daemon=True
+		reporting.start()
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		gateway.stop()
+		worker.join()
+		if os.path.exists(path):
+			os.remove(path)
+
+########################################################################
+def main(args):
+	parser = argparse.ArgumentParser(description='Serve ODB access to the control tools over a Unix socket, one call at a time')
+	parser.add_argument('-socket',type=str,default=pyodbedit.GATEWAY_SOCKET,help='Unix socket to listen on. Default is '+pyodbedit.GATEWAY_SOCKET+' (or PYODB_GATEWAY).')
+	parser.add_argument('-backend',type=str,help='pyodbedit backend to use (odbedit, midas, jsonrpc). Default is the fastest available.')
+	parser.add_argument('-rate',type=float,default=RATE,help='Maximum ODB calls per s, not counting run transitions (0 for no limit). Default is '+str(RATE)+'.')
+	parser.add_argument('-window',type=float,default=WINDOW,help='How long (s) to hold writes to merge them. Default is '+str(WINDOW)+' s.')
+	parser.add_argument('-report',type=float,default=0,help='Print the metrics every this many s. Default is never.')
+	parser.add_argument('-metrics',action='store_true',default=False,help='Print the metrics of the gateway running on -socket and exit.')
+	args = parser.parse_args(args)
+
+	if args.metrics:
+		client=pyodbedit.GatewayBackend(args.socket)
+		print(json.dumps(client.metrics(),indent=1,sort_keys=True))
+		client.close()
+		return
+
+	if args.backend is not None and args.backend=='gateway':
+		parser.error('The gateway can\'t use itself as its backend')
+	backend=pyodbedit.BACKENDS[args.backend]() if args.backend is not None else pyodbedit.direct_backend()
+	print('ODB gateway on '+args.socket+' using the '+backend.name+' backend, '
+		+(str(args.rate)+' calls/s max, ' if args.rate else '')+'writes merged over '+str(args.window)+' s')
+	gateway=Gateway(backend,args.rate,args.window)
+	signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0))
+	try:
+		serve(args.socket,gateway,args.report)
+	except (KeyboardInterrupt,SystemExit):
+		pass
+	except RuntimeError as e:
+		sys.exit('****'+str(e)+'****')
+	finally:
+		print(json.dumps(gateway.metrics()))
+		backend.close()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
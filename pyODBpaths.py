@@ -0,0 +1,108 @@
+#ODB paths for the tower settings the scripts use, in one place
+#
+#A DCRC ("board") can be given as
+#  3, '3'                      - DCRC3 on the default tower (DEFAULT_TOWER)
+#  'Tower02:3', ('Tower02',3)  - DCRC3 on Tower02
+#so the same scan, flash or ramp code can drive boards on several towers at
+#once. Paths come from the templates in LAYOUTS and are cached, so building
+#them in a ramp or flash loop costs a dictionary lookup.
+#
+#  pyODBpaths.path('Tower02:3','chargeBias',0)
+#    -> '/Equipment/Tower02/Settings/DCRC3/Charge/Bias (V)[0]'
+
+import os
+import re
+import functools
+import collections
+
+#Path templates for each ODB layout. {tower}, {dcrc} and {channel} are filled in.
+LAYOUTS={
+	'oldMidas':{
+		'chargeBias':'/Equipment/{tower}/Settings/DCRC{dcrc}/Charge/Bias (V)[{channel}]',
+		'enable15V':'/Equipment/{tower}/Settings/DCRC{dcrc}/LED/Enable15VPower',
+		'enableLED1':'/Equipment/{tower}/Settings/DCRC{dcrc}/LED/EnableLED1',
+		'enableLED2':'/Equipment/{tower}/Settings/DCRC{dcrc}/LED/EnableLED2',
+		'ledPulseWidth':'/Equipment/{tower}/Settings/DCRC{dcrc}/LED/LEDPulseWidth (us)',
+		'ledRepRate':'/Equipment/{tower}/Settings/DCRC{dcrc}/LED/LEDRepRate (us)',
+		'led1Current':'/Equipment/{tower}/Settings/DCRC{dcrc}/LED/LED1Current (mA)',
+		'led2Current':'/Equipment/{tower}/Settings/DCRC{dcrc}/LED/LED2Current (mA)',
+		#Monitored value of each charge bias channel, for closed-loop HV ramps
+		'chargeBiasReadback':'/Equipment/{tower}/Variables/DCRC{dcrc}/Charge/Bias (V)[{channel}]',
+	},
+}
+
+#Tower and layout used for boards given without a tower
+DEFAULT_TOWER=os.environ.get('PYODB_TOWER','Tower01')
+LAYOUT=os.environ.get('PYODB_LAYOUT','oldMidas')
+
+#Run and logger keys, which aren't per tower
+WRITE_DATA='/Logger/Write data'
+RUN_DURATION='/Logger/Run duration'
+SERIES_DURATION='/Seriesinfo/Duration (s)'
+RUN_STATE='/Runinfo/State'
+RUN_NUMBER='/Runinfo/Run number'
+
+#A DCRC on a tower
+Board=collections.namedtuple('Board',['tower','dcrc'])
+
+#Parse any of the board forms above into a Board
+def board(spec):
+	if isinstance(spec,Board):
+		return spec
+	if isinstance(spec,(tuple,list)):
+		tower,dcrc=spec
+		return Board(str(tower),int(dcrc))
+	spec=str(spec).strip()
+	if ':' in spec:
+		tower,dcrc=spec.split(':')
+		return Board(tower.strip(),int(dcrc))
+	return Board(DEFAULT_TOWER,int(spec))
+
+#'Tower02:3' style name for a board, for printing and journals
+def name(spec):
+	b=board(spec)
+	return b.tower+':'+str(b.dcrc)
+
+#Use tower for boards given without one (e.g. from a script's -tower option)
+def setDefaultTower(tower):
+	global DEFAULT_TOWER
+	DEFAULT_TOWER=tower
+	_path.cache_clear()
+
+@functools.lru_cache(maxsize=4096)
+def _path(layout,tower,dcrc,key,channel):
+	return LAYOUTS[layout][key].format(tower=tower,dcrc=dcrc,channel=channel)
+
+#ODB path of key (one of the LAYOUTS keys) for a board
+#channel is the array index for array keys such as chargeBias
+def path(spec,key,channel=None):
+	b=board(spec)
+	return _path(LAYOUT,b.tower,b.dcrc,key,channel)
+
+@functools.lru_cache(maxsize=None)
+def _patterns(layout):
+	patterns=[]
+	for key,template in LAYOUTS[layout].items():
+		pattern=re.escape(template)
+		for field,group in (('tower','(?P<tower>[^/]+)'),('dcrc',r'(?P<dcrc>\d+)'),('channel',r'(?P<channel>\d+)')):
+			pattern=pattern.replace(re.escape('{'+field+'}'),group)
+		patterns.append((key,re.compile('^'+pattern+'$')))
+	return patterns
+
+#The other way round: (Board, key, channel) for a path built by path(), or None
+def parse(odbPath):
+	for key,pattern in _patterns(LAYOUT):
+		m=pattern.match(odbPath)
+		if m:
+			channel=m.groupdict().get('channel')
+			return Board(m.group('tower'),int(m.group('dcrc'))),key,(int(channel) if channel is not None else None)
+	return None
+
+#The towers a list of boards are on, in order of first appearance
+def towers(specs):
+	out=[]
+	for spec in specs:
+		tower=board(spec).tower
+		if tower not in out:
+			out.append(tower)
+	return out
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#A simulated MIDAS ODB, for running and timing the control scripts without a DAQ
+#
+#SimBackend is a pyodbedit backend with configurable per-call latency, delayed
+#run transitions and injected failures, and it counts every call made to it:
+#
+#  sim=pyODBsim.SimBackend(pyODBsim.tower(12),latency=0.05,transitionDelay=2.0)
+#  pyodbedit.set_backend(sim)
+#  ...
+#  sim.counts -> Counter of calls, reads, writes, transitions
+#
+#compressedTime(factor) makes time.sleep, asyncio.sleep and the clocks run
+#factor times faster, so a long scan can be run through in seconds.
+#
+#Run as a program this file stands in for the odbedit binary (-c and the
+#interactive stdin mode), keeping the ODB in the JSON file named by
+#PYODBSIM_STATE. Link it onto the PATH as 'odbedit', or point
+#pyodbedit.OdbeditBackend(odbedit=...) at it.
+
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import random
+import shlex
+import asyncio
+import tempfile
+import threading
+import contextlib
+import collections
+
+import pyodbedit
+import pyODBpaths
+
+#A plausible starting ODB for a tower with DCRCs 1..nDCRC
+def tower(nDCRC=4,tower='Tower01'):
+	values={'/Runinfo/State':pyodbedit.STATE_STOPPED,'/Runinfo/Run number':0,
+		'/Logger/Write data':False,'/Logger/Run duration':0,'/Seriesinfo/Duration (s)':0,
+		'/Playground/time':0}
+	for board in range(1,nDCRC+1):
+		base='/Equipment/'+tower+'/Settings/DCRC'+str(board)
+		values[base+'/Charge/Bias (V)']=[0.0,0.0]
+		values['/Equipment/'+tower+'/Variables/DCRC'+str(board)+'/Charge/Bias (V)']=[0.0,0.0]
+		values[base+'/LED/Enable15VPower']=False
+		values[base+'/LED/EnableLED1']=False
+		values[base+'/LED/EnableLED2']=False
+		values[base+'/LED/LEDPulseWidth (us)']=0
+		values[base+'/LED/LEDRepRate (us)']=0
+		values[base+'/LED/LED1Current (mA)']=0
+		values[base+'/LED/LED2Current (mA)']=0
+	return values
+
+#MemoryBackend with the behaviour of a real ODB made configurable
+#  latency, jitter       - every call takes latency + up to jitter s
+#  transitionDelay       - s before /Runinfo/State follows a start or stop
+#  failRate              - chance each written key fails
+#  failPaths             - keys matching this regex always fail to write
+#  transitionFailRate    - chance a start or stop never happens
+#  readbackRate          - how fast (V/s) the charge bias readbacks follow their
+#                          settings, like a slow supply; None for straight away
+class SimBackend(pyodbedit.MemoryBackend):
+	name='sim'
+
+	def __init__(self,values=None,latency=0.0,jitter=0.0,transitionDelay=0.0,failRate=0.0,
+			failPaths=None,transitionFailRate=0.0,seed=None,readbackRate=None):
+		pyodbedit.MemoryBackend.__init__(self,values if values is not None else tower(),latency)
+		self.jitter=jitter
+		self.transitionDelay=transitionDelay
+		self.failRate=failRate
+		self.failPaths=re.compile(failPaths) if failPaths else None
+		self.transitionFailRate=transitionFailRate
+		self.random=random.Random(seed)
+		self.counts=collections.Counter()
+		#(time.monotonic() when it happens, new state, new run number)
+		self.pending=None
+		self.readbackRate=readbackRate
+		#Readbacks on their way to a new setting: {path: (from, to, time.monotonic() set)}
+		self.slewing={}
+
+	def _count(self,**counts):
+		with self.lock:
+			self.counts['calls']+=1
+			self.counts.update(counts)
+
+	def _wait(self):
+		delay=self.latency+self.jitter*self.random.random()
+		if delay>0:
+			time.sleep(delay)
+
+	#Apply a run transition once its delay is up, and move the readbacks on
+	def _get(self,path):
+		if self.pending is not None and time.monotonic()>=self.pending[0]:
+			self.values['/Runinfo/State']=self.pending[1]
+			self.values['/Runinfo/Run number']=self.pending[2]
+			self.pending=None
+		self._slew()
+		return pyodbedit.MemoryBackend._get(self,path)
+
+	def _slew(self):
+		now=time.monotonic()
+		for path,(start,end,t0) in list(self.slewing.items()):
+			moved=self.readbackRate*(now-t0)
+			if moved>=abs(end-start):
+				del self.slewing[path]
+				self._set(path,end)
+			else:
+				self._set(path,start+(moved if end>start else -moved))
+
+	#Send a charge bias setting on to its readback
+	def _readback(self,path,val):
+		parsed=pyODBpaths.parse(path)
+		if parsed is None or parsed[1]!='chargeBias':
+			return
+		readback=pyODBpaths.path(parsed[0],'chargeBiasReadback',parsed[2])
+		try:
+			start=float(self._get(readback))
+		except KeyError:
+			return
+		if self.readbackRate is None:
+			self._set(readback,val)
+		else:
+			self.slewing[readback]=(start,float(val),time.monotonic())
+
+	def read(self,path):
+		self._count(reads=1)
+		return pyodbedit.MemoryBackend.read(self,path)
+
+	def read_values(self,paths):
+		self._count(reads=len(paths))
+		return pyodbedit.MemoryBackend.read_values(self,paths)
+
+	def read_tree(self,path):
+		self._count(reads=1)
+		return pyodbedit.MemoryBackend.read_tree(self,path)
+
+	def write_many(self,items):
+		self._count(writes=len(items))
+		self._wait()
+		failed={}
+		with self.lock:
+			for path,val in items:
+				if (self.failPaths is not None and self.failPaths.search(path)) or self.random.random()<self.failRate:
+					failed[path]='simulated write failure'
+					continue
+				error=self._set(path,pyodbedit._from_text(val))
+				if error:
+					failed[path]=error
+				else:
+					self._readback(path,pyodbedit._from_text(val))
+		if failed:
+			self._count(failures=len(failed))
+		return failed
+
+	def _transition(self,state):
+		self._count(transitions=1)
+		self._wait()
+		if self.random.random()<self.transitionFailRate:
+			self._count(failures=1)
+			return 'simulated transition failure'
+		with self.lock:
+			run=self.values['/Runinfo/Run number']
+			if state==pyodbedit.STATE_RUNNING:
+				run+=1
+			self.pending=(time.monotonic()+self.transitionDelay,state,run)
+		return ''
+
+	def runstart(self):
+		return self._transition(pyodbedit.STATE_RUNNING)
+
+	def runstop(self):
+		return self._transition(pyodbedit.STATE_STOPPED)
+
+#Make time.sleep, threading.Event.wait, asyncio.sleep, time.monotonic and time.time run factor times
+#faster for the duration of the block. Everything in this package reads the
+#time through those, so deadlines and waits stay consistent with each other.
+#Real processing time is stretched by the same factor, so keep factor modest
+#when measuring small overheads.
+@contextlib.contextmanager
+def compressedTime(factor):
+	realSleep,realMonotonic,realTime,realAsyncSleep=time.sleep,time.monotonic,time.time,asyncio.sleep
+	realLoopTime=asyncio.BaseEventLoop.time
+	realEventWait=threading.Event.wait
+	m0=realMonotonic()
+	t0=realTime()
+	time.monotonic=lambda: m0+(realMonotonic()-m0)*factor
+	time.time=lambda: t0+(realMonotonic()-m0)*factor
+	time.sleep=lambda seconds: realSleep(max(0.0,seconds)/factor)
+	asyncio.sleep=lambda seconds,*args,**kwargs: realAsyncSleep(max(0.0,seconds)/factor,*args,**kwargs)
+	threading.Event.wait=lambda event,timeout=None: realEventWait(event,None if timeout is None else max(0.0,timeout)/factor)
+	#The event loop schedules on real time, as it sleeps in real time
+	asyncio.BaseEventLoop.time=lambda loop: realMonotonic()
+	try:
+		yield
+	finally:
+		time.sleep,time.monotonic,time.time,asyncio.sleep=realSleep,realMonotonic,realTime,realAsyncSleep
+		asyncio.BaseEventLoop.time=realLoopTime
+		threading.Event.wait=realEventWait
+
+#The ODB file used when standing in for odbedit
+def _stateFile():
+	return os.environ.get('PYODBSIM_STATE','pyodbsim.json')
+
+def _loadState():
+	path=_stateFile()
+	if os.path.exists(path):
+		with open(path,'r') as f:
+			return json.load(f)
+	return tower()
+
+#Written to a temporary file first, so readers never see half a file
+def _saveState(values):
+	path=_stateFile()
+	fd,tmp=tempfile.mkstemp(prefix=os.path.basename(path)+'.',suffix='.tmp',dir=os.path.dirname(os.path.abspath(path)))
+	try:
+		with os.fdopen(fd,'w') as f:
+			json.dump(values,f)
+		os.replace(tmp,path)
+	except BaseException:
+		os.remove(tmp)
+		raise
+
+#Hold the state file's lock, so the odbedit stand-ins (one per session in the
+#pyodbedit pool) read, change and save it one at a time
+@contextlib.contextmanager
+def _stateLock():
+	with open(_stateFile()+'.lock','a') as f:
+		fcntl.flock(f,fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(f,fcntl.LOCK_UN)
+
+#Run one odbedit command against the state file, returning what odbedit would print
+def odbeditCommand(line):
+	words=shlex.split(line)
+	if not words:
+		return ''
+	with _stateLock():
+		return _command(words,line)
+
+def _command(words,line):
+	sim=SimBackend(_loadState(),latency=float(os.environ.get('PYODBSIM_LATENCY','0')))
+	cmd=words[0]
+	if cmd=='ls' and len(words)>1:
+		return sim.read(words[-1])
+	if cmd=='json' and len(words)>1:
+		try:
+			return json.dumps(sim.read_tree(words[-1]))
+		except KeyError:
+			return 'key '+words[-1]+' not found'
+	if cmd=='set' and len(words)>2:
+		failed=sim.write_many([(words[1],' '.join(words[2:]))])
+		_saveState(sim.values)
+		return failed.get(words[1],'')
+	if cmd in ('start','stop'):
+		out=sim.runstart() if cmd=='start' else sim.runstop()
+		sim._get('/Runinfo/State')
+		_saveState(sim.values)
+		return out
+	return 'Unknown command: '+line
+
+#odbedit stand-in: 'odbedit -c <command>' or commands on stdin
+def odbeditMain(args):
+	if len(args)>=2 and args[0]=='-c':
+		out=odbeditCommand(args[1])
+		if out:
+			print(out)
+		return
+	for line in sys.stdin:
+		if line.strip()=='exit':
+			break
+		out=odbeditCommand(line)
+		if out:
+			sys.stdout.write(out+'\n')
+		sys.stdout.flush()
+
+if __name__ == "__main__":
+	odbeditMain(sys.argv[1:])
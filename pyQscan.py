@@ -3,14 +3,89 @@
 #Nick Mast 10/2019
 #
 import sys
-import time
 import re
 import numpy as np
 import argparse
 from argparse import ArgumentParser, ArgumentTypeError
 
 import pyodbedit as poe
-import pyFlash
+import pyODBpaths as paths
+import pyScan
+
+#ODB settings putting Side1 bias V1 on both channels of DCRC_S1 and V2 on both of DCRC_S2
+def qBiasSettings(DCRC_S1,DCRC_S2,V1,V2):
+	return {
+		paths.path(DCRC_S1,'chargeBias',0):str(V1),
+		paths.path(DCRC_S1,'chargeBias',1):str(V1),
+		paths.path(DCRC_S2,'chargeBias',0):str(V2),
+		paths.path(DCRC_S2,'chargeBias',1):str(V2)}
+
+#The bias side of a Qbias scan on one Side1/Side2 pair: the settings for each
+#(Side1 V, Side2 V) point in Vlist and for setting them back to 0
+#pyMultiScan interleaves these for several detectors.
+class QBias(object):
+	def __init__(self,DCRC_S1,DCRC_S2,Vlist):
+		self.DCRC_S1=DCRC_S1
+		self.DCRC_S2=DCRC_S2
+		self.Vlist=[list(V) for V in Vlist]
+		self.points=len(self.Vlist)
+
+	def describe(self):
+		return 'Qbias on DCRC '+paths.name(self.DCRC_S1)+'/'+paths.name(self.DCRC_S2)
+
+	#DCRCs the scan sets
+	def boards(self):
+		return [self.DCRC_S1,self.DCRC_S2]
+
+	def setSteps(self,i,label):
+		V1,V2=self.Vlist[i]
+		return [pyScan.Settings(qBiasSettings(self.DCRC_S1,self.DCRC_S2,V1,V2),label)]
+
+	#Qbias doesn't drift
+	def driftStep(self,tSeries_sec,label):
+		return None
+
+	def unsetSteps(self):
+		return [pyScan.Settings(qBiasSettings(self.DCRC_S1,self.DCRC_S2,0,0),'Qbias off')]
+
+#Build the list of pyScan steps for a Qbias scan
+#For each (Side1 V, Side2 V) pair in Vlist: set the biases, take nSubSeries runs
+#of tSeries_sec each, set the biases back to 0, then flash and cool down.
+#debug leaves /Logger/Write data alone.
+def qScanSteps(DCRC_S1,DCRC_S2,Vlist,tSeries_sec,DCRCs2Flash,nSubSeries=1,
+		FlashDuration=30.0,CoolDuration_sec=1800,debug=False):
+	logger={paths.RUN_DURATION:'0'}
+	if not debug:
+		logger[paths.WRITE_DATA]='y'
+	bias=QBias(DCRC_S1,DCRC_S2,Vlist)
+	steps=[pyScan.Settings(logger,'logger on')]
+	for iV in range(bias.points):
+		label='set '+str(iV+1)+'/'+str(bias.points)
+		#Set Qbias
+		steps+=bias.setSteps(iV,label)
+
+		###########
+		#Take data
+		###########
+		steps.append(pyScan.Settings({paths.SERIES_DURATION:str(tSeries_sec)},label))
+		for iSubSeries in range(nSubSeries):
+			subLabel=label+(' subseries '+str(iSubSeries+1)+'/'+str(nSubSeries) if nSubSeries>1 else '')
+			steps.append(pyScan.StartRun(subLabel,iV,iSubSeries))
+			steps.append(pyScan.TakeData(tSeries_sec,subLabel))
+			steps.append(pyScan.StopRun(subLabel))
+
+		#Set Qbias = 0
+		steps+=bias.unsetSteps()
+
+		###########
+		#Flash & cooldown
+		###########
+		steps.append(pyScan.Flash(DCRCs2Flash,FlashDuration,label))
+		steps.append(pyScan.Cool(CoolDuration_sec,label))
+
+	#Return to normal settings
+	steps.append(pyScan.Settings({paths.WRITE_DATA:'n'},'logger off'))
+	return steps
 
 #the stuff below is so this functionality can be used as a script
 ########################################################################
@@ -22,23 +97,31 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Get run info')
 
 	#DCRC number	
-	parser.add_argument('-DCRC_S1S2',type=str,help='MIDAS DCRC number of boards controlling Side1 and Side2 Q biases. Format at Side1DCRC/Side2DCRC. e.g. 3/1 for DCRC3 on side1 and DCRC1 on side2.')
+	parser.add_argument('-DCRC_S1S2',type=str,help='MIDAS DCRC number of boards controlling Side1 and Side2 Q biases. Format at Side1DCRC/Side2DCRC. e.g. 3/1 for DCRC3 on side1 and DCRC1 on side2. Boards on another tower can be given as Tower:DCRC, e.g. Tower02:3/Tower02:1.')
 	#Voltage Biases
 	parser.add_argument('-Vs',type=str,help='Bias voltages in desired run order. Format as Side1 V1/Side2 V1,Side1 V2/Side2 V2 etc. e.g. 0/0,5/-5,10/-10. Note, this may have to be input as a string: -Vs=\'-1/1,-3/3\' so that the leading negative bias is not interpreted as an argument flag.')
 	#Series time	
 	parser.add_argument('-tSeries',type=float,help='Run time for each data series in minutes')
 	parser.add_argument('-NsubSeries',type=int,help='Number of subseries (individual MIDAS runs) to break each series into. This feature is for mitigating various DCRC issues which are reset by stopping/starting a new run. Default is None.')
 	#Flashing
-	parser.add_argument('-DCRCs2Flash',type=str,help='Comma-separated list of DCRC MIDAS numbers to use for flashing')
+	parser.add_argument('-DCRCs2Flash',type=str,help='Comma-separated list of DCRC MIDAS numbers to use for flashing. Boards on other towers can be given as Tower:DCRC, e.g. 1,2,Tower02:1.')
 	parser.add_argument('-FlashDuration',type=float,default=30,help='Flash time in seconds. Default is 30 s.')
 	parser.add_argument('-CoolDuration',type=float,default=30,help='Post flash cooldown time in minutes. Default is 30 min.')
 
 	#Debug
 	parser.add_argument('-debug',action='store_true',default=False,help='Do not log data. Display debug messages.')
 
-	#So far this only has the oldMidas paths hardcoded
+	#Timing
+	parser.add_argument('-trace',type=str,help='Record every ODB call to this file (.jsonl, or .json for a Chrome trace) and print where the time went at the end.')
+	parser.add_argument('-journal',type=str,help='Journal file recording the scan\'s progress, so an interrupted scan can be carried on with -resume. Default is no journal.')
+	parser.add_argument('-resume',action='store_true',default=False,help='Carry on an interrupted scan from its -journal, after putting the hardware back where the scan expects it.')
+	parser.add_argument('-runLog',type=str,help='Record every run with the biases it was taken at in this file (.db for SQLite, or .csv). See pyRunLog.')
+
+	#ODB paths come from pyODBpaths (the oldMidas layout unless PYODB_LAYOUT says otherwise)
 	
 	args = parser.parse_args()
+	if args.resume and args.journal is None:
+		parser.error('-resume needs the -journal of the scan to carry on')
 
 	###########################
 	#Parse command line inputs
@@ -54,7 +137,7 @@ if __name__ == "__main__":
 	#Parse Vs list of the format: (V11/V21),(V12/V22),(V13/V23)
 	args.Vs.replace(" ","")
 	Vlist=re.findall("([+-]?\d*\.?\d+)/([+-]?\d*\.?\d+)",args.Vs)
-	Vlist=np.array(Vlist).astype(np.float)
+	Vlist=np.array(Vlist).astype(float)
 	if(args.debug):
 		print('Vlist:',Vlist)
 
@@ -76,69 +159,25 @@ if __name__ == "__main__":
 	print('COMMENT "Command to produce this script was: python '+" ".join(sys.argv[:])+'"')
 	if(args.debug):
 		print("Not Running: poe.write('/Logger/Write data','y')")
-	else:
-		poe.write('/Logger/Write data','y')
-	poe.write('/Logger/Run duration','0')
-
-	print('run/flash/cooldown loop')
-	for iV, V in enumerate(Vlist):
-		#Set Qbias
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(DCRC_S1)+'/Charge/Bias (V)[0]',str(V[0]))
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(DCRC_S1)+'/Charge/Bias (V)[1]',str(V[0]))
-		
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(DCRC_S2)+'/Charge/Bias (V)[0]',str(V[1]))
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(DCRC_S2)+'/Charge/Bias (V)[1]',str(V[1]))
-
-		###########
-		#Take data
-		###########
-		print('')
-		print('Take Data. Set '+str(iV+1)+'/'+str(len(Vlist)))
-		poe.write('/Seriesinfo/Duration (s)',str(tSeries_sec))
-
-		for iSubSeries in range(nSubSeries):
-			if nSubSeries>1:
-				print('SubSeries '+str(iSubSeries+1)+'/'+str(nSubSeries))
-
-			print('Start Run')
-			poe.runstart()
-
-			print('Waiting '+ str(tSeries_sec))
-			time.sleep(tSeries_sec)
+	poe.enable_cache()
+	if args.trace is not None:
+		poe.enable_trace(args.trace)
+
+	steps=qScanSteps(DCRC_S1,DCRC_S2,Vlist,tSeries_sec,DCRCs2FlashList,nSubSeries,
+		FlashDuration,CoolDuration_sec,args.debug)
+	scan=pyScan.Scan(steps,tasks=[pyScan.progress(300)],name='Qbias Scan',journal=args.journal,runLog=args.runLog)
+	print('run/flash/cooldown loop. Expected duration '+str(round(scan.expectedDuration()/3600.,2))+' h')
+	start=0
+	if args.resume:
+		start=scan.recover()
+	try:
+		scan.run(start)
+	except pyScan.ScanAborted as e:
+		sys.exit('****Scan aborted: '+str(e)+('. Run again with -resume to carry on.' if args.journal else '')+'****')
 
-			print('Stop Run')
-			poe.runstop()
-			
-		#Set Qbias = 0
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(DCRC_S1)+'/Charge/Bias (V)[0]',str(0))
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(DCRC_S1)+'/Charge/Bias (V)[1]',str(0))
-		
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(DCRC_S2)+'/Charge/Bias (V)[0]',str(0))
-		poe.write('/Equipment/Tower01/Settings/DCRC'+str(DCRC_S2)+'/Charge/Bias (V)[1]',str(0))
-
-		###########
-		#Flash & cooldown
-		###########
-		print('Flash and cooldown')
-		#Save 15V power settings and enable
-		DCRC_15VPowerList=pyFlash.get15VPowerEnable(DCRCs2FlashList)
-		pyFlash.turn15VPowerEnableOn(DCRCs2FlashList)
-
-		#Flash
-		pyFlash.enableLEDs(DCRCs2FlashList,1)
-		print('Waiting '+ str(FlashDuration)+ ' sec')
-		time.sleep(FlashDuration)
-		pyFlash.enableLEDs(DCRCs2FlashList,0)
-		
-		#Restore previous 15V power state
-		pyFlash.set15VPowerEnable(DCRCs2FlashList,DCRC_15VPowerList)
-		#Cooldown
-		print('Cooldown '+ str(CoolDuration_sec)+' sec')
-		time.sleep(CoolDuration)
-
-	
-	#Return to normal settings
 	print('')
 	print('Restore normal settings')
-	poe.write('/Logger/Write data','n')
+	print('ODB cache: '+str(poe.cache_stats()))
+	if args.trace is not None:
+		poe.print_trace_summary()
 	print('Done')
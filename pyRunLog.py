@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#A record of every MIDAS run a scan takes, for picking runs out afterwards
+#
+#Give a pyScan.Scan a run log and each run it stops is written out straight
+#away as one record: the run number, the scan and step label, the point and
+#subseries, when the run actually started and stopped, the biases on each DCRC
+#at the start and end of the run (HV in V and the Qbias channels, as set by the
+#scan), how fast each HV drifted, and the last flash before the run.
+#
+#  scan=pyScan.Scan(steps,runLog='runs.db')
+#
+#The file is only ever appended to, and is either
+#  .db/.sqlite  - an SQLite database, indexed by run and by bias, or
+#  .csv         - plain CSV with one row per run and bias (so a run with two
+#                 biased DCRCs has several rows), for a spreadsheet
+#Looking runs up:
+#  pyRunLog.RunLog('runs.db').find(board='Tower01:4',name='HV',value=20)
+#  python pyRunLog.py runs.db -board 4 -name HV -value 20
+#
+#Bias names are 'HV' for the HV on a DCRC and 'Q0', 'Q1'... for its charge bias channels.
+
+import os
+import sys
+import csv
+import json
+import sqlite3
+import argparse
+
+import pyODBpaths
+
+#The per run fields, in CSV column order
+FIELDS=['run','scan','label','point','subseries','start','stop','live','startLatency','stopLatency',
+	'flashes','lastFlashStart','lastFlashEnd','lastFlashBoards']
+#The per bias fields: value at the start of the run, at the end, and the drift in between (per s)
+BIAS_FIELDS=['board','name','value','end','drift']
+
+_SCHEMA='''
+CREATE TABLE IF NOT EXISTS runs (run INTEGER, scan TEXT, label TEXT, point INTEGER, subseries INTEGER,
+	start REAL, stop REAL, live REAL, startLatency REAL, stopLatency REAL,
+	flashes INTEGER, lastFlashStart REAL, lastFlashEnd REAL, lastFlashBoards TEXT);
+CREATE TABLE IF NOT EXISTS biases (runId INTEGER, run INTEGER, board TEXT, name TEXT, value REAL, "end" REAL, drift REAL);
+CREATE INDEX IF NOT EXISTS runs_run ON runs (run);
+CREATE INDEX IF NOT EXISTS biases_runId ON biases (runId);
+CREATE INDEX IF NOT EXISTS biases_value ON biases (board, name, value);
+'''
+
+#One row per bias of a run record: (board, name, value, end, drift)
+def _biasRows(record):
+	rows=[]
+	for board in sorted(record['bias']):
+		for name in sorted(record['bias'][board]):
+			value=record['bias'][board][name]
+			end=record['biasEnd'].get(board,{}).get(name,value)
+			drift=record['drift'].get(board,{}).get(name,0.0)
+			rows.append((board,name,value,end,drift))
+	return rows
+
+#A run record from its run fields and bias rows
+def _record(fields,biasRows):
+	record=dict(fields)
+	boards=record.get('lastFlashBoards')
+	record['lastFlashBoards']=boards.split() if boards else []
+	record['bias']={}
+	record['biasEnd']={}
+	record['drift']={}
+	for board,name,value,end,drift in biasRows:
+		record['bias'].setdefault(board,{})[name]=value
+		record['biasEnd'].setdefault(board,{})[name]=end
+		record['drift'].setdefault(board,{})[name]=drift
+	return record
+
+def _float(text):
+	return float(text) if text not in ('',None) else None
+
+def _int(text):
+	return int(text) if text not in ('',None) else None
+
+_TYPES={'run':_int,'point':_int,'subseries':_int,'flashes':_int,'scan':str,'label':str,'lastFlashBoards':str}
+
+#Append-only run log, SQLite or CSV depending on the file name
+class RunLog(object):
+	def __init__(self,path):
+		self.path=path
+		self.sqlite=os.path.splitext(path)[1].lower() in ('.db','.sqlite','.sqlite3')
+		if self.sqlite:
+			with self._connect() as db:
+				db.executescript(_SCHEMA)
+
+	def _connect(self):
+		return sqlite3.connect(self.path,timeout=30.0)
+
+	#Add a run. record is a dict of the FIELDS plus 'bias' and 'biasEnd'
+	#({board: {name: value}}) and 'drift' ({board: {name: V/s}}), as made by
+	#pyScan.Scan. It is on disk before this returns.
+	def write(self,record):
+		fields=[record.get(field) for field in FIELDS]
+		fields[FIELDS.index('lastFlashBoards')]=' '.join(record.get('lastFlashBoards') or [])
+		biases=_biasRows(record)
+		if self.sqlite:
+			db=self._connect()
+			try:
+				with db:
+					#biases.runId is the runs rowid, as run numbers can repeat (e.g. on a test DAQ)
+					runId=db.execute('INSERT INTO runs VALUES ('+','.join('?'*len(FIELDS))+')',fields).lastrowid
+					db.executemany('INSERT INTO biases VALUES (?,?,?,?,?,?,?)',[(runId,record['run'])+row for row in biases])
+			finally:
+				db.close()
+			return
+		new=not os.path.exists(self.path) or os.path.getsize(self.path)==0
+		with open(self.path,'a',newline='') as f:
+			out=csv.writer(f)
+			if new:
+				out.writerow(FIELDS+BIAS_FIELDS)
+			for row in biases or [('',)*len(BIAS_FIELDS)]:
+				out.writerow(fields+list(row))
+			f.flush()
+			os.fsync(f.fileno())
+
+	#Every run record, in the order they were written
+	def read(self):
+		if self.sqlite:
+			return self._select('',[])
+		records=[]
+		if not os.path.exists(self.path):
+			return records
+		with open(self.path,'r',newline='') as f:
+			for row in csv.DictReader(f):
+				fields=dict((field,_TYPES.get(field,_float)(row[field])) for field in FIELDS)
+				if not records or records[-1]['run']!=fields['run'] or records[-1]['start']!=fields['start']:
+					records.append(_record(fields,[]))
+				if row['board']:
+					for key,field in (('bias','value'),('biasEnd','end'),('drift','drift')):
+						records[-1][key].setdefault(row['board'],{})[row['name']]=float(row[field])
+		return records
+
+	def _select(self,where,args):
+		db=self._connect()
+		try:
+			rows=db.execute('SELECT rowid,* FROM runs'+where+' ORDER BY rowid',args).fetchall()
+			records=[]
+			for row in rows:
+				biases=db.execute('SELECT board,name,value,"end",drift FROM biases WHERE runId=?',(row[0],)).fetchall()
+				records.append(_record(zip(FIELDS,row[1:]),biases))
+			return records
+		finally:
+			db.close()
+
+	#The runs matching everything given: run number, and/or a bias, i.e. board
+	#and/or bias name set to value (within tolerance) at the start of the run
+	def find(self,run=None,board=None,name=None,value=None,tolerance=0.005):
+		if board is not None:
+			board=pyODBpaths.name(board)
+		if self.sqlite:
+			where=[]
+			args=[]
+			if run is not None:
+				where.append('run=?')
+				args.append(int(run))
+			bias=[]
+			for column,arg in (('board',board),('name',name)):
+				if arg is not None:
+					bias.append(column+'=?')
+					args.append(arg)
+			if value is not None:
+				bias.append('value BETWEEN ? AND ?')
+				args+=[value-tolerance,value+tolerance]
+			if bias:
+				where.append('rowid IN (SELECT runId FROM biases WHERE '+' AND '.join(bias)+')')
+			return self._select(' WHERE '+' AND '.join(where) if where else '',args)
+		def match(record):
+			if run is not None and record['run']!=int(run):
+				return False
+			if board is None and name is None and value is None:
+				return True
+			return any((board is None or b==board) and (name is None or n==name)
+				and (value is None or abs(v-value)<=tolerance) for b,n,v,e,d in _biasRows(record))
+		return [record for record in self.read() if match(record)]
+
+#One line per run
+def describe(record):
+	biases=', '.join(board+' '+name+'='+str(value)
+		+(' ('+('%+g'%drift)+'/s)' if drift else '')
+		for board,name,value,end,drift in _biasRows(record))
+	return ('Run '+str(record['run'])+' '+str(record['label'])+': '+str(round(record['live'] or 0.0,1))+' s live'
+		+('; '+biases if biases else '')
+		+('; flashed '+' '.join(record['lastFlashBoards'])+' '+str(int(record['start']-record['lastFlashEnd']))+' s before'
+			if record['lastFlashEnd'] is not None else ''))
+
+########################################################################
+def main(args):
+	parser = argparse.ArgumentParser(description='List the runs in a scan run log (.db or .csv)')
+	parser.add_argument('log',type=str,help='Run log file')
+	parser.add_argument('-run',type=int,help='Only this run number')
+	parser.add_argument('-board',type=str,help='Only runs biasing this DCRC (e.g. 4 or Tower02:4)')
+	parser.add_argument('-name',type=str,help='Only runs with this bias (HV, Q0, Q1...)')
+	parser.add_argument('-value',type=float,help='Only runs with the bias at this value')
+	parser.add_argument('-tolerance',type=float,default=0.005,help='How close to -value a bias has to be. Default is 0.005.')
+	parser.add_argument('-json',action='store_true',default=False,help='Print each run as a JSON object')
+	args = parser.parse_args(args)
+
+	for record in RunLog(args.log).find(args.run,args.board,args.name,args.value,args.tolerance):
+		print(json.dumps(record) if args.json else describe(record))
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,753 @@
+#An asyncio engine for running scans by issuing odbedit commands, without the MIDAS Sequencer
+#
+#A scan is a flat list of steps (set bias, ramp HV, start run, wait, stop run,
+#flash, cool...) which are run one after another. Background tasks such as ODB
+#polling, a heartbeat and progress reports run alongside the steps, so the scan
+#can keep an eye on things during the long waits.
+#
+#  steps=[pyScan.Settings({'/Logger/Write data':'y'}),pyScan.StartRun(),
+#         pyScan.Wait(600),pyScan.StopRun()]
+#  scan=pyScan.Scan(steps,tasks=[pyScan.progress(60),pyScan.heartbeat()])
+#  scan.run()
+#
+#pyHVscan.hvScanSteps and pyQscan.qScanSteps build the steps for the HV and
+#Qbias scans.
+#
+#Give the Scan a journal file and every step is recorded there once it has
+#finished (a flash also when it starts, with the 15V power states to put back).
+#If the scan dies, Scan.recover() puts the hardware back into a known state and
+#returns the step to carry on from, losing at most the current run.
+#
+#With pyodbedit.enable_trace() on, each ODB call is labelled with the phase of
+#the step that made it (ramp, run, flash, cool... see PHASES), so
+#pyodbedit.print_trace_summary() shows where the scan spent its time waiting on the ODB.
+#
+#The watch and limits tasks keep an eye on ODB keys during the scan (a tripped
+#supply, a railing channel...) and can abort or pause it.
+#
+#Give the Scan a run log file and every run it takes is recorded there with the
+#biases it was taken at (see pyRunLog).
+
+import os
+import json
+import time
+import asyncio
+import threading
+import functools
+import contextvars
+
+import pyodbedit as poe
+import pyFlash
+import pyODBpaths
+import pyChangeHV
+import pyHeartbeat
+import pyRunLog
+
+#One thing a scan does
+#duration is the expected time (s) the step takes
+class Step(object):
+	kind='step'
+
+	def __init__(self,label=''):
+		self.label=label
+		self.duration=0.0
+
+	def describe(self):
+		if self.label:
+			return self.kind+' '+self.label
+		return self.kind
+
+	#Expected number of (reads, writes) the step makes to the ODB
+	def odbCalls(self):
+		return (0,0)
+
+	async def run(self,scan):
+		raise NotImplementedError
+
+#Write a batch of ODB settings
+class Settings(Step):
+	kind='settings'
+
+	def __init__(self,values,label=''):
+		Step.__init__(self,label)
+		self.values=dict(values)
+
+	def odbCalls(self):
+		return (0,len(self.values))
+
+	async def run(self,scan):
+		failed=await scan.odb(pyFlash.writeSettings,self.values)
+		scan.noteSettings(self.values,failed)
+
+#Sit and wait while the background tasks carry on
+class Wait(Step):
+	kind='wait'
+
+	def __init__(self,seconds,label=''):
+		Step.__init__(self,label)
+		self.duration=float(seconds)
+
+	async def run(self,scan):
+		print('Waiting '+str(self.duration)+' sec')
+		await asyncio.sleep(self.duration)
+
+#Post flash cooldown
+class Cool(Wait):
+	kind='cool'
+
+	async def run(self,scan):
+		print('Cooldown '+str(self.duration)+' sec')
+		await asyncio.sleep(self.duration)
+
+#Take data for a while (the run must already be started)
+#The time is counted from when the run was confirmed to have started, and
+#stops while the scan is paused: the run carries on through a pause, and this
+#step waits until it has had its full duration of unpaused data.
+class TakeData(Wait):
+	kind='data'
+
+	async def run(self,scan):
+		print('Take Data '+self.label+'. Waiting '+str(self.duration)+' sec')
+		start=scan.runStart if scan.runStart is not None else time.monotonic()
+		while True:
+			if scan.paused is not None and scan.unpaused is not None:
+				await scan.unpaused.wait()
+			remaining=start+self.duration+scan.pausedTime(start)-time.monotonic()
+			if remaining<=0 and scan.paused is None:
+				break
+			await asyncio.sleep(max(0.0,remaining))
+
+#Turn the HV power supply on or off (see pyChangeHV.setHVpowerOnOff)
+class HVPower(Step):
+	kind='hvpower'
+
+	def __init__(self,iDCRC,state,label=''):
+		Step.__init__(self,label)
+		self.iDCRC=iDCRC
+		self.state=state
+		self.duration=5.0
+
+	def odbCalls(self):
+		return (0,1)
+
+	async def run(self,scan):
+		await scan.odb(pyChangeHV.setHVpowerOnOff,self.iDCRC,self.state)
+
+#Ramp the HV from HVstart to HVend (see pyChangeHV.changeHVFromTo)
+#With HVmaxRate the ramp is closed loop (see pyChangeHV.runAdaptiveRamp). Its
+#duration and ODB calls are then worked out at HVrampRate, so are upper bounds
+#unless the readback lags.
+class Ramp(Step):
+	kind='ramp'
+
+	def __init__(self,iDCRC,HVstart,HVend,HVrampRate,HVrampUpdatePeriod,HVcalFile,label='',
+			HVmaxRate=None,HVrampTolerance=pyChangeHV.RAMP_TOLERANCE,HVreadback=None):
+		Step.__init__(self,label)
+		self.iDCRC=iDCRC
+		self.HVstart=float(HVstart)
+		self.HVend=float(HVend)
+		self.HVrampRate=HVrampRate
+		self.HVrampUpdatePeriod=HVrampUpdatePeriod
+		self.HVcalFile=HVcalFile
+		self.HVmaxRate=HVmaxRate
+		self.HVrampTolerance=HVrampTolerance
+		self.HVreadback=HVreadback
+		if HVmaxRate is not None and HVmaxRate<HVrampRate:
+			raise ValueError('HVmaxRate ('+str(HVmaxRate)+' V/s) is below HVrampRate ('+str(HVrampRate)+' V/s)')
+		self.schedule=pyChangeHV.rampSchedule(self.HVstart,self.HVend,HVrampRate,HVrampUpdatePeriod)
+		self.duration=len(self.schedule)*float(HVrampUpdatePeriod)
+
+	def odbCalls(self):
+		if self.HVmaxRate is not None:
+			return (len(self.schedule)+1,len(self.schedule))
+		return (0,len(self.schedule))
+
+	async def run(self,scan):
+		print('Set HV = '+str(self.HVend))
+		cals=pyChangeHV.loadCalTable(self.HVcalFile)
+		if self.HVmaxRate is not None:
+			rampLog=await scan.odb(pyChangeHV.runAdaptiveRamp,self.iDCRC,self.HVstart,self.HVend,cals,self.HVrampRate,
+				self.HVmaxRate,self.HVrampUpdatePeriod,self.HVrampTolerance,self.HVreadback,False,scan.stopping)
+		else:
+			rampLog=await scan.odb(pyChangeHV.runRampSchedule,self.iDCRC,self.schedule,cals,False,scan.stopping)
+		scan.setBias(self.iDCRC,'HV',rampLog[-1][1] if rampLog else self.HVstart)
+
+#Run transitions are counted as writes, plus the run state reads before and after
+#(waiting for the transition to finish will usually poll a few more times)
+#point and subseries (counted from 0) say which bias point and subseries of it
+#the run is, for the run log
+class StartRun(Step):
+	kind='runstart'
+
+	def __init__(self,label='',point=None,subseries=None):
+		Step.__init__(self,label)
+		self.point=point
+		self.subseries=subseries
+
+	def odbCalls(self):
+		return (2,1)
+
+	async def run(self,scan):
+		print('Start Run')
+		scan.transition=await scan.odb(poe.runstart)
+		scan.runStart=scan.transition.confirmed
+		scan.openRun(self)
+		print('Run '+str(scan.transition.run)+' started in '+str(round(scan.transition.latency,2))+' s')
+
+class StopRun(Step):
+	kind='runstop'
+
+	def odbCalls(self):
+		return (2,1)
+
+	async def run(self,scan):
+		print('Stop Run')
+		scan.transition=await scan.odb(poe.runstop)
+		if scan.runStart is not None:
+			#Time the run spent while the scan was paused isn't counted as live
+			scan.liveTime+=max(0.0,scan.transition.confirmed-scan.runStart-scan.pausedTime(scan.runStart))
+		scan.closeRun()
+		scan.runStart=None
+		print('Run '+str(scan.transition.run)+' stopped in '+str(round(scan.transition.latency,2))+' s')
+
+#Flash the LEDs on a list of DCRCs, turning on their 15V power for the flash
+#and putting it back how it was afterwards
+class Flash(Step):
+	kind='flash'
+
+	def __init__(self,boards,seconds,label=''):
+		Step.__init__(self,label)
+		self.boards=list(boards)
+		self.duration=float(seconds)
+
+	#Read the 15V power states, turn them on, LEDs on, LEDs off, restore 15V
+	def odbCalls(self):
+		return (len(self.boards),6*len(self.boards))
+
+	async def run(self,scan):
+		print('Flash')
+		#Save 15V power settings and enable
+		power=await scan.odb(pyFlash.get15VPowerEnable,self.boards)
+		scan.record({'event':'flash','step':scan.index,'boards':self.boards,'power':power})
+		await scan.odb(pyFlash.turn15VPowerEnableOn,self.boards)
+		#Flash
+		await scan.odb(pyFlash.enableLEDs,self.boards,1)
+		start=time.time()
+		print('Wait '+str(self.duration)+' sec')
+		await asyncio.sleep(self.duration)
+		await scan.odb(pyFlash.enableLEDs,self.boards,0)
+		scan.noteFlash(self.boards,start,time.time())
+		#Restore previous 15V power state
+		await scan.odb(pyFlash.set15VPowerEnable,self.boards,power)
+
+#The scan phase each kind of step's ODB calls are counted under in a trace
+#(see pyodbedit.enable_trace); other kinds are their own phase
+PHASES={'hvpower':'ramp','ramp':'ramp','runstart':'run','runstop':'run','data':'run',
+	'flash':'flash','cool':'cool'}
+
+def phaseOf(step):
+	return PHASES.get(step.kind,step.kind)
+
+#Kinds of step that never overlap anything, whatever the policy says:
+#nothing else should happen while the run is starting, stopping or taking data
+NEVER_OVERLAP=('runstart','runstop','data')
+
+#A step (the host) with a chain of later steps run during it
+#The chain runs in order and is timed to finish when the host does, so for
+#example the next HV ramp happens during the tail of a cooldown. If the chain
+#is longer than the host they start together.
+class Overlap(Step):
+	kind='overlap'
+
+	def __init__(self,host,chain):
+		Step.__init__(self,host.label)
+		self.host=host
+		self.chain=list(chain)
+		chainDuration=sum(step.duration for step in self.chain)
+		self.offset=max(0.0,host.duration-chainDuration)
+		self.duration=max(host.duration,chainDuration)
+
+	def describe(self):
+		return self.host.describe()+' + '+', '.join(step.describe() for step in self.chain)
+
+	def odbCalls(self):
+		calls=[step.odbCalls() for step in [self.host]+self.chain]
+		return (sum(r for r,w in calls),sum(w for r,w in calls))
+
+	async def run(self,scan):
+		async def chain():
+			await asyncio.sleep(self.offset)
+			for step in self.chain:
+				poe.set_phase(phaseOf(step))
+				await step.run(scan)
+		poe.set_phase(phaseOf(self.host))
+		await asyncio.gather(self.host.run(scan),chain())
+
+#Several chains of steps run at the same time, each chain in order
+#e.g. the bias changes for several detectors. Its kind is the kind of the steps
+#in it if they are all the same, so overlap policies can refer to it that way.
+class Parallel(Step):
+	def __init__(self,chains,label=''):
+		Step.__init__(self,label)
+		self.chains=[list(chain) for chain in chains if chain]
+		kinds=set(step.kind for chain in self.chains for step in chain)
+		self.kind=kinds.pop() if len(kinds)==1 else 'parallel'
+		self.duration=max([sum(step.duration for step in chain) for chain in self.chains]+[0.0])
+
+	def describe(self):
+		return ' | '.join(', '.join(step.describe() for step in chain) for chain in self.chains)
+
+	def odbCalls(self):
+		calls=[step.odbCalls() for chain in self.chains for step in chain]
+		return (sum(r for r,w in calls),sum(w for r,w in calls))
+
+	async def run(self,scan):
+		async def chain(steps):
+			for step in steps:
+				poe.set_phase(phaseOf(step))
+				await step.run(scan)
+		await asyncio.gather(*[chain(steps) for steps in self.chains])
+
+#True if both steps (or any of the steps they are made of) drive the HV on the same DCRC
+def _sameHV(a,b):
+	boards=set(pyODBpaths.board(step.iDCRC) for step in substeps(a) if getattr(step,'iDCRC',None) is not None)
+	return any(pyODBpaths.board(step.iDCRC) in boards for step in substeps(b) if getattr(step,'iDCRC',None) is not None)
+
+#Fold steps that may safely run at the same time into Overlap steps
+#policy is a list of allowed [host kind, step kind] pairs, e.g.
+#  [['cool','hvpower'],['cool','ramp'],['cool','wait']]
+#lets the HV power on, ramp and prebias wait that follow a cooldown run during it.
+#Each host collects the unbroken run of allowed steps straight after it. Steps
+#in NEVER_OVERLAP and steps driving the same HV as the host are never folded in.
+def overlapSteps(steps,policy):
+	allowed=set((host,kind) for host,kind in policy)
+	out=[]
+	i=0
+	while i<len(steps):
+		host=steps[i]
+		chain=[]
+		i+=1
+		if host.kind not in NEVER_OVERLAP:
+			while i<len(steps) and (host.kind,steps[i].kind) in allowed \
+					and steps[i].kind not in NEVER_OVERLAP and not _sameHV(host,steps[i]):
+				chain.append(steps[i])
+				i+=1
+		out.append(Overlap(host,chain) if chain else host)
+	return out
+
+#The step itself, or for an Overlap or Parallel the steps it is made of
+def substeps(step):
+	if isinstance(step,Overlap):
+		return [sub for step in [step.host]+step.chain for sub in substeps(step)]
+	if isinstance(step,Parallel):
+		return [sub for chain in step.chains for step in chain for sub in substeps(step)]
+	return [step]
+
+#Append-only record of a scan's progress, one JSON object per line
+#Each line is flushed to disk before the scan moves on
+class Journal(object):
+	def __init__(self,path):
+		self.path=path
+
+	def write(self,record):
+		with open(self.path,'a') as f:
+			f.write(json.dumps(record)+'\n')
+			f.flush()
+			os.fsync(f.fileno())
+
+	#Records since the scan was last started from scratch
+	#A half-written last line (from a crash mid-write) is ignored
+	def read(self):
+		records=[]
+		if not os.path.exists(self.path):
+			return records
+		with open(self.path,'r') as f:
+			for line in f:
+				try:
+					record=json.loads(line)
+				except ValueError:
+					continue
+				if record.get('event')=='scan' and not record.get('resume'):
+					records=[]
+				records.append(record)
+		return records
+
+#Index of the first step to run when resuming: the first step that didn't
+#finish, or the StartRun of the run it was part of so the whole subseries is redone
+def resumeIndex(steps,records):
+	done=set(record['step'] for record in records if record.get('event')=='done')
+	k=0
+	while k<len(steps) and k in done:
+		k+=1
+	for j in range(k-1,-1,-1):
+		if isinstance(steps[j],StopRun):
+			break
+		if isinstance(steps[j],StartRun):
+			return j
+	return k
+
+#Raised by Scan.run when the scan is stopped with Scan.abort
+class ScanAborted(Exception):
+	pass
+
+#Runs a list of steps, with background tasks alongside
+#tasks are functions taking the Scan and returning a coroutine (see poll,
+#heartbeat and progress below)
+class Scan(object):
+	def __init__(self,steps,tasks=(),name='Scan',journal=None,runLog=None):
+		self.steps=list(steps)
+		self.tasks=list(tasks)
+		self.name=name
+		self.journal=Journal(journal) if journal else None
+		self.runLog=pyRunLog.RunLog(runLog) if runLog else None
+		self.index=None
+		self.started=None
+		#Measured once the scan has run: total time and time spent with a run going
+		self.elapsed=0.0
+		self.liveTime=0.0
+		#The last run transition, and when the current run was confirmed started
+		self.transition=None
+		self.runStart=None
+		#Set by abort() and pause()
+		self.aborted=None
+		self.paused=None
+		self.stepTask=None
+		self.unpaused=None
+		#(start, end or None) of each pause, in time.monotonic()
+		self.pauses=[]
+		#Set when the scan is aborted, to stop ramps running in worker threads
+		self.stopping=threading.Event()
+		#What the scan has set each DCRC's biases to, {board name: {'HV': V, 'Q0': V...}},
+		#the flashes it has done, and the run log record of the current run
+		self.bias={}
+		self.flashes=[]
+		self.runRecord=None
+
+	#Stop the scan now, cancelling the step in progress. Scan.run raises
+	#ScanAborted(reason). The step isn't journalled as done, so a resume redoes it.
+	#Hardware is left as it is (Scan.recover sorts it out).
+	#Call from the event loop, e.g. from a background task or watch callback.
+	def abort(self,reason):
+		if self.aborted is not None:
+			return
+		print('****Abort scan: '+reason+'****')
+		self.aborted=reason
+		self.stopping.set()
+		if self.stepTask is not None:
+			self.stepTask.cancel()
+
+	#Hold the scan before it starts its next step until resume() is called
+	#The step in progress carries on, except that TakeData stops counting:
+	#a run going stays going, but the paused time doesn't count towards its
+	#data taking (so the step lasts that much longer)
+	def pause(self,reason):
+		if self.paused is None:
+			print('****Pause scan: '+reason+'****')
+			self.paused=reason
+			self.pauses.append((time.monotonic(),None))
+			if self.unpaused is not None:
+				self.unpaused.clear()
+
+	def resume(self):
+		if self.paused is not None:
+			print('Resume scan (paused for '+self.paused+')')
+			self.paused=None
+			self.pauses[-1]=(self.pauses[-1][0],time.monotonic())
+			if self.unpaused is not None:
+				self.unpaused.set()
+
+	#Seconds the scan has spent paused since the time.monotonic() since
+	def pausedTime(self,since):
+		now=time.monotonic()
+		return sum(max(0.0,min(end if end is not None else now,now)-max(start,since)) for start,end in self.pauses)
+
+	#The step being run, or None
+	@property
+	def current(self):
+		if self.index is None:
+			return None
+		return self.steps[self.index]
+
+	#Expected time (s) for the whole scan
+	def expectedDuration(self):
+		return sum(step.duration for step in self.steps)
+
+	#Work out what the scan will cost without running it
+	#Returns a dict of the expected duration (s), ODB reads and writes, number
+	#of runs, live time (s spent between StartRun and StopRun) and live fraction
+	def estimate(self):
+		duration=reads=writes=live=0.0
+		runs=0
+		running=False
+		for step in self.steps:
+			if isinstance(step,StartRun):
+				running=True
+				runs+=1
+			elif isinstance(step,StopRun):
+				running=False
+			elif running:
+				live+=step.duration
+			duration+=step.duration
+			r,w=step.odbCalls()
+			reads+=r
+			writes+=w
+		return {'duration':duration,'reads':int(reads),'writes':int(writes),'runs':runs,
+			'live':live,'liveFraction':live/duration if duration>0 else 0.0}
+
+	#Add a record to the journal, if there is one
+	def record(self,record):
+		if self.journal is not None:
+			record.setdefault('time',time.time())
+			self.journal.write(record)
+
+	#Keep track of the biases for the run log: 'HV' on a DCRC in V, or its
+	#charge bias channels 'Q0', 'Q1'...
+	def setBias(self,board,name,value):
+		self.bias.setdefault(pyODBpaths.name(board),{})[name]=round(float(value),4)
+
+	#The charge biases among settings written by a Settings step
+	def noteSettings(self,values,failed=()):
+		for path,val in values.items():
+			parsed=pyODBpaths.parse(path)
+			if path not in failed and parsed is not None and parsed[1]=='chargeBias':
+				self.setBias(parsed[0],'Q'+str(parsed[2]),val)
+
+	def noteFlash(self,boards,start,end):
+		self.flashes.append({'start':start,'end':end,'boards':[pyODBpaths.name(board) for board in boards]})
+
+	#Start the run log record of the run step just started
+	def openRun(self,step):
+		if self.runLog is None:
+			return
+		last=self.flashes[-1] if self.flashes else {'start':None,'end':None,'boards':[]}
+		self.runRecord={'run':self.transition.run,'scan':self.name,'label':step.label,
+			'point':step.point,'subseries':step.subseries,
+			'start':time.time()-(time.monotonic()-self.transition.confirmed),
+			'startLatency':self.transition.latency,'flashes':len(self.flashes),
+			'lastFlashStart':last['start'],'lastFlashEnd':last['end'],'lastFlashBoards':last['boards'],
+			'bias':dict((board,dict(biases)) for board,biases in self.bias.items())}
+
+	#Finish the current run's record, now it has stopped, and write it out
+	def closeRun(self):
+		record=self.runRecord
+		self.runRecord=None
+		if record is None:
+			return
+		record['stop']=time.time()-(time.monotonic()-self.transition.confirmed)
+		record['stopLatency']=self.transition.latency
+		record['live']=self.transition.confirmed-self.runStart if self.runStart is not None else record['stop']-record['start']
+		record['biasEnd']=dict((board,dict(biases)) for board,biases in self.bias.items() if board in record['bias'])
+		record['drift']={}
+		for board,biases in record['bias'].items():
+			for name,value in biases.items():
+				end=record['biasEnd'][board].get(name,value)
+				record['drift'].setdefault(board,{})[name]=round((end-value)/record['live'],6) if record['live']>0 else 0.0
+		self.runLog.write(record)
+
+	#Get ready to carry on a scan that was interrupted, using its journal
+	#  - stops a run left going
+	#  - turns off LEDs left on by an interrupted flash and restores the 15V power
+	#  - ramps each HV from whatever it is actually set to, to where the scan
+	#    expects it to be at the resume point
+	#Returns the index of the step to carry on from (see resumeIndex)
+	def recover(self):
+		records=self.journal.read()
+		headers=[record for record in records if record.get('event')=='scan']
+		if headers and headers[-1]['steps']!=[step.describe() for step in self.steps]:
+			raise ValueError(self.journal.path+' is the journal of a different scan')
+		k=resumeIndex(self.steps,records)
+		print('Resuming at step '+str(k+1)+'/'+str(len(self.steps)))
+
+		if poe.read_value(pyODBpaths.RUN_STATE)==poe.STATE_RUNNING:
+			print('Stop run left going')
+			poe.runstop()
+
+		done=set(record['step'] for record in records if record.get('event')=='done')
+		for record in records:
+			if record.get('event')=='flash' and record['step'] not in done:
+				print('Finish interrupted flash')
+				pyFlash.enableLEDs(record['boards'],0)
+				pyFlash.set15VPowerEnable(record['boards'],record['power'])
+
+		#Where each HV should be at step k: the end of the last ramp before it
+		ramps={}
+		expected={}
+		for i,step in enumerate(self.steps):
+			for sub in substeps(step):
+				if isinstance(sub,Ramp):
+					ramps.setdefault(pyODBpaths.board(sub.iDCRC),sub)
+					if i<k:
+						expected[pyODBpaths.board(sub.iDCRC)]=sub.HVend
+		todo=[]
+		for iDCRC,ramp in ramps.items():
+			cals=pyChangeHV.loadCalTable(ramp.HVcalFile)
+			setting=poe.read_value(pyODBpaths.path(iDCRC,'chargeBias',0))
+			HVnow=round(cals.HV(setting),2)
+			HVwant=expected.get(iDCRC,0.0)
+			if abs(HVnow-HVwant)>0.01:
+				print('HV on DCRC '+pyODBpaths.name(iDCRC)+' is '+str(HVnow)+' V, ramping to '+str(HVwant)+' V')
+				todo.append((iDCRC,pyChangeHV.rampSchedule(HVnow,HVwant,ramp.HVrampRate,ramp.HVrampUpdatePeriod),cals))
+		#All the HVs ramp back at the same time
+		pyChangeHV.runRampSchedules(todo)
+
+		#What the steps before k set, for the run log
+		self.bias={}
+		self.flashes=[]
+		times=dict((record['step'],record) for record in records if record.get('event')=='done')
+		for i,step in enumerate(self.steps[:k]):
+			for sub in substeps(step):
+				if isinstance(sub,Settings):
+					self.noteSettings(sub.values)
+				elif isinstance(sub,Ramp):
+					self.setBias(sub.iDCRC,'HV',sub.HVend)
+				elif isinstance(sub,Flash) and i in times:
+					self.noteFlash(sub.boards,times[i]['start'],times[i]['end'])
+		return k
+
+	#Run a blocking ODB function in a worker thread so the event loop carries on
+	#The worker sees the calling task's trace phase
+	async def odb(self,fn,*args):
+		loop=asyncio.get_event_loop()
+		return await loop.run_in_executor(None,functools.partial(contextvars.copy_context().run,fn,*args))
+
+	#Run the steps from index start on (0 for a new scan)
+	async def execute(self,start=0):
+		self.started=time.monotonic()
+		self.liveTime=0.0
+		self.runStart=None
+		self.runRecord=None
+		if start==0:
+			self.bias={}
+			self.flashes=[]
+		self.aborted=None
+		self.stopping.clear()
+		self.unpaused=asyncio.Event()
+		if self.paused is None:
+			self.unpaused.set()
+		self.record({'event':'scan','name':self.name,'resume':start>0,'start':start,
+			'steps':[step.describe() for step in self.steps]})
+		background=[asyncio.ensure_future(task(self)) for task in self.tasks]
+		try:
+			for self.index in range(start,len(self.steps)):
+				step=self.steps[self.index]
+				record={'event':'done','step':self.index,'kind':step.kind,'label':step.label,'start':time.time()}
+				if not self.unpaused.is_set():
+					await self.unpaused.wait()
+					record['start']=time.time()
+				if self.aborted is not None:
+					raise ScanAborted(self.aborted)
+				poe.set_phase(phaseOf(step))
+				self.stepTask=asyncio.ensure_future(step.run(self))
+				try:
+					await self.stepTask
+				except asyncio.CancelledError:
+					if self.aborted is None:
+						raise
+					raise ScanAborted(self.aborted)
+				finally:
+					self.stepTask=None
+				record['end']=time.time()
+				if isinstance(step,(StartRun,StopRun)):
+					record['run']=self.transition.run
+					record['latency']=self.transition.latency
+				self.record(record)
+		finally:
+			self.index=None
+			self.elapsed=time.monotonic()-self.started
+			for task in background:
+				task.cancel()
+			await asyncio.gather(*background,return_exceptions=True)
+
+	def run(self,start=0):
+		return asyncio.run(self.execute(start))
+
+#Background task: read paths every period seconds, straight from the ODB (not
+#the cache), and hand {path: value} to
+#callback(scan, values)
+def poll(paths,period,callback):
+	paths=list(paths)
+	async def task(scan):
+		poe.set_phase('poll')
+		while True:
+			try:
+				values=await scan.odb(poe.read_values,paths,True)
+				callback(scan,dict(zip(paths,values)))
+			except Exception as e:
+				print('****Poll failed: '+str(e)+'****')
+			await asyncio.sleep(period)
+	return task
+
+#Background task: write the unix time to path every period seconds
+#(see pyHeartbeat), printing its tick statistics when the scan ends
+def heartbeat(path='/Playground/time',period=1.0):
+	async def task(scan):
+		poe.set_phase('heartbeat')
+		hb=pyHeartbeat.Heartbeat(path,period)
+		try:
+			await hb.runAsync(scan.odb)
+		finally:
+			print(hb.summary())
+	return task
+
+#Background task: watch paths (see pyodbedit.watch) and hand the changes,
+#{path: (old, new)}, to callback(scan, changes) in the event loop. The callback
+#can call scan.abort(reason), scan.pause(reason) or scan.resume().
+#The first call has every watched key (old is None), so the starting values
+#can be checked too. If the keys can't be read to start with, the scan is
+#aborted rather than run unwatched.
+def watch(paths,callback,period=poe.WATCH_PERIOD):
+	async def task(scan):
+		loop=asyncio.get_event_loop()
+		w=poe.Watch(paths,lambda changes: loop.call_soon_threadsafe(callback,scan,changes),period)
+		try:
+			await scan.odb(w.start)
+		except Exception as e:
+			scan.abort('can\'t watch '+', '.join(w.paths)+': '+str(e))
+			return
+		callback(scan,dict((path,(None,val)) for path,val in w.values.items()))
+		try:
+			await asyncio.Event().wait()
+		finally:
+			w.stop()
+	return task
+
+#Background task: keep keys within limits
+#rules is a list of (path, low, high, action): when the key's value goes below
+#low or above high (either may be None), action ('abort' or 'pause') is taken.
+#A paused scan is resumed once every key that paused it is back within limits.
+#  pyScan.limits([('/Equipment/HV/Variables/Current',None,1e-6,'abort')])
+def limits(rules,period=poe.WATCH_PERIOD):
+	rules=[(path,low,high,action) for path,low,high,action in rules]
+	for path,low,high,action in rules:
+		if action not in ('abort','pause'):
+			raise ValueError('limit action for '+path+' should be abort or pause, not '+repr(action))
+	out=set()
+	def check(scan,changes):
+		for path,low,high,action in rules:
+			if path not in changes:
+				continue
+			val=changes[path][1]
+			bad=val is None or (low is not None and val<low) or (high is not None and val>high)
+			if bad and action=='abort':
+				scan.abort(path+' = '+str(val)+' outside ['+str(low)+', '+str(high)+']')
+			elif bad:
+				out.add(path)
+				scan.pause(path+' = '+str(val)+' outside ['+str(low)+', '+str(high)+']')
+			elif path in out:
+				out.discard(path)
+				if not out:
+					scan.resume()
+	return watch([path for path,low,high,action in rules],check,period)
+
+#Background task: print how far through the scan we are every period seconds
+def progress(period=60.0):
+	async def task(scan):
+		total=scan.expectedDuration()
+		while True:
+			await asyncio.sleep(period)
+			step=scan.current
+			elapsed=time.monotonic()-scan.started
+			print('Progress: step '+str(scan.index+1)+'/'+str(len(scan.steps))
+				+(' ('+step.describe()+')' if step is not None else '')
+				+', '+str(int(elapsed))+'/'+str(int(total))+' s')
+	return task
@@ -0,0 +1,291 @@
+# Run an HV or Qbias scan described in a plan file instead of on the command line
+# Plans can be JSON, TOML or YAML (YAML needs pyyaml). The keys are the same as
+# the pyHVscan/pyQscan command line options, e.g. for an HV scan:
+#
+#   type: HV
+#   iDCRC: 4                   # or Tower:DCRC, e.g. Tower02:4
+#   HVs: [0, 10, 20, 45]
+#   HVcalFile: /path/to/cal.txt
+#   HVrampRate: 1.0            # V/s
+#   HVrampUpdatePeriod: 1      # s
+#   HVmaxRate: 5.0             # V/s, optional: ramp in closed loop on the readback
+#   HVrampTolerance: 0.5       # V the readback may lag in a closed-loop ramp
+#   HVreadback: /path/to/monitor  # optional, HV readback key in V
+#   HVdriftRate: 0.0           # V/s
+#   HVdriftUpdatePeriod: 10    # s
+#   HVpreBias: 15/5            # overbias %/wait min
+#   tSeries: 60                # min
+#   NsubSeries: 2
+#   DCRCs2Flash: [1, 2, 3]
+#   FlashDuration: 30          # s
+#   CoolDuration: 30           # min
+#
+# and for a Qbias scan:
+#
+#   type: Q
+#   DCRC_S1S2: 3/1
+#   Vs: [[0, 0], [5, -5], [10, -10]]
+#   tSeries: 60
+#   DCRCs2Flash: [1, 3]
+#   debug: false
+#
+# A multi plan scans several detectors at once (see pyMultiScan), sharing the
+# runs, flashes and cooldowns. It has the run and flash settings, and a list of
+# HV and Q scans giving just their bias settings (and any extra DCRCs2Flash):
+#
+#   type: multi
+#   tSeries: 60
+#   NsubSeries: 2
+#   DCRCs2Flash: [1, 2, 3]
+#   scans:
+#     - {type: HV, iDCRC: 4, HVs: [0, 10, 20], HVcalFile: /path/to/cal.txt}
+#     - {type: Q, DCRC_S1S2: 3/1, Vs: [[0, 0], [5, -5], [10, -10]]}
+#
+# Either kind of plan can also say which steps may overlap to cut dead time
+# (see pyScan.overlapSteps), e.g. to ramp up for the next bias point during the
+# tail of the cooldown:
+#
+#   overlap: [[cool, hvpower], [cool, ramp], [cool, wait]]
+#
+# The same list can be given in a separate policy file with -policy, as
+# {"overlap": [...]}.
+#
+# ODB keys can be watched while the scan runs (see pyScan.limits). Each entry is
+# [path, low, high, action], with null for no limit; 'abort' stops the scan
+# (carry on later with -resume) and 'pause' holds it before its next step
+# until the key is back in range, e.g.
+#
+#   limits: [["/Equipment/HV/Variables/Current", null, 1e-6, abort]]
+#
+# Progress is journalled to <plan>.journal (or -journal). If the scan is
+# interrupted, run it again with -resume to carry on from the subseries it was
+# in, after the HV has been ramped back from wherever it was left.
+#
+# Every run is recorded in <plan>.runs.db (or -runLog) with its bias point,
+# subseries, start and stop times, the biases on each DCRC and the last flash
+# before it, so runs can be picked out by bias afterwards (see pyRunLog).
+#
+# With -dryRun the plan is compiled into its step list and the expected
+# duration, ODB traffic and live-time fraction are printed without touching
+# the ODB.
+
+import os
+import sys
+import json
+import argparse
+
+import pyodbedit
+import pyChangeHV
+import pyScan
+import pyHVscan
+import pyQscan
+import pyMultiScan
+
+#Raised for plan files that are missing settings or don't make sense
+class PlanError(ValueError):
+	pass
+
+#Read a plan file into a dict, picking the format from the extension
+def loadPlan(planFile):
+	ext=os.path.splitext(planFile)[1].lower()
+	if ext=='.json':
+		with open(planFile,'r') as f:
+			return json.load(f)
+	if ext=='.toml':
+		try:
+			import tomllib
+		except ImportError:
+			import tomli as tomllib
+		with open(planFile,'rb') as f:
+			return tomllib.load(f)
+	if ext in ('.yaml','.yml'):
+		import yaml
+		with open(planFile,'r') as f:
+			return yaml.safe_load(f)
+	raise PlanError(planFile+': unknown plan format (use .json, .toml or .yaml)')
+
+def _require(plan,keys):
+	missing=[key for key in keys if plan.get(key) is None]
+	if missing:
+		raise PlanError('plan is missing '+', '.join(missing))
+
+#'a,b,c' or [a,b,c] -> list
+def _list(val):
+	if isinstance(val,str):
+		return [x.strip() for x in val.split(',')]
+	return list(val)
+
+#Series time per subseries in s, as the scan scripts work it out
+def _seriesTime(plan):
+	tSeries_sec=round(float(plan['tSeries'])*60.0)
+	nSubSeries=int(plan.get('NsubSeries') or 1)
+	return round(float(tSeries_sec)/nSubSeries),nSubSeries
+
+#Closed-loop ramp settings (see pyChangeHV.runAdaptiveRamp), off unless HVmaxRate is given
+def _adaptive(plan):
+	HVmaxRate=plan.get('HVmaxRate')
+	if HVmaxRate is not None and float(HVmaxRate)<float(plan.get('HVrampRate',1.0)):
+		raise PlanError('HVmaxRate must be at least HVrampRate')
+	return (float(HVmaxRate) if HVmaxRate is not None else None,
+		float(plan.get('HVrampTolerance',pyChangeHV.RAMP_TOLERANCE)),plan.get('HVreadback'))
+
+#HVpreBias as '15/5' or {'percent': 15, 'minutes': 5} -> (percent, wait s)
+def _preBias(val):
+	if val is None or val=='None':
+		return None,0
+	if isinstance(val,dict):
+		return float(val['percent']),int(60.0*float(val['minutes']))
+	percent,minutes=str(val).split('/')
+	return float(percent),int(60.0*float(minutes))
+
+def _checkPeriods(plan):
+	for name in ('HVrampUpdatePeriod','HVdriftUpdatePeriod'):
+		if name in plan and float(plan[name])<pyChangeHV.MIN_UPDATE_PERIOD:
+			raise PlanError('Minimum '+name+' is '+str(pyChangeHV.MIN_UPDATE_PERIOD)+' s')
+
+#The HVBias or QBias for one scan in a multi plan
+def compileBias(plan):
+	kind=str(plan.get('type','')).upper()
+	if kind=='HV':
+		_require(plan,['iDCRC','HVs','HVcalFile'])
+		_checkPeriods(plan)
+		percent,wait_sec=_preBias(plan.get('HVpreBias'))
+		return pyHVscan.HVBias(plan['iDCRC'],[float(x) for x in _list(plan['HVs'])],plan['HVcalFile'],
+			float(plan.get('HVrampRate',1.0)),float(plan.get('HVrampUpdatePeriod',1.0)),
+			float(plan.get('HVdriftRate',0.0)),float(plan.get('HVdriftUpdatePeriod',10.0)),percent,wait_sec,*_adaptive(plan))
+	if kind=='Q':
+		_require(plan,['DCRC_S1S2','Vs'])
+		DCRC_S1,DCRC_S2=str(plan['DCRC_S1S2']).split('/')
+		return pyQscan.QBias(DCRC_S1,DCRC_S2,[[float(V1),float(V2)] for V1,V2 in plan['Vs']])
+	raise PlanError('scans in a multi plan should be type HV or Q, not '+repr(plan.get('type')))
+
+#Turn a plan dict into the list of pyScan steps
+def compilePlan(plan):
+	kind=str(plan.get('type','')).upper()
+	if kind=='HV':
+		_require(plan,['iDCRC','HVs','HVcalFile','tSeries','DCRCs2Flash'])
+		tSeries_sec,nSubSeries=_seriesTime(plan)
+		percent,wait_sec=_preBias(plan.get('HVpreBias'))
+		_checkPeriods(plan)
+		return pyHVscan.hvScanSteps(plan['iDCRC'],[float(x) for x in _list(plan['HVs'])],plan['HVcalFile'],
+			tSeries_sec,_list(plan['DCRCs2Flash']),nSubSeries,
+			float(plan.get('HVrampRate',1.0)),float(plan.get('HVrampUpdatePeriod',1.0)),
+			float(plan.get('HVdriftRate',0.0)),float(plan.get('HVdriftUpdatePeriod',10.0)),
+			percent,wait_sec,float(plan.get('FlashDuration',30)),round(float(plan.get('CoolDuration',30))*60.0),*_adaptive(plan))
+	if kind=='Q':
+		_require(plan,['DCRC_S1S2','Vs','tSeries','DCRCs2Flash'])
+		tSeries_sec,nSubSeries=_seriesTime(plan)
+		DCRC_S1,DCRC_S2=str(plan['DCRC_S1S2']).split('/')
+		Vlist=[[float(V1),float(V2)] for V1,V2 in plan['Vs']]
+		return pyQscan.qScanSteps(DCRC_S1,DCRC_S2,Vlist,tSeries_sec,_list(plan['DCRCs2Flash']),nSubSeries,
+			float(plan.get('FlashDuration',30)),round(float(plan.get('CoolDuration',30))*60.0),bool(plan.get('debug',False)))
+	if kind=='MULTI':
+		_require(plan,['scans','tSeries'])
+		tSeries_sec,nSubSeries=_seriesTime(plan)
+		flash=_list(plan.get('DCRCs2Flash',[]))
+		for scan in plan['scans']:
+			flash+=[board for board in _list(scan.get('DCRCs2Flash',[])) if board not in flash]
+		if not flash:
+			raise PlanError('plan is missing DCRCs2Flash')
+		try:
+			return pyMultiScan.multiScanSteps([compileBias(scan) for scan in plan['scans']],tSeries_sec,flash,nSubSeries,
+				float(plan.get('FlashDuration',30)),round(float(plan.get('CoolDuration',30))*60.0),bool(plan.get('debug',False)))
+		except pyMultiScan.ConflictError as e:
+			raise PlanError(str(e))
+	raise PlanError('plan type should be HV, Q or multi, not '+repr(plan.get('type')))
+
+#Check every HV ramp in the steps against its calibration table
+#Returns a list of problems (empty if everything is in range)
+def checkRamps(steps):
+	problems=[]
+	for step in [sub for step in steps for sub in pyScan.substeps(step)]:
+		if isinstance(step,pyScan.Ramp) and step.schedule:
+			try:
+				cals=pyChangeHV.loadCalTable(step.HVcalFile)
+				pyChangeHV.calcBiasSetting([HV for t,HV in step.schedule],cals)
+			except (IOError,OSError,pyChangeHV.CalibrationError) as e:
+				problems.append(step.describe()+': '+str(e))
+	return problems
+
+#Print the step list and the cost of the scan
+#serial is the scan without overlaps, for comparison
+def printDryRun(scan,serial=None):
+	t=0.0
+	for i,step in enumerate(scan.steps):
+		reads,writes=step.odbCalls()
+		print('%4d %9.1f s  %-40s %8.1f s  %3d r %4d w'%(i+1,t,step.describe(),step.duration,reads,writes))
+		t+=step.duration
+	est=scan.estimate()
+	print('')
+	print('Steps:         '+str(len(scan.steps)))
+	print('Runs:          '+str(est['runs']))
+	print('Duration:      '+str(round(est['duration']/3600.,2))+' h')
+	print('Live time:     '+str(round(est['live']/3600.,2))+' h ('+str(round(100*est['liveFraction'],1))+'%)')
+	print('ODB reads:     '+str(est['reads']))
+	print('ODB writes:    '+str(est['writes']))
+	if serial is not None:
+		base=serial.estimate()
+		print('Without overlaps: '+str(round(base['duration']/3600.,2))+' h, live '+str(round(100*base['liveFraction'],1))+'%')
+
+########################################################################
+def main(args):
+	parser = argparse.ArgumentParser(description='Run a scan from a plan file')
+	parser.add_argument('plan',type=str,help='Scan plan file (.json, .toml or .yaml)')
+	parser.add_argument('-policy',type=str,help='File listing the steps allowed to overlap, as {"overlap": [[host kind, step kind], ...]}. Overrides the plan\'s own overlap list.')
+	parser.add_argument('-journal',type=str,help='Journal file recording the scan\'s progress. Default is the plan file name + .journal')
+	parser.add_argument('-resume',action='store_true',default=False,help='Carry on an interrupted scan from its journal.')
+	parser.add_argument('-trace',type=str,help='Record every ODB call to this file (.jsonl, or .json for a Chrome trace) and print where the time went at the end.')
+	parser.add_argument('-runLog',type=str,help='File recording every run with the biases it was taken at (.db for SQLite, or .csv). Default is the plan file name + .runs.db')
+	parser.add_argument('-dryRun','--dry-run',dest='dryRun',action='store_true',default=False,help='Print the steps and what the scan will cost without touching the ODB.')
+	args = parser.parse_args(args)
+
+	plan=loadPlan(args.plan)
+	steps=compilePlan(plan)
+	problems=checkRamps(steps)
+	for problem in problems:
+		print('****'+problem+'****')
+
+	policy=plan.get('overlap')
+	if args.policy is not None:
+		policy=loadPlan(args.policy).get('overlap')
+	serial=None
+	if policy:
+		serial=pyScan.Scan(steps,name=args.plan)
+		steps=pyScan.overlapSteps(steps,policy)
+	journal=args.journal if args.journal is not None else args.plan+'.journal'
+	tasks=[pyScan.progress(300)]
+	if plan.get('limits'):
+		tasks.append(pyScan.limits(plan['limits']))
+	runLog=args.runLog if args.runLog is not None else args.plan+'.runs.db'
+	scan=pyScan.Scan(steps,tasks=tasks,name=args.plan,journal=journal,runLog=None if args.dryRun else runLog)
+
+	if args.dryRun:
+		printDryRun(scan,serial)
+		return scan
+
+	if problems:
+		sys.exit('****Plan has HV ramps outside the calibration****')
+	print('Scan from plan '+args.plan)
+	print('COMMENT plan: '+json.dumps(plan,sort_keys=True))
+	pyodbedit.enable_cache()
+	if args.trace is not None:
+		pyodbedit.enable_trace(args.trace)
+	start=0
+	if args.resume:
+		start=scan.recover()
+	try:
+		scan.run(start)
+	except pyScan.ScanAborted as e:
+		sys.exit('****Scan aborted: '+str(e)+'. Run again with -resume to carry on.****')
+	print('Live time '+str(round(scan.liveTime/3600.,2))+' h of '+str(round(scan.elapsed/3600.,2))+' h ('
+		+str(round(100*scan.liveTime/scan.elapsed,1))+'%)')
+	if serial is not None:
+		print('Without overlaps expected '+str(round(100*serial.estimate()['liveFraction'],1))+'%')
+	print('ODB cache: '+str(pyodbedit.cache_stats()))
+	if args.trace is not None:
+		pyodbedit.print_trace_summary()
+	print('Done')
+	return scan
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
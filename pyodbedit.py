@@ -1,22 +1,1342 @@
 #pyodbedit.py
 #A python function to issue odbedit commands to the MIDAS odb
-#These will only work when issued on the same machine as the MIDAS daq (cdms2 by default)
+#
+#The read/write/runstart/runstop functions go through a backend, picked
+#automatically the first time one is needed:
+#  midas   - the MIDAS python bindings (midas.client), if they can be imported
+#  jsonrpc - mhttpd's JSON-RPC interface, if MHTTPD_URL is set (works off the DAQ host)
+#  odbedit - odbedit processes. These will only work when issued on the same
+#            machine as the MIDAS daq (cdms2 by default)
+#  memory  - an in-memory ODB stand-in for testing without a DAQ
+#  gateway - a pyODBgateway process, which is used first whenever one of
+#            this user's is listening on GATEWAY_SOCKET, so every tool's ODB
+#            traffic goes through it (see pyODBgateway.py)
+#Set PYODBEDIT_BACKEND to one of those names to force a choice, or call set_backend().
+#
+#The odbedit backend pipes reads and writes over stdin to a small pool of
+#long-lived odbedit sessions instead of starting (and connecting) a new
+#odbedit for every call.
+#odbedit is always run directly, never through a shell. Paths and values are
+#quoted as single odbedit arguments. A failing, complaining or hung odbedit
+#raises OdbeditError (OdbeditTimeout after COMMAND_TIMEOUT s).
 
 import os
+import re
+import json
+import math
+import queue
+import socket
+import stat
+import atexit
+import itertools
+import contextlib
+import contextvars
+import collections
+import subprocess
+import threading
+import time
 
-#read from the odb
+from urllib.request import Request, urlopen
+
+ODBEDIT='odbedit'
+#mhttpd address for the jsonrpc backend, e.g. http://localhost:8080
+MHTTPD_URL=os.environ.get('MHTTPD_URL')
+#Maximum number of odbedit sessions kept open at once
+POOL_SIZE=4
+#Set to False to go back to one odbedit process per call
+PERSISTENT=True
+#How long (s) enable_cache() trusts a remembered value
+CACHE_TTL=10.0
+#How long (s) an odbedit command (or a batch of them on a session) may take
+COMMAND_TIMEOUT=10.0
+#How long (s) runstart/runstop wait for /Runinfo/State to change, and how often they look
+TRANSITION_TIMEOUT=60.0
+TRANSITION_POLL=0.1
+#Number of calls enable_trace() keeps in memory
+TRACE_SIZE=100000
+#How often (s) watch() polls when the backend has no hotlinks
+WATCH_PERIOD=1.0
+#Unix socket of the pyODBgateway process, if one is running. By default it is
+#in a directory only this user can get into: $XDG_RUNTIME_DIR, or else
+#/tmp/pyodb-<uid> (made owner-only by the gateway)
+def _default_gateway_socket():
+  runtime=os.environ.get('XDG_RUNTIME_DIR')
+  if runtime and os.path.isdir(runtime):
+    return os.path.join(runtime,'pyodb-gateway.sock')
+  return os.path.join('/tmp','pyodb-'+str(os.getuid()),'gateway.sock')
+GATEWAY_SOCKET=os.environ.get('PYODB_GATEWAY') or _default_gateway_socket()
+#How many times to try connecting to a busy gateway, and the first wait (s)
+#between tries (doubling each time)
+GATEWAY_RETRIES=6
+GATEWAY_BACKOFF=0.01
+
+#/Runinfo/State values
+STATE_STOPPED=1
+STATE_PAUSED=2
+STATE_RUNNING=3
+
+#odbedit may echo its prompt (e.g. "[local:Online:S]/>") in front of output
+_prompt=re.compile(r'^(\[[^\]]*\][^>]*>\s*)+')
+
+#Raised when odbedit can't be run, exits with an error, writes to stderr or
+#prints something that isn't a value where a value was expected
+#cmd, returncode and output say what happened (returncode is None if odbedit
+#didn't exit)
+class OdbeditError(Exception):
+  def __init__(self,message,cmd=None,returncode=None,output=''):
+    Exception.__init__(self,message)
+    self.cmd=cmd
+    self.returncode=returncode
+    self.output=output
+
+#Raised when an odbedit command takes longer than its timeout
+class OdbeditTimeout(OdbeditError):
+  pass
+
+#Quote a path or value as a single odbedit argument
+#odbedit has no escape character, so quotes and line breaks can't be sent at all
+def _quote(text):
+  text=str(text)
+  if '"' in text or '\n' in text or '\r' in text:
+    raise ValueError('odbedit can\'t take '+repr(text)+': it contains a quote or line break')
+  return '"'+text+'"'
+
+#A single long-lived odbedit process, run without a shell
+#Every command is followed by an 'ls' of a key that can't exist. Its "not found"
+#message contains a unique token, which marks the end of the command's output.
+#A thread reads odbedit's output so that commands can time out.
+class Session(object):
+  def __init__(self,odbedit=ODBEDIT):
+    try:
+      self.proc=subprocess.Popen([odbedit],stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,universal_newlines=True,bufsize=1)
+    except OSError as e:
+      raise OdbeditError('can\'t run '+odbedit+': '+str(e))
+    self.counter=itertools.count()
+    self.lines=queue.Queue()
+    self.reader=threading.Thread(target=self._read,name='odbedit session')
+    self.reader.daemon=True
+    self.reader.start()
+
+  def _read(self):
+    for line in self.proc.stdout:
+      self.lines.put(line)
+    self.lines.put(None)
+
+  def command(self,cmd,timeout=COMMAND_TIMEOUT):
+    return self.commands([cmd],timeout)[0]
+
+  #Send a batch of commands in one go and collect each one's output
+  #The whole batch must finish within timeout s
+  def commands(self,cmds,timeout=COMMAND_TIMEOUT):
+    deadline=time.monotonic()+timeout
+    tokens=[]
+    try:
+      for cmd in cmds:
+        token='__pyodbedit_'+str(os.getpid())+'_'+str(id(self))+'_'+str(next(self.counter))+'__'
+        self.proc.stdin.write(cmd+'\n')
+        self.proc.stdin.write('ls "/'+token+'"\n')
+        tokens.append(token)
+      self.proc.stdin.flush()
+    except (OSError,ValueError) as e:
+      raise OdbeditError('odbedit session has gone: '+str(e),cmds[len(tokens)] if len(tokens)<len(cmds) else cmds[-1],
+                         self.proc.poll())
+    outs=[]
+    lines=[]
+    while True:
+      try:
+        line=self.lines.get(timeout=max(0.0,deadline-time.monotonic()))
+      except queue.Empty:
+        raise OdbeditTimeout(cmds[len(outs)]+' took more than '+str(timeout)+' s',cmds[len(outs)],None,'\n'.join(lines))
+      if line is None:
+        raise OdbeditError('odbedit session exited while running: '+cmds[len(outs)],cmds[len(outs)],
+                           self.proc.wait(),'\n'.join(lines))
+      if tokens[len(outs)] in line:
+        outs.append('\n'.join(lines).strip())
+        lines=[]
+        if len(outs)==len(tokens):
+          return outs
+      else:
+        lines.append(_prompt.sub('',line.rstrip('\n')))
+
+  def close(self):
+    try:
+      self.proc.stdin.write('exit\n')
+      self.proc.stdin.close()
+      self.proc.wait(timeout=5)
+    except Exception:
+      self.proc.kill()
+
+#A bounded pool of Sessions, safe to share between threads
+#Sessions are started lazily and dropped if a command fails on them
+class SessionPool(object):
+  def __init__(self,size=POOL_SIZE,odbedit=ODBEDIT):
+    self.odbedit=odbedit
+    self.slots=threading.BoundedSemaphore(size)
+    self.lock=threading.Lock()
+    self.idle=[]
+
+  def command(self,cmd):
+    return self.commands([cmd])[0]
+
+  def commands(self,cmds,timeout=COMMAND_TIMEOUT):
+    with self.slots:
+      with self.lock:
+        session=self.idle.pop() if self.idle else None
+      if session is None:
+        session=Session(self.odbedit)
+      try:
+        outs=session.commands(cmds,timeout)
+      except Exception:
+        session.close()
+        raise
+      with self.lock:
+        self.idle.append(session)
+      return outs
+
+  def close(self):
+    with self.lock:
+      sessions,self.idle=self.idle,[]
+    for session in sessions:
+      session.close()
+
+#run a single odbedit command in its own process (no shell), returning its output
+#Raises OdbeditError if odbedit fails or complains on stderr
+def _oneshot(cmd,odbedit=ODBEDIT,timeout=COMMAND_TIMEOUT):
+  try:
+    result=subprocess.run([odbedit,'-c',cmd],stdout=subprocess.PIPE,stderr=subprocess.PIPE,
+                          universal_newlines=True,timeout=timeout)
+  except subprocess.TimeoutExpired as e:
+    raise OdbeditTimeout(cmd+' took more than '+str(timeout)+' s',cmd,None,e.output or '')
+  except OSError as e:
+    raise OdbeditError('can\'t run '+odbedit+': '+str(e),cmd)
+  if result.returncode!=0 or result.stderr.strip():
+    raise OdbeditError(cmd+' failed'+(' (exit code '+str(result.returncode)+')' if result.returncode else '')
+                       +': '+(result.stderr.strip() or result.stdout.strip()),cmd,result.returncode,
+                       result.stdout+result.stderr)
+  return result.stdout.strip()
+
+#Convert an odbedit style value string ('y', '3', '1.5', 'text') into the
+#python value the JSON based backends expect
+def _from_text(val):
+  val=str(val)
+  if val.lower() in ('y','yes','true'):
+    return True
+  if val.lower() in ('n','no','false'):
+    return False
+  for conv in (int,float):
+    try:
+      return conv(val)
+    except ValueError:
+      pass
+  return val
+
+#...and back again, the way 'ls -v' would print it
+def _to_text(val):
+  if isinstance(val,bool):
+    return 'y' if val else 'n'
+  if isinstance(val,list):
+    return '\n'.join(_to_text(v) for v in val)
+  return str(val)
+
+#Parse 'ls -v' output into python values. Array keys print one element per line.
+def _parse_ls(out):
+  lines=out.splitlines()
+  if len(lines)>1:
+    return [_from_text(line.strip()) for line in lines]
+  return _from_text(out.strip())
+
+_missing=re.compile(r'^key .* not found')
+#odbedit complaints, which must not be mistaken for values
+_error=re.compile(r'^(error|cannot|can\'t|unknown command|wrong|invalid|not connected)\b',re.I)
+
+#odbedit complains in a single line, so a multi-line array listing whose
+#elements happen to start with one of those words is still a value
+def _complaint(out):
+  return '\n' not in out and _error.match(out) is not None
+_hex=re.compile(r'^0x[0-9a-fA-F]+$')
+_index=re.compile(r'^(.*)\[(\d+)\]$')
+
+#Drop the 'name/key' and 'name/last_written' metadata entries from MIDAS JSON
+#and turn hex encoded integers back into ints
+def _clean_json(data):
+  if isinstance(data,dict):
+    return dict((k,_clean_json(v)) for k,v in data.items() if '/' not in k)
+  if isinstance(data,list):
+    return [_clean_json(v) for v in data]
+  if isinstance(data,str) and _hex.match(data):
+    return int(data,16)
+  return data
+
+#Backends all provide:
+#  read(path)                       - odbedit style text, as 'ls -v' prints it
+#  read_values([path,...])          - typed python values, KeyError for missing keys
+#  read_tree(path)                  - a whole subtree as a nested dict
+#  write_many([(path,value),...])   - returns {path: message} for the keys that failed
+#  runstart(), runstop(), close()
+
+#Talk to the ODB with odbedit
+class OdbeditBackend(object):
+  name='odbedit'
+
+  def __init__(self,odbedit=ODBEDIT,persistent=PERSISTENT,size=POOL_SIZE):
+    self.odbedit=odbedit
+    self.persistent=persistent
+    self.pool=SessionPool(size,odbedit)
+
+  #run a list of odbedit commands as one batch, returning each command's output
+  def commands(self,cmds,timeout=COMMAND_TIMEOUT):
+    cmds=list(cmds)
+    if not cmds:
+      return []
+    if self.persistent:
+      return self.pool.commands(cmds,timeout)
+    return [_oneshot(cmd,self.odbedit,timeout) for cmd in cmds]
+
+  def read(self,path):
+    return self.commands(['ls -v '+_quote(path)])[0]
+
+  def read_values(self,paths):
+    values=[]
+    for path,out in zip(paths,self.commands('ls -v '+_quote(path) for path in paths)):
+      if _missing.match(out):
+        raise KeyError(path)
+      if _complaint(out):
+        raise OdbeditError('reading '+path+': '+out,'ls -v '+_quote(path),None,out)
+      values.append(_parse_ls(out))
+    return values
+
+  #Needs an odbedit new enough to have the 'json' command
+  def read_tree(self,path):
+    out=self.commands(['json '+_quote(path)])[0]
+    try:
+      return _clean_json(json.loads(out))
+    except ValueError:
+      if _missing.match(out):
+        raise KeyError(path)
+      raise OdbeditError('reading '+path+': '+out,'json '+_quote(path),None,out)
+
+  #'set' prints nothing when it succeeds, so any output is reported as a failure
+  #Values odbedit can't take are reported as failures without being sent
+  def write_many(self,items):
+    failed={}
+    cmds=[]
+    sent=[]
+    for path,val in items:
+      try:
+        cmds.append('set '+_quote(path)+' '+_quote(val))
+        sent.append(path)
+      except ValueError as e:
+        failed[path]=str(e)
+    for path,out in zip(sent,self.commands(cmds)):
+      if out:
+        failed[path]=out
+    return failed
+
+  #Run transitions always go through 'odbedit -c', which skips the interactive
+  #run parameter questions that 'start' would otherwise ask on a session
+  def runstart(self):
+    #return _oneshot('start now') #What does now do?
+    return _oneshot('start',self.odbedit,TRANSITION_TIMEOUT)
+
+  def runstop(self):
+    return _oneshot('stop',self.odbedit,TRANSITION_TIMEOUT)
+
+  def close(self):
+    self.pool.close()
+
+#Talk to the ODB through the MIDAS python bindings
+class MidasBackend(object):
+  name='midas'
+
+  def __init__(self,client_name='pyodbedit'):
+    import midas.client
+    self.client=midas.client.MidasClient(client_name)
+    self.lock=threading.Lock()
+    self.listener=None
+    self.closed=threading.Event()
+    #Hotlinks delivered by communicate(), waiting to be passed on: (fn, path, value)
+    self.hotlinks=collections.deque()
+
+  def read(self,path):
+    with self.lock:
+      return _to_text(self.client.odb_get(path))
+
+  def read_values(self,paths):
+    values=[]
+    with self.lock:
+      for path in paths:
+        try:
+          values.append(self.client.odb_get(path))
+        except Exception as e:
+          raise KeyError(path+': '+str(e))
+    return values
+
+  def read_tree(self,path):
+    return self.read_values([path])[0]
+
+  def write_many(self,items):
+    failed={}
+    with self.lock:
+      for path,val in items:
+        try:
+          self.client.odb_set(path,_from_text(val))
+        except Exception as e:
+          failed[path]=str(e)
+    return failed
+
+  def runstart(self):
+    with self.lock:
+      self.client.start_run()
+    return ''
+
+  def runstop(self):
+    with self.lock:
+      self.client.stop_run()
+    return ''
+
+  #Call fn(path, value) whenever the key or subtree at path changes (an ODB
+  #hotlink). The MIDAS client only delivers hotlinks while it is communicating,
+  #so a thread does that in short slices between the other calls.
+  #fn is called once the thread has let go of the client again, so it can
+  #read and write the ODB itself.
+  def watch(self,path,fn):
+    with self.lock:
+      self.client.odb_watch(path,lambda client,path,value: self.hotlinks.append((fn,path,value)))
+      if self.listener is None:
+        self.listener=threading.Thread(target=self._listen,name='pyodbedit hotlinks')
+        self.listener.daemon=True
+        self.listener.start()
+
+  def unwatch(self,path):
+    with self.lock:
+      self.client.odb_stop_watching(path)
+
+  def _listen(self):
+    while not self.closed.wait(0.05):
+      with self.lock:
+        self.client.communicate(10)
+      while self.hotlinks:
+        fn,path,value=self.hotlinks.popleft()
+        try:
+          fn(path,value)
+        except Exception as e:
+          print('****Hotlink on '+path+' failed: '+str(e)+'****')
+
+  def close(self):
+    self.closed.set()
+    if self.listener is not None:
+      self.listener.join()
+    self.client.disconnect()
+
+class JSONRPCError(Exception):
+  pass
+
+#Talk to the ODB through mhttpd's JSON-RPC interface
+#A whole write_many is a single db_paste request
+class JSONRPCBackend(object):
+  name='jsonrpc'
+
+  def __init__(self,url=None,timeout=10):
+    self.url=(url or MHTTPD_URL).rstrip('/')+'/?mjsonrpc'
+    self.timeout=timeout
+    self.counter=itertools.count()
+
+  def call(self,method,params):
+    body=json.dumps({'jsonrpc':'2.0','method':method,'params':params,'id':next(self.counter)})
+    req=Request(self.url,body.encode('utf-8'),{'Content-Type':'application/json'})
+    reply=json.loads(urlopen(req,timeout=self.timeout).read().decode('utf-8'))
+    if reply.get('error'):
+      raise JSONRPCError(method+': '+str(reply['error']))
+    return reply['result']
+
+  def read(self,path):
+    result=self.call('db_get_values',{'paths':[path]})
+    if result['status'][0]!=1:
+      return 'key '+path+' not found (status '+str(result['status'][0])+')'
+    return _to_text(_clean_json(result['data'][0]))
+
+  #Any number of keys (or whole subtrees) come back from one db_get_values
+  def read_values(self,paths):
+    paths=list(paths)
+    result=self.call('db_get_values',{'paths':paths})
+    for path,status in zip(paths,result['status']):
+      if status!=1:
+        raise KeyError(path+' (status '+str(status)+')')
+    return [_clean_json(data) for data in result['data']]
+
+  def read_tree(self,path):
+    return self.read_values([path])[0]
+
+  def write_many(self,items):
+    if not items:
+      return {}
+    result=self.call('db_paste',{'paths':[path for path,val in items],
+                                 'values':[_from_text(val) for path,val in items]})
+    return dict((path,'db_paste status '+str(status))
+                for (path,val),status in zip(items,result['status']) if status!=1)
+
+  def transition(self,which):
+    result=self.call('cm_transition',{'transition':which})
+    if result.get('status')!=1:
+      raise JSONRPCError(which+' failed: '+str(result.get('error_string',result)))
+    return ''
+
+  def runstart(self):
+    return self.transition('TR_START')
+
+  def runstop(self):
+    return self.transition('TR_STOP')
+
+  def close(self):
+    pass
+
+#A dictionary standing in for the ODB, keyed by full path
+#Array keys hold lists; 'path[i]' reads and writes their elements
+#latency (s) is added to every call to mimic a slower backend
+class MemoryBackend(object):
+  name='memory'
+
+  def __init__(self,values=None,latency=0.0):
+    self.values=dict(values or {})
+    self.latency=latency
+    self.values.setdefault('/Runinfo/State',STATE_STOPPED)
+    self.values.setdefault('/Runinfo/Run number',0)
+    self.lock=threading.Lock()
+
+  def _wait(self):
+    if self.latency:
+      time.sleep(self.latency)
+
+  def _get(self,path):
+    if path in self.values:
+      return self.values[path]
+    m=_index.match(path)
+    if m and isinstance(self.values.get(m.group(1)),list):
+      array=self.values[m.group(1)]
+      if int(m.group(2))<len(array):
+        return array[int(m.group(2))]
+    raise KeyError(path)
+
+  def _set(self,path,val):
+    m=_index.match(path)
+    if m and isinstance(self.values.get(m.group(1)),list):
+      array=self.values[m.group(1)]
+      if int(m.group(2))>=len(array):
+        return 'index '+m.group(2)+' out of range for '+m.group(1)
+      array[int(m.group(2))]=val
+    else:
+      self.values[path]=val
+
+  def read(self,path):
+    self._wait()
+    with self.lock:
+      try:
+        return _to_text(self._get(path))
+      except KeyError:
+        return 'key '+path+' not found'
+
+  def read_values(self,paths):
+    self._wait()
+    with self.lock:
+      return [self._get(path) for path in paths]
+
+  def read_tree(self,path):
+    self._wait()
+    prefix=path.rstrip('/')+'/'
+    tree={}
+    with self.lock:
+      for key,val in self.values.items():
+        if key.startswith(prefix):
+          parts=key[len(prefix):].split('/')
+          node=tree
+          for part in parts[:-1]:
+            node=node.setdefault(part,{})
+          node[parts[-1]]=list(val) if isinstance(val,list) else val
+    if not tree:
+      raise KeyError(path)
+    return tree
+
+  def write_many(self,items):
+    self._wait()
+    failed={}
+    with self.lock:
+      for path,val in items:
+        error=self._set(path,_from_text(val))
+        if error:
+          failed[path]=error
+    return failed
+
+  def runstart(self):
+    self._wait()
+    with self.lock:
+      if self.values['/Runinfo/State']!=STATE_RUNNING:
+        self.values['/Runinfo/State']=STATE_RUNNING
+        self.values['/Runinfo/Run number']+=1
+    return ''
+
+  def runstop(self):
+    self._wait()
+    with self.lock:
+      self.values['/Runinfo/State']=STATE_STOPPED
+    return ''
+
+  def close(self):
+    pass
+
+#Wraps another backend and remembers the last known value of every key
+#  - repeat reads within ttl seconds are answered locally
+#  - writes of the value a key already holds are skipped
+#  - everything is forgotten on runstart/runstop or invalidate()
+#The counters in stats() show how many round trips were saved.
+#Changes made to the ODB by other programs go unnoticed for up to ttl seconds.
+class CachedBackend(object):
+  def __init__(self,inner,ttl=CACHE_TTL):
+    self.inner=inner
+    self.name=inner.name+'+cache'
+    self.ttl=ttl
+    self.lock=threading.Lock()
+    self.entries={}
+    self.counts={'hits':0,'misses':0,'writes':0,'skipped':0}
+
+  #Forget path (and its array elements), or everything if path is None
+  def invalidate(self,path=None):
+    with self.lock:
+      if path is None:
+        self.entries.clear()
+        return
+      base=_index.sub(r'\1',path)
+      for key in list(self.entries):
+        if key==path or key==base or _index.sub(r'\1',key)==base:
+          del self.entries[key]
+
+  def stats(self):
+    with self.lock:
+      return dict(self.counts)
+
+  #Cached entry for path that has the given field, or None
+  def _lookup(self,path,field):
+    entry=self.entries.get(path)
+    if entry is None or field not in entry or time.time()-entry['time']>self.ttl:
+      return None
+    return entry
+
+  def read(self,path):
+    with self.lock:
+      entry=self._lookup(path,'text')
+      if entry is not None:
+        self.counts['hits']+=1
+        return entry['text']
+      self.counts['misses']+=1
+    out=self.inner.read(path)
+    if not _missing.match(out):
+      with self.lock:
+        self.entries[path]={'text':out,'time':time.time()}
+    return out
+
+  def read_values(self,paths):
+    values={}
+    with self.lock:
+      for path in paths:
+        entry=self._lookup(path,'value')
+        if entry is not None:
+          values[path]=entry['value']
+      todo=[path for path in paths if path not in values]
+      self.counts['hits']+=len(paths)-len(todo)
+      self.counts['misses']+=len(todo)
+    if todo:
+      fetched=self.inner.read_values(todo)
+      now=time.time()
+      with self.lock:
+        for path,val in zip(todo,fetched):
+          values[path]=val
+          self.entries[path]={'value':val,'text':_to_text(val),'time':now}
+    return [values[path] for path in paths]
+
+  def read_tree(self,path):
+    return self.inner.read_tree(path)
+
+  def write_many(self,items):
+    with self.lock:
+      todo=[]
+      for path,val in items:
+        entry=self._lookup(path,'text')
+        if entry is not None and entry['text']==val:
+          self.counts['skipped']+=1
+        else:
+          todo.append((path,val))
+      self.counts['writes']+=len(todo)
+    if not todo:
+      return {}
+    for path,val in todo:
+      self.invalidate(path)
+    failed=self.inner.write_many(todo)
+    now=time.time()
+    with self.lock:
+      for path,val in todo:
+        if path not in failed:
+          self.entries[path]={'text':val,'time':now}
+    return failed
+
+  def runstart(self):
+    self.invalidate()
+    return self.inner.runstart()
+
+  def runstop(self):
+    self.invalidate()
+    return self.inner.runstop()
+
+  def close(self):
+    self.inner.close()
+
+#What the tracer records for every ODB call
+#op = read/read_values/read_tree/write/runstart/runstop, path = key (or list of
+#keys for a batch), value = value written or read, start = time.time(),
+#duration in s, backend name, outcome = 'ok' or what went wrong, phase = the
+#scan phase the call was made in (see phase())
+Call=collections.namedtuple('Call',['op','path','value','start','duration','backend','outcome','phase'])
+
+_phase=contextvars.ContextVar('pyodbedit_phase',default='')
+
+#Label the ODB calls made from here on (in this thread or asyncio task) with name
+def set_phase(name):
+  return _phase.set(name)
+
+#...or only for the calls made inside a with block
+@contextlib.contextmanager
+def phase(name):
+  token=_phase.set(name)
+  try:
+    yield
+  finally:
+    _phase.reset(token)
+
+#Wraps another backend and records every call it makes as a Call
+#The last size calls are kept in memory (calls). With a file they are also
+#streamed to it: as JSON lines, or as a Chrome trace (chrome://tracing,
+#ui.perfetto.dev) if the file name ends in .json
+class TracedBackend(object):
+  def __init__(self,inner,size=TRACE_SIZE,filename=None):
+    self.inner=inner
+    self.name=inner.name
+    self.calls=collections.deque(maxlen=size)
+    self.lock=threading.Lock()
+    self.file=None
+    self.chrome=False
+    if filename:
+      self.file=open(filename,'w')
+      self.chrome=filename.lower().endswith('.json')
+      if self.chrome:
+        self.file.write('[\n')
+      self.first=True
+
+  def _record(self,call):
+    with self.lock:
+      self.calls.append(call)
+      if self.file is None:
+        return
+      if not self.chrome:
+        self.file.write(json.dumps(call._asdict())+'\n')
+      else:
+        paths=call.path if isinstance(call.path,list) else [call.path]
+        event={'name':call.op+(' '+paths[0] if paths[0] else '')+(' +'+str(len(paths)-1) if len(paths)>1 else ''),
+               'cat':call.phase or 'none','ph':'X','ts':int(call.start*1e6),'dur':int(call.duration*1e6),
+               'pid':os.getpid(),'tid':threading.current_thread().name,
+               'args':{'path':call.path,'value':call.value,'backend':call.backend,'outcome':call.outcome}}
+        self.file.write(('' if self.first else ',\n')+json.dumps(event))
+        self.first=False
+      self.file.flush()
+
+  #Run fn(*args), recording it. outcome(result) says how it went.
+  def _call(self,op,path,value,fn,args,outcome=lambda result: 'ok',result_value=None):
+    start=time.time()
+    t0=time.monotonic()
+    try:
+      result=fn(*args)
+    except Exception as e:
+      self._record(Call(op,path,value,start,time.monotonic()-t0,self.name,type(e).__name__+': '+str(e),_phase.get()))
+      raise
+    if result_value is not None:
+      value=result_value(result)
+    self._record(Call(op,path,value,start,time.monotonic()-t0,self.name,outcome(result),_phase.get()))
+    return result
+
+  def read(self,path):
+    return self._call('read',path,None,self.inner.read,(path,),
+                      lambda out: 'missing' if _missing.match(out) else 'ok',lambda out: out)
+
+  def read_values(self,paths):
+    paths=list(paths)
+    if not paths:
+      return []
+    return self._call('read_values',paths if len(paths)>1 else paths[0],None,self.inner.read_values,(paths,),
+                      result_value=lambda values: values if len(values)>1 else values[0])
+
+  def read_tree(self,path):
+    return self._call('read_tree',path,None,self.inner.read_tree,(path,))
+
+  def write_many(self,items):
+    items=list(items)
+    if not items:
+      return {}
+    paths=[path for path,val in items]
+    values=[val for path,val in items]
+    return self._call('write',paths if len(paths)>1 else paths[0],values if len(values)>1 else values[0],
+                      self.inner.write_many,(items,),
+                      lambda failed: 'failed: '+'; '.join(path+': '+failed[path] for path in failed) if failed else 'ok')
+
+  def runstart(self):
+    return self._call('runstart','',None,self.inner.runstart,(),lambda out: 'ok' if not out else out)
+
+  def runstop(self):
+    return self._call('runstop','',None,self.inner.runstop,(),lambda out: 'ok' if not out else out)
+
+  def close_file(self):
+    with self.lock:
+      if self.file is not None:
+        if self.chrome:
+          self.file.write('\n]\n')
+        self.file.close()
+        self.file=None
+
+  def close(self):
+    self.close_file()
+    self.inner.close()
+
+class GatewayError(Exception):
+  pass
+
+#Talk to the ODB through a pyODBgateway process on a Unix socket
+#Requests and replies are JSON objects, one per line. Each thread gets its own
+#connection, so calls from several threads are queued at the gateway together
+#(and their writes can be merged there).
+class GatewayBackend(object):
+  name='gateway'
+
+  def __init__(self,path=None,timeout=COMMAND_TIMEOUT+TRANSITION_TIMEOUT):
+    self.path=path or GATEWAY_SOCKET
+    self.timeout=timeout
+    self.local=threading.local()
+    self.lock=threading.Lock()
+    self.connections=[]
+    #Fail now, rather than on the first call, if there is no gateway
+    self._connection()
+
+  def _connection(self):
+    conn=getattr(self.local,'conn',None)
+    if conn is None:
+      sock=self._connect()
+      conn=(sock,sock.makefile('rw'))
+      self.local.conn=conn
+      with self.lock:
+        self.connections.append(conn)
+    return conn
+
+  #Connect, retrying for a while if the gateway's backlog is full
+  #(EAGAIN) or it is refusing connections (e.g. just starting up)
+  def _connect(self):
+    wait=GATEWAY_BACKOFF
+    for attempt in range(GATEWAY_RETRIES):
+      sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+      sock.settimeout(self.timeout)
+      try:
+        sock.connect(self.path)
+        return sock
+      except (BlockingIOError,ConnectionRefusedError):
+        sock.close()
+        if attempt==GATEWAY_RETRIES-1:
+          raise
+      except OSError:
+        sock.close()
+        raise
+      time.sleep(wait)
+      wait*=2
+
+  def _drop(self):
+    conn=getattr(self.local,'conn',None)
+    self.local.conn=None
+    if conn is not None:
+      with self.lock:
+        if conn in self.connections:
+          self.connections.remove(conn)
+      conn[0].close()
+
+  def call(self,op,**args):
+    sock,f=self._connection()
+    try:
+      f.write(json.dumps(dict(args,op=op))+'\n')
+      f.flush()
+      line=f.readline()
+    except (OSError,socket.error) as e:
+      self._drop()
+      raise GatewayError(op+': '+str(e))
+    if not line:
+      self._drop()
+      raise GatewayError(op+': the gateway closed the connection')
+    reply=json.loads(line)
+    if 'error' in reply:
+      if reply.get('type')=='KeyError':
+        raise KeyError(reply['error'])
+      if reply.get('type') in ('OdbeditError','OdbeditTimeout'):
+        raise OdbeditError(reply['error'])
+      raise GatewayError(op+': '+reply['error'])
+    return reply['result']
+
+  def read(self,path):
+    return self.call('read',path=path)
+
+  def read_values(self,paths):
+    return self.call('read_values',paths=list(paths))
+
+  def read_tree(self,path):
+    return self.call('read_tree',path=path)
+
+  def write_many(self,items):
+    if not items:
+      return {}
+    return self.call('write_many',items=[[path,val] for path,val in items])
+
+  def runstart(self):
+    return self.call('runstart')
+
+  def runstop(self):
+    return self.call('runstop')
+
+  #The gateway's queue depth, latencies and counts
+  def metrics(self):
+    return self.call('metrics')
+
+  def close(self):
+    with self.lock:
+      connections,self.connections=self.connections,[]
+    for sock,f in connections:
+      sock.close()
+
+BACKENDS={'odbedit':OdbeditBackend,'midas':MidasBackend,'jsonrpc':JSONRPCBackend,'memory':MemoryBackend,
+          'gateway':GatewayBackend}
+
+_backend=None
+_backend_lock=threading.Lock()
+
+#Whether path is a socket belonging to this user. Anyone else's socket there
+#is never used automatically, as all our ODB traffic would go through it.
+def _own_socket(path):
+  try:
+    st=os.stat(path)
+  except OSError:
+    return False
+  return stat.S_ISSOCK(st.st_mode) and st.st_uid==os.getuid()
+
+#Pick the gateway if one of ours is running, else the fastest backend that is available here
+def _auto_backend():
+  name=os.environ.get('PYODBEDIT_BACKEND')
+  if name:
+    return BACKENDS[name]()
+  if _own_socket(GATEWAY_SOCKET):
+    try:
+      return GatewayBackend()
+    except Exception:
+      pass
+  return direct_backend()
+
+#The fastest backend talking to the ODB itself (not through a gateway)
+def direct_backend():
+  try:
+    return MidasBackend()
+  except Exception:
+    pass
+  if MHTTPD_URL:
+    return JSONRPCBackend()
+  return OdbeditBackend()
+
+#the backend in use, choosing one if needed
+def backend():
+  global _backend
+  with _backend_lock:
+    if _backend is None:
+      _backend=_auto_backend()
+    return _backend
+
+#use a specific backend (an instance, or one of the names in BACKENDS)
+def set_backend(new):
+  global _backend
+  if isinstance(new,str):
+    new=BACKENDS[new]()
+  with _backend_lock:
+    old,_backend=_backend,new
+  #don't close a backend that is just gaining or losing a cache in front of it
+  if old is not None and old is not new and new is not getattr(old,'inner',None) \
+     and old is not getattr(new,'inner',None):
+    old.close()
+  return new
+
+#Put a CachedBackend in front of the current backend
+#The scan scripts turn this on so that settings a scan writes again unchanged
+#(the series duration at every point, the 15V power put back after each
+#flash...) don't cost an ODB write each time
+def enable_cache(ttl=CACHE_TTL):
+  current=backend()
+  if isinstance(current,CachedBackend):
+    current.ttl=ttl
+    return current
+  return set_backend(CachedBackend(current,ttl))
+
+#Go back to talking to the backend directly
+def disable_cache():
+  current=backend()
+  if isinstance(current,CachedBackend):
+    set_backend(current.inner)
+
+#Forget cached values for path, or for everything
+def invalidate(path=None):
+  current=backend()
+  if isinstance(current,CachedBackend):
+    current.invalidate(path)
+
+#hits/misses/writes/skipped counts from the cache ({} if it isn't enabled)
+def cache_stats():
+  current=backend()
+  if isinstance(current,CachedBackend):
+    return current.stats()
+  return {}
+
+#close the backend's connections
+def close():
+  with _backend_lock:
+    if _backend is not None:
+      _backend.close()
+
+atexit.register(close)
+
+#The TracedBackend in use, or None
+def _tracer():
+  current=backend()
+  while current is not None:
+    if isinstance(current,TracedBackend):
+      return current
+    current=getattr(current,'inner',None)
+  return None
+
+#Record every call to the ODB (see TracedBackend)
+#The tracer sits underneath the cache, if there is one, so it sees the calls
+#that actually reach the ODB. filename streams the calls to a file as well.
+def enable_trace(filename=None,size=TRACE_SIZE):
+  disable_trace()
+  current=backend()
+  if isinstance(current,CachedBackend):
+    current.inner=TracedBackend(current.inner,size,filename)
+    return current.inner
+  return set_backend(TracedBackend(current,size,filename))
+
+#Stop recording (closing any trace file)
+def disable_trace():
+  tracer=_tracer()
+  if tracer is None:
+    return
+  tracer.close_file()
+  current=backend()
+  if current is tracer:
+    set_backend(tracer.inner)
+  else:
+    current.inner=tracer.inner
+
+#The recorded calls, oldest first ([] if tracing isn't enabled)
+def trace_calls():
+  tracer=_tracer()
+  if tracer is None:
+    return []
+  with tracer.lock:
+    return list(tracer.calls)
+
+#Read the calls back from a trace file written by enable_trace
+def load_trace(filename):
+  with open(filename,'r') as f:
+    text=f.read()
+  if text.lstrip().startswith('['):
+    text=text.strip()
+    if not text.endswith(']'):
+      text=text.rstrip(',')+']'
+    return [Call(event['name'].split(' ')[0],event['args']['path'],event['args']['value'],event['ts']/1e6,
+                 event['dur']/1e6,event['args']['backend'],event['args']['outcome'],
+                 '' if event['cat']=='none' else event['cat']) for event in json.loads(text)]
+  calls=[]
+  for line in text.splitlines():
+    try:
+      calls.append(Call(**json.loads(line)))
+    except (ValueError,TypeError):
+      pass
+  return calls
+
+#Nearest-rank percentile of a sorted list
+def percentile(values,p):
+  if not values:
+    return 0.0
+  return values[min(len(values)-1,max(0,int(math.ceil(p/100.0*len(values)))-1))]
+
+#Summarise traced calls (the ones in memory if calls is None)
+#Returns {'paths': {path: stats}, 'ops': {op: stats}, 'phases': {phase: stats}}
+#where stats is a dict of calls, failures, total s, p50 s, p99 s and max s.
+#A batch counts as a call for every path in it.
+def trace_summary(calls=None):
+  if calls is None:
+    calls=trace_calls()
+  groups={'paths':collections.defaultdict(list),'ops':collections.defaultdict(list),
+          'phases':collections.defaultdict(list)}
+  for call in calls:
+    for path in (call.path if isinstance(call.path,list) else [call.path]):
+      groups['paths'][path or call.op].append(call)
+    groups['ops'][call.op].append(call)
+    groups['phases'][call.phase or 'none'].append(call)
+  summary={}
+  for group,members in groups.items():
+    summary[group]={}
+    for key,grouped in members.items():
+      durations=sorted(call.duration for call in grouped)
+      summary[group][key]={'calls':len(grouped),'failures':sum(1 for call in grouped if call.outcome!='ok'),
+                           'total':sum(durations),'p50':percentile(durations,50),
+                           'p99':percentile(durations,99),'max':durations[-1]}
+  return summary
+
+#Print trace_summary() as tables, the top paths by time spent on them first
+def print_trace_summary(calls=None,top=20):
+  summary=trace_summary(calls)
+  for group,title in (('phases','phase'),('ops','call'),('paths','path')):
+    rows=sorted(summary[group].items(),key=lambda item: -item[1]['total'])
+    if group=='paths':
+      rows=rows[:top]
+    print('%-60s %7s %5s %9s %9s %9s %9s'%(title,'calls','fail','total s','p50 ms','p99 ms','max ms'))
+    for key,stats in rows:
+      print('%-60s %7d %5d %9.2f %9.1f %9.1f %9.1f'%(key[-60:],stats['calls'],stats['failures'],stats['total'],
+            1000*stats['p50'],1000*stats['p99'],1000*stats['max']))
+    print('')
+
+#Flatten a read_tree result into {full path: value}
+def _flatten(path,tree):
+  values={}
+  for key,val in tree.items():
+    if isinstance(val,dict):
+      values.update(_flatten(path+'/'+key,val))
+    else:
+      values[path+'/'+key]=val
+  return values
+
+#Keeps an eye on some ODB keys and calls callback({path: (old, new)}) with the
+#ones that changed. A path ending in '/' watches everything under it.
+#Uses hotlinks if the backend has them (midas). Otherwise a thread reads all
+#the keys every period s, in one batch plus one read_tree per subtree, and
+#compares them with the last values seen. Keys that disappear are not reported.
+#The callback is run in the hotlink or polling thread.
+class Watch(object):
+  def __init__(self,paths,callback,period=WATCH_PERIOD):
+    self.paths=list(paths)
+    self.keys=[path for path in self.paths if not path.endswith('/')]
+    self.trees=[path.rstrip('/') for path in self.paths if path.endswith('/')]
+    self.callback=callback
+    self.period=period
+    self.values=None
+    self.lock=threading.Lock()
+    self.stopping=threading.Event()
+    self.thread=None
+    self.native=None
+    self.errors=0
+
+  #Read all the watched keys, straight from the ODB. Missing keys read as None,
+  #and so does a missing subtree (under its own path)
+  def read(self):
+    current=_uncached()
+    values={}
+    try:
+      if self.keys:
+        values.update(zip(self.keys,current.read_values(self.keys)))
+    except KeyError:
+      for path in self.keys:
+        try:
+          values[path]=current.read_values([path])[0]
+        except KeyError:
+          values[path]=None
+    for tree in self.trees:
+      try:
+        values.update(_flatten(tree,current.read_tree(tree)))
+      except KeyError:
+        values[tree]=None
+    return values
+
+  #Compare values with the last ones seen, and report the differences
+  #The first values seen are just remembered
+  def update(self,values):
+    with self.lock:
+      if self.values is None:
+        self.values=dict(values)
+        return {}
+      changes=dict((path,(self.values.get(path),val)) for path,val in values.items()
+                   if self.values.get(path)!=val)
+      self.values.update(values)
+    if changes:
+      self.callback(changes)
+    return changes
+
+  def poll(self):
+    return self.update(self.read())
+
+  def _hotlink(self,path,value):
+    self.update(_flatten(path,value) if isinstance(value,dict) else {path:value})
+
+  def _run(self):
+    while not self.stopping.wait(self.period):
+      try:
+        self.poll()
+      except Exception as e:
+        self.errors+=1
+        print('****Watch failed: '+str(e)+'****')
+
+  def start(self):
+    self.poll()
+    current=backend()
+    while current is not None and not hasattr(current,'watch'):
+      current=getattr(current,'inner',None)
+    if current is not None:
+      self.native=current
+      for path in self.paths:
+        current.watch(path.rstrip('/'),self._hotlink)
+    else:
+      self.thread=threading.Thread(target=self._run,name='pyodbedit watch')
+      self.thread.daemon=True
+      self.thread.start()
+    return self
+
+  def stop(self):
+    if self.native is not None:
+      for path in self.paths:
+        self.native.unwatch(path.rstrip('/'))
+      self.native=None
+    self.stopping.set()
+    if self.thread is not None:
+      self.thread.join()
+      self.thread=None
+
+#Start watching paths, calling callback({path: (old, new)}) when any of them change
+#Returns the Watch; call its stop() when done
+#  w=pyodbedit.watch(['/Runinfo/State','/Equipment/Tower01/Variables/'],print)
+def watch(paths,callback,period=WATCH_PERIOD):
+  return Watch(paths,callback,period).start()
+
+#read from the odb, as the text odbedit would print
 def read(path):
-  return os.popen('odbedit -c \'ls -v \"'+path+'\"\'').read().strip()
+  return backend().read(path)
+
+#read a key as a python value: bool, int, float, str, or a list for array keys
+#fresh reads straight from the ODB, never from the cache (e.g. for monitor readbacks)
+#Raises KeyError if the key doesn't exist
+def read_value(path,fresh=False):
+  return (_uncached() if fresh else backend()).read_values([path])[0]
+
+#read several keys in one round trip, returning their values in order
+#fresh reads straight from the ODB, never from the cache
+def read_values(paths,fresh=False):
+  return (_uncached() if fresh else backend()).read_values(list(paths))
+
+#read a whole subtree in one call, as a nested dict
+#e.g. read_tree('/Equipment/Tower01/Settings')['DCRC3']['LED']['Enable15VPower']
+def read_tree(path):
+  return backend().read_tree(path)
 
 #write to the odb
+#val can be odbedit text ('y', '1.5') or a python value (True, 1.5)
 def write(path,val):
-  return os.popen('odbedit -c \'set \"'+path+'\" '+val+'\'').read().strip()
+  failed=backend().write_many([(path,_to_text(val))])
+  return failed.get(path,'')
+
+#write several keys in a single round trip
+#values is a {path: value} dict (or a list of (path, value) pairs)
+#Returns {path: message} for the keys that failed; empty if all went through
+def write_many(values):
+  items=list(values.items()) if hasattr(values,'items') else list(values)
+  return backend().write_many([(path,_to_text(val)) for path,val in items])
+
+#Queue up writes and send them together with write_many when the block exits
+#  with pyodbedit.Transaction() as t:
+#    t.write(path1,'y')
+#    t.write(path2,'n')
+#  t.failures -> {path: message} for any keys that failed
+class Transaction(object):
+  def __init__(self):
+    self.pending=[]
+    self.failures={}
+
+  def write(self,path,val):
+    self.pending.append((path,val))
+
+  def flush(self):
+    pending,self.pending=self.pending,[]
+    self.failures.update(write_many(pending))
+    return self.failures
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,exc_type,exc,tb):
+    if exc_type is None:
+      self.flush()
+    return False
+
+#Raised when a run doesn't start or stop in time
+class TransitionError(Exception):
+  pass
+
+#What runstart/runstop return
+#run = run number, latency = s from issuing the command to seeing the new state,
+#confirmed = time.monotonic() when the new state was seen, output = backend output
+Transition=collections.namedtuple('Transition',['run','latency','confirmed','output'])
+
+#The backend without the cache in front, for reads that must be fresh
+def _uncached():
+  current=backend()
+  if isinstance(current,CachedBackend):
+    current=current.inner
+  return current
+
+#Read run info straight from the ODB, never from the cache
+def _runinfo():
+  return _uncached().read_values(['/Runinfo/State','/Runinfo/Run number'])
+
+#Issue a transition and poll until done(state, run number) is true
+def _transition(issue,done,what,timeout):
+  t0=time.monotonic()
+  out=issue()
+  deadline=t0+timeout
+  while True:
+    state,run=_runinfo()
+    if done(state,run):
+      now=time.monotonic()
+      return Transition(run,now-t0,now,out)
+    if time.monotonic()>deadline:
+      raise TransitionError(what+' did not happen within '+str(timeout)+' s (state '+str(state)+')'
+                            +(': '+out if out else ''))
+    time.sleep(TRANSITION_POLL)
 
 #start a new run
-def runstart():
-  #return os.popen('odbedit -c "start now"').read().strip() #What does now do?
-  return os.popen('odbedit -c start').read().strip()
+#Blocks until /Runinfo/State says a new run is going
+#Returns a Transition with the new run number and how long the start took
+def runstart(timeout=TRANSITION_TIMEOUT):
+  state,before=_runinfo()
+  if state==STATE_RUNNING:
+    raise TransitionError('run '+str(before)+' is already in progress')
+  return _transition(backend().runstart,lambda state,run: state==STATE_RUNNING and run!=before,
+                     'Start of run '+str(before+1),timeout)
 
 #stop the current run
-def runstop():
-  return os.popen('odbedit -c stop').read().strip()
+#Blocks until /Runinfo/State says the run has stopped
+#Returns a Transition with the stopped run's number and how long the stop took
+def runstop(timeout=TRANSITION_TIMEOUT):
+  state,run=_runinfo()
+  if state==STATE_STOPPED:
+    return Transition(run,0.0,time.monotonic(),'')
+  return _transition(backend().runstop,lambda state,run: state==STATE_STOPPED,
+                     'Stop of run '+str(run),timeout)
+
+#python pyodbedit.py trace.jsonl prints the summary of a trace file
+if __name__ == "__main__":
+  import sys
+  if len(sys.argv)<2:
+    sys.exit('usage: '+sys.argv[0]+' <trace file (.jsonl or Chrome trace .json)>')
+  print_trace_summary(load_trace(sys.argv[1]))
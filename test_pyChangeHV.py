@@ -0,0 +1,160 @@
+#Tests for pyChangeHV's calibration tables and ramps against the simulated ODB
+
+import os
+import re
+import time
+import pytest
+
+import pyodbedit
+import pyChangeHV
+import pyODBpaths
+
+BIAS=pyODBpaths.path(1,'chargeBias',0)
+
+def _write(tmp_path,text,name='cal.txt'):
+	path=str(tmp_path/name)
+	with open(path,'w') as f:
+		f.write(text)
+	return path
+
+def test_cal_table_interpolates_both_ways(calFile):
+	cals=pyChangeHV.loadCalTable(calFile)
+	assert len(cals)==11
+	assert cals.setting(30.0)==pytest.approx(1.5)
+	assert list(cals.setting([0.0,50.0,100.0]))==pytest.approx([0.0,2.5,5.0])
+	assert cals.HV(1.5)==pytest.approx(30.0)
+
+def test_cal_table_is_sorted_by_HV():
+	cals=pyChangeHV.CalTable([2.0,0.0,1.0],[40.0,0.0,20.0])
+	assert list(cals.HVs)==[0.0,20.0,40.0]
+	assert list(cals.settings)==[0.0,1.0,2.0]
+
+def test_cal_table_can_fall_with_HV():
+	cals=pyChangeHV.CalTable([5.0,0.0],[0.0,100.0])
+	assert cals.setting(20.0)==pytest.approx(4.0)
+	assert cals.HV(4.0)==pytest.approx(20.0)
+
+def test_cal_table_rejects_bad_tables():
+	with pytest.raises(pyChangeHV.CalibrationError):
+		pyChangeHV.CalTable([0.0],[0.0])
+	with pytest.raises(pyChangeHV.CalibrationError):
+		pyChangeHV.CalTable([0.0,1.0,2.0],[0.0,20.0,20.0])
+	with pytest.raises(pyChangeHV.CalibrationError):
+		pyChangeHV.CalTable([0.0,2.0,1.0],[0.0,20.0,40.0])
+
+def test_HV_outside_the_calibration(calFile):
+	cals=pyChangeHV.loadCalTable(calFile)
+	with pytest.raises(pyChangeHV.CalibrationError):
+		cals.setting(100.5)
+	with pytest.raises(pyChangeHV.CalibrationError):
+		pyChangeHV.calcBiasSetting([10.0,-1.0],cals)
+
+def test_old_style_tables_still_work():
+	assert pyChangeHV.calcBiasSetting(10.0,[[0.0,0.0],[1.0,20.0]])==pytest.approx(0.5)
+
+def test_cal_file_header_and_blank_lines(tmp_path):
+	path=_write(tmp_path,'DCRC setting\tHV\n0\t0\n\n1\t20\n')
+	assert len(pyChangeHV.loadCalTable(path))==2
+
+def test_cal_file_with_a_bad_line(tmp_path):
+	path=_write(tmp_path,'DCRC setting\tHV\n0\t0\n1 20\n')
+	with pytest.raises(pyChangeHV.CalibrationError) as e:
+		pyChangeHV.loadCalTable(path)
+	assert 'line 3' in str(e.value)
+
+def test_cal_file_is_reloaded_when_it_changes(tmp_path):
+	path=_write(tmp_path,'0\t0\n1\t20\n')
+	cals=pyChangeHV.loadCalTable(path)
+	assert pyChangeHV.loadCalTable(path) is cals
+	_write(tmp_path,'0\t0\n1\t40\n')
+	os.utime(path,(0,os.path.getmtime(path)+10))
+	assert pyChangeHV.loadCalTable(path).HV(1.0)==pytest.approx(40.0)
+
+def test_ramp_outside_the_calibration_changes_nothing(sim,calFile):
+	cals=pyChangeHV.loadCalTable(calFile)
+	with pytest.raises(pyChangeHV.CalibrationError):
+		pyChangeHV.changeHVFromTo(1,0.0,200.0,100.0,0.05,cals)
+	assert sim.counts['writes']==0
+
+def test_ramp_stops_at_a_failed_write(sim,calFile):
+	sim.failPaths=re.compile('DCRC1/Charge')
+	cals=pyChangeHV.loadCalTable(calFile)
+	with pytest.raises(pyodbedit.OdbeditError) as e:
+		pyChangeHV.changeHVFromTo(1,0.0,20.0,100.0,0.05,cals)
+	assert BIAS in str(e.value)
+	assert sim.counts['writes']==1
+	assert pyodbedit.read_value(BIAS)==0.0
+
+def test_schedule_steps_at_the_rate():
+	schedule=pyChangeHV.rampSchedule(0.0,10.0,2.0,1.0)
+	assert schedule==[(0.0,2.0),(1.0,4.0),(2.0,6.0),(3.0,8.0),(4.0,10.0)]
+
+def test_schedule_lands_on_the_end():
+	schedule=pyChangeHV.rampSchedule(0.0,5.0,2.0,1.0)
+	assert [HV for t,HV in schedule]==[2.0,4.0,5.0]
+
+def test_schedule_ramps_down():
+	schedule=pyChangeHV.rampSchedule(10.0,4.0,3.0,0.5)
+	assert [HV for t,HV in schedule]==[8.5,7.0,5.5,4.0]
+	assert [t for t,HV in schedule]==[0.0,0.5,1.0,1.5]
+
+def test_schedule_has_no_rounding_step():
+	#1.1/0.1 comes out a little over 11 in floating point
+	assert len(pyChangeHV.rampSchedule(0.0,1.1,0.1,1.0))==11
+
+def test_schedule_with_nothing_to_do():
+	assert pyChangeHV.rampSchedule(5.0,5.0,1.0,1.0)==[]
+
+def test_schedule_needs_a_positive_rate():
+	with pytest.raises(ValueError):
+		pyChangeHV.rampSchedule(0.0,10.0,0.0,1.0)
+	with pytest.raises(ValueError):
+		pyChangeHV.rampSchedule(0.0,10.0,1.0,-1.0)
+
+def test_ramp_writes_each_step(sim,calFile):
+	cals=pyChangeHV.loadCalTable(calFile)
+	rampLog=pyChangeHV.changeHVFromTo(1,0.0,20.0,100.0,0.05,cals)
+	assert [HV for t,HV,lag in rampLog]==[5.0,10.0,15.0,20.0]
+	assert sim.counts['writes']==4
+	assert pyodbedit.read_value(BIAS)==pytest.approx(1.0)
+
+#After a slow write the ramp runs late rather than catching up faster
+def test_ramp_never_steps_faster_than_the_period(calFile,monkeypatch):
+	writes=[]
+	def setDCRCQI(iDCRC,V):
+		writes.append(time.monotonic())
+		if len(writes)==1:
+			time.sleep(0.17)
+	monkeypatch.setattr(pyChangeHV,'setDCRCQI',setDCRCQI)
+	schedule=pyChangeHV.rampSchedule(0.0,5.0,10.0,0.1)
+	rampLog=pyChangeHV.runRampSchedule(1,schedule,pyChangeHV.loadCalTable(calFile))
+	assert len(writes)==5
+	gaps=[b-a for a,b in zip(writes,writes[1:])]
+	assert min(gaps)>=0.1-0.002
+	assert rampLog[1][2]==pytest.approx(0.07,abs=0.03)
+
+def test_adaptive_ramp_speeds_up(sim,calFile):
+	cals=pyChangeHV.loadCalTable(calFile)
+	rampLog=pyChangeHV.changeHVFromTo(1,0.0,20.0,10.0,0.05,cals,HVmaxRate=100.0)
+	assert rampLog[-1][1]==20.0
+	#At 10 V/s all the way this would have taken 40 steps
+	assert len(rampLog)<40
+	steps=[b-a for (t,a,lag),(t,b,lag) in zip(rampLog,rampLog[1:])]
+	assert steps[-2]>steps[0]
+
+def test_adaptive_ramp_waits_for_a_slow_readback(sim,calFile):
+	#The readback follows at 0.5 setting units/s = 10 V/s
+	sim.readbackRate=0.5
+	cals=pyChangeHV.loadCalTable(calFile)
+	rampLog=pyChangeHV.changeHVFromTo(1,0.0,10.0,5.0,0.05,cals,HVmaxRate=100.0,tolerance=0.5)
+	assert rampLog[-1][1]==10.0
+	assert pyChangeHV.readHV(1,cals)==pytest.approx(10.0,abs=0.5)
+	steps=[b-a for (t,a,lag),(t,b,lag) in zip(rampLog,rampLog[1:])]
+	assert max(steps)<=100.0*0.05+1e-9
+
+def test_adaptive_ramp_gives_up_on_a_stuck_readback(sim,calFile,monkeypatch):
+	sim.readbackRate=0.0
+	monkeypatch.setattr(pyChangeHV,'SETTLE_TIMEOUT',0.3)
+	cals=pyChangeHV.loadCalTable(calFile)
+	with pytest.raises(pyChangeHV.ReadbackError):
+		pyChangeHV.changeHVFromTo(1,0.0,10.0,5.0,0.05,cals,HVmaxRate=100.0)
@@ -0,0 +1,50 @@
+#Tests for pyFlash's concurrent per-board operations against the simulated ODB
+
+import time
+
+import pyodbedit
+import pyFlash
+import pyODBpaths
+
+BOARDS=[1,2,3,4]
+
+def test_boards_are_done_at_the_same_time(sim):
+	sim.latency=0.1
+	t0=time.monotonic()
+	timing=pyFlash.enableLEDs(BOARDS,1)
+	#One board after another would take 0.4 s
+	assert time.monotonic()-t0<0.3
+	assert sorted(timing)==BOARDS
+	assert pyFlash.lastTiming==timing
+	assert pyFlash.boardSpread()<0.05
+	assert all(pyodbedit.read_value(pyODBpaths.path(board,'enableLED'+led)) is True for board in BOARDS for led in '12')
+
+def test_results_come_back_in_board_order(sim):
+	sim.values[pyODBpaths.path(2,'enable15V')]=True
+	power=pyFlash.get15VPowerEnable(BOARDS)
+	assert power==[False,True,False,False]
+	pyFlash.turn15VPowerEnableOn(BOARDS)
+	assert pyFlash.get15VPowerEnable(BOARDS)==[True]*4
+	pyFlash.set15VPowerEnable(BOARDS,power)
+	assert pyFlash.get15VPowerEnable(BOARDS)==power
+
+def test_boards_on_several_towers(sim):
+	sim.values.update(dict((key.replace('Tower01','Tower02'),val) for key,val in list(sim.values.items()) if 'Tower01' in key))
+	pyFlash.turnQBiasOff(['1','Tower02:1'])
+	pyFlash.enableLEDs(['Tower01:1',('Tower02',1)],1)
+	assert pyodbedit.read_value(pyODBpaths.path('Tower02:1','enableLED2')) is True
+	assert pyodbedit.read_value(pyODBpaths.path('Tower01:1','enableLED2')) is True
+
+def test_board_spread():
+	assert pyFlash.boardSpread({})==0.0
+	assert pyFlash.boardSpread({1:(0.0,1.0),2:(0.0,1.25)})==0.25
+
+#The worker threads label their ODB calls with the caller's trace phase
+def test_workers_keep_the_trace_phase(sim):
+	pyodbedit.enable_trace()
+	try:
+		with pyodbedit.phase('flash'):
+			pyFlash.enableLEDs(BOARDS,0)
+		assert [call.phase for call in pyodbedit.trace_calls()]==['flash']*len(BOARDS)
+	finally:
+		pyodbedit.disable_trace()
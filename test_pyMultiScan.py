@@ -0,0 +1,75 @@
+#Tests for pyMultiScan: several detectors scanned with shared runs
+
+import pytest
+
+import pyodbedit
+import pyODBpaths
+import pyHVscan
+import pyQscan
+import pyScan
+import pyMultiScan
+import pyScanPlan
+
+def _kinds(steps):
+	return [step.kind for step in steps]
+
+def test_settings_are_merged_and_runs_shared(calFile):
+	biases=[pyQscan.QBias(1,2,[[0,0],[5,-5]]),pyQscan.QBias(3,4,[[1,-1],[2,-2]])]
+	steps=pyMultiScan.multiScanSteps(biases,60,[1,2,3,4],nSubSeries=2)
+	#Both Q biases go out in one Settings step per point
+	assert _kinds(steps)==['settings']+['settings','settings','runstart','data','runstop','runstart','data','runstop',
+		'settings','flash','cool']*2+['settings']
+	assert steps[1].values==dict(list(pyQscan.qBiasSettings(1,2,0,0).items())+list(pyQscan.qBiasSettings(3,4,1,-1).items()))
+	assert steps[9].values==dict(list(pyQscan.qBiasSettings(1,2,0,0).items())+list(pyQscan.qBiasSettings(3,4,0,0).items()))
+
+def test_HV_ramps_run_in_parallel(calFile):
+	biases=[pyHVscan.HVBias(1,[10,20],calFile,10.0,0.5),pyHVscan.HVBias(2,[30],calFile,10.0,0.5)]
+	steps=pyMultiScan.multiScanSteps(biases,60,[1,2])
+	setBoth=steps[1]
+	assert isinstance(setBoth,pyScan.Parallel)
+	assert setBoth.kind=='parallel'
+	assert [[step.kind for step in chain] for chain in setBoth.chains]==[['hvpower','ramp'],['hvpower','ramp']]
+	#The longer ramp (0 to 30 V) sets the step's length
+	assert setBoth.duration==5.0+3.0
+	#Point 2 only has the first detector's ramp
+	point2=steps[_kinds(steps).index('cool')+1:]
+	assert _kinds(point2)[:2]==['hvpower','ramp']
+	assert pyScan.Scan(steps).estimate()['runs']==2
+
+def test_drifts_run_alongside_the_data(calFile):
+	biases=[pyHVscan.HVBias(1,[10],calFile,HVdriftRate=0.01,HVdriftUpdatePeriod=10),pyQscan.QBias(3,4,[[1,-1]])]
+	steps=pyMultiScan.multiScanSteps(biases,100,[1])
+	data=[step for step in steps if isinstance(step,pyScan.Parallel) and 'data' in step.describe()]
+	assert len(data)==1
+	assert [[step.kind for step in chain] for chain in data[0].chains]==[['data'],['ramp']]
+
+def test_two_scans_on_one_DCRC(calFile):
+	biases=[pyHVscan.HVBias('Tower01:2',[10],calFile),pyQscan.QBias(1,2,[[0,0]])]
+	with pytest.raises(pyMultiScan.ConflictError):
+		pyMultiScan.multiScanSteps(biases,60,[1])
+	#...but the same DCRC number on another tower is fine
+	pyMultiScan.checkConflicts([pyHVscan.HVBias('Tower02:2',[10],calFile),pyQscan.QBias(1,2,[[0,0]])])
+
+def test_multi_plan(calFile):
+	plan={'type':'multi','tSeries':1,'DCRCs2Flash':[1],'scans':[
+		{'type':'HV','iDCRC':4,'HVs':[0,10],'HVcalFile':calFile,'HVrampRate':10.0},
+		{'type':'Q','DCRC_S1S2':'3/1','Vs':[[0,0],[5,-5]],'DCRCs2Flash':[3]}]}
+	steps=pyScanPlan.compilePlan(plan)
+	assert [step.boards for step in steps if isinstance(step,pyScan.Flash)]==[[1,3]]*2
+	plan['scans'][1]['DCRC_S1S2']='4/1'
+	with pytest.raises(pyScanPlan.PlanError):
+		pyScanPlan.compilePlan(plan)
+
+def test_multi_scan_runs(sim,calFile):
+	biases=[pyHVscan.HVBias(1,[20],calFile,400.0,0.01),pyQscan.QBias(3,4,[[2,-2]])]
+	seen={}
+	class Check(pyScan.Step):
+		async def run(self,scan):
+			seen.update(zip(['HV','Q3','Q4'],pyodbedit.read_values([pyODBpaths.path(1,'chargeBias',0),
+				pyODBpaths.path(3,'chargeBias',0),pyODBpaths.path(4,'chargeBias',1)])))
+	steps=pyMultiScan.multiScanSteps(biases,0.05,[1],FlashDuration=0.01,CoolDuration_sec=0.01)
+	runstart=_kinds(steps).index('runstart')
+	steps.insert(runstart,Check())
+	pyScan.Scan(steps).run()
+	assert seen=={'HV':pytest.approx(1.0),'Q3':2,'Q4':-2}
+	assert pyodbedit.read_value('/Runinfo/Run number')==1
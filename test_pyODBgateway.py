@@ -0,0 +1,206 @@
+#Tests for pyODBgateway against the simulated ODB
+
+import os
+import sys
+import stat
+import time
+import socket
+import threading
+import subprocess
+import pytest
+
+import pyodbedit
+import pyODBsim
+import pyODBgateway
+
+LED='/Equipment/Tower01/Settings/DCRC1/LED/EnableLED1'
+
+#A SimBackend that remembers the order calls reach it in
+class Recorder(pyODBsim.SimBackend):
+	def __init__(self,*args,**kwargs):
+		pyODBsim.SimBackend.__init__(self,*args,**kwargs)
+		self.order=[]
+
+	def read_values(self,paths):
+		self.order.append(('read_values',paths[0]))
+		return pyODBsim.SimBackend.read_values(self,paths)
+
+	def write_many(self,items):
+		self.order.append(('write_many',sorted(path for path,val in items)))
+		return pyODBsim.SimBackend.write_many(self,items)
+
+	def runstart(self):
+		self.order.append(('runstart',''))
+		return pyODBsim.SimBackend.runstart(self)
+
+#Call gateway.submit from a thread for each of requests [(op, args)...], one
+#after another, returning the threads and {index: result}
+def _submitAll(gateway,requests,spacing=0.01):
+	results={}
+	def submit(i,op,args):
+		results[i]=gateway.submit(op,args)
+	threads=[]
+	for i,(op,args) in enumerate(requests):
+		thread=threading.Thread(target=submit,args=(i,op,args))
+		thread.start()
+		threads.append(thread)
+		time.sleep(spacing)
+	return threads,results
+
+def _worker(gateway):
+	worker=threading.Thread(target=gateway.run)
+	worker.daemon=True
+	worker.start()
+	return worker
+
+def test_writes_to_a_key_are_merged():
+	sim=Recorder(pyODBsim.tower(1))
+	gateway=pyODBgateway.Gateway(sim,rate=0,window=0.5)
+	worker=_worker(gateway)
+	threads,results=_submitAll(gateway,[('write_many',{'items':[(LED,val)]}) for val in ('y','n','y','n')])
+	for thread in threads:
+		thread.join()
+	gateway.stop()
+	worker.join()
+	assert sim.order==[('write_many',[LED])]
+	assert sim.values[LED] is False
+	assert results=={0:{},1:{},2:{},3:{}}
+	assert gateway.counts['coalesced']==3
+
+def test_each_writer_gets_its_own_failures():
+	sim=Recorder(pyODBsim.tower(1),failPaths='Playground')
+	gateway=pyODBgateway.Gateway(sim,rate=0,window=0.3)
+	worker=_worker(gateway)
+	threads,results=_submitAll(gateway,[('write_many',{'items':[(LED,'y')]}),
+		('write_many',{'items':[('/Playground/time','5')]})])
+	for thread in threads:
+		thread.join()
+	gateway.stop()
+	worker.join()
+	assert results[0]=={}
+	assert list(results[1])==['/Playground/time']
+
+def test_run_control_goes_first():
+	sim=Recorder(pyODBsim.tower(1))
+	gateway=pyODBgateway.Gateway(sim,rate=0,window=0.0)
+	#Queue everything before the gateway starts making calls
+	threads,results=_submitAll(gateway,[('read_values',{'paths':[LED]}),('read_values',{'paths':['/Playground/time']}),
+		('runstart',{}),('read_values',{'paths':['/Runinfo/State']})])
+	while len(gateway.queue)<4:
+		time.sleep(0.01)
+	worker=_worker(gateway)
+	for thread in threads:
+		thread.join()
+	gateway.stop()
+	worker.join()
+	assert sim.order==[('runstart',''),('read_values','/Runinfo/State'),
+		('read_values',LED),('read_values','/Playground/time')]
+
+def test_reads_queued_before_a_write_batch_go_first():
+	sim=Recorder(pyODBsim.tower(1))
+	gateway=pyODBgateway.Gateway(sim,rate=0,window=0.0)
+	threads,results=_submitAll(gateway,[('read_values',{'paths':[LED]}),('write_many',{'items':[(LED,'y')]}),
+		('read_values',{'paths':['/Playground/time']})])
+	worker=_worker(gateway)
+	for thread in threads:
+		thread.join()
+	gateway.stop()
+	worker.join()
+	assert [op for op,path in sim.order]==['read_values','write_many','read_values']
+	assert results[0]==[False]
+
+def test_rate_limit():
+	sim=pyODBsim.SimBackend(pyODBsim.tower(1))
+	gateway=pyODBgateway.Gateway(sim,rate=20,window=0.0)
+	worker=_worker(gateway)
+	t0=time.monotonic()
+	for i in range(5):
+		gateway.submit('read_values',{'paths':[LED]})
+	dt=time.monotonic()-t0
+	gateway.stop()
+	worker.join()
+	assert dt>=4*0.05-0.01
+
+def test_metrics():
+	sim=pyODBsim.SimBackend(pyODBsim.tower(1))
+	gateway=pyODBgateway.Gateway(sim,rate=0,window=0.0)
+	worker=_worker(gateway)
+	for i in range(3):
+		gateway.submit('read_values',{'paths':[LED]})
+	with pytest.raises(KeyError):
+		gateway.submit('read_values',{'paths':['/No/such/key']})
+	gateway.stop()
+	worker.join()
+	metrics=gateway.metrics()
+	assert metrics['requests']==4
+	assert metrics['calls']==4
+	assert metrics['errors']==1
+	assert metrics['latency']['read_values']['n']==4
+
+#The whole path: GatewayBackend -> socket -> Handler -> Gateway -> backend
+def test_through_the_socket(tmp_path):
+	path=str(tmp_path/'gateway.sock')
+	sim=pyODBsim.SimBackend(pyODBsim.tower(1))
+	gateway=pyODBgateway.Gateway(sim,rate=0,window=0.01)
+	server=pyODBgateway.Server(path,pyODBgateway.Handler)
+	server.gateway=gateway
+	worker=_worker(gateway)
+	serving=threading.Thread(target=server.serve_forever)
+	serving.daemon=True
+	serving.start()
+	client=pyodbedit.GatewayBackend(path)
+	try:
+		assert client.write_many([(LED,'y')])=={}
+		assert client.read_values([LED])==[True]
+		with pytest.raises(KeyError):
+			client.read_values(['/No/such/key'])
+		assert client.runstart()==''
+		assert client.metrics()['calls']==4
+	finally:
+		client.close()
+		server.shutdown()
+		server.server_close()
+		gateway.stop()
+		worker.join()
+
+def test_no_gateway(tmp_path):
+	with pytest.raises(OSError):
+		pyodbedit.GatewayBackend(str(tmp_path/'none.sock'))
+
+#Only a socket of our own is picked up automatically
+def test_only_our_own_socket_is_used(tmp_path,monkeypatch):
+	path=str(tmp_path/'gateway.sock')
+	assert not pyodbedit._own_socket(path)
+	sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+	try:
+		sock.bind(path)
+		assert pyodbedit._own_socket(path)
+		uid=os.getuid()
+		monkeypatch.setattr(os,'getuid',lambda: uid+1)
+		assert not pyodbedit._own_socket(path)
+	finally:
+		sock.close()
+	monkeypatch.undo()
+	with open(str(tmp_path/'file'),'w'):
+		pass
+	assert not pyodbedit._own_socket(str(tmp_path/'file'))
+
+def test_gateway_socket_is_private(tmp_path):
+	path=str(tmp_path/'run'/'gateway.sock')
+	gateway=subprocess.Popen([sys.executable,'pyODBgateway.py','-backend','memory','-socket',path],
+		cwd=os.path.dirname(os.path.abspath(pyODBgateway.__file__)),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+	try:
+		for i in range(100):
+			if pyodbedit._own_socket(path):
+				break
+			time.sleep(0.05)
+		assert stat.S_IMODE(os.stat(str(tmp_path/'run')).st_mode)==0o700
+		assert stat.S_IMODE(os.stat(path).st_mode)&0o077==0
+		client=pyodbedit.GatewayBackend(path)
+		assert client.write_many([(LED,'y')])=={}
+		assert client.read_values([LED])==[True]
+		client.close()
+	finally:
+		gateway.terminate()
+		gateway.communicate(timeout=10)
+	assert not os.path.exists(path)
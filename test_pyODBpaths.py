@@ -0,0 +1,44 @@
+#Tests for pyODBpaths: board specs and ODB path templates
+
+import pytest
+
+import pyODBpaths
+
+@pytest.mark.parametrize('spec',[3,'3',' 3 ','Tower01:3',('Tower01',3),['Tower01','3'],pyODBpaths.Board('Tower01',3)])
+def test_board_forms(spec):
+	assert pyODBpaths.board(spec)==pyODBpaths.Board('Tower01',3)
+	assert pyODBpaths.name(spec)=='Tower01:3'
+
+def test_board_on_another_tower():
+	assert pyODBpaths.board('Tower02 : 4')==pyODBpaths.Board('Tower02',4)
+
+@pytest.mark.parametrize('spec',['x','Tower02:','Tower02:4:1',('Tower02',)])
+def test_bad_board_specs(spec):
+	with pytest.raises(ValueError):
+		pyODBpaths.board(spec)
+
+def test_paths():
+	assert pyODBpaths.path('Tower02:3','chargeBias',0)=='/Equipment/Tower02/Settings/DCRC3/Charge/Bias (V)[0]'
+	assert pyODBpaths.path(1,'enable15V')=='/Equipment/Tower01/Settings/DCRC1/LED/Enable15VPower'
+	with pytest.raises(KeyError):
+		pyODBpaths.path(1,'noSuchKey')
+
+def test_parse_undoes_path():
+	for key in pyODBpaths.LAYOUTS[pyODBpaths.LAYOUT]:
+		channel=1 if '{channel}' in pyODBpaths.LAYOUTS[pyODBpaths.LAYOUT][key] else None
+		assert pyODBpaths.parse(pyODBpaths.path('Tower02:12',key,channel))==(pyODBpaths.Board('Tower02',12),key,channel)
+	assert pyODBpaths.parse('/Logger/Write data') is None
+
+def test_default_tower():
+	old=pyODBpaths.DEFAULT_TOWER
+	before=pyODBpaths.path(2,'enableLED1')
+	pyODBpaths.setDefaultTower('Tower03')
+	try:
+		assert pyODBpaths.path(2,'enableLED1')=='/Equipment/Tower03/Settings/DCRC2/LED/EnableLED1'
+		assert pyODBpaths.name(2)=='Tower03:2'
+	finally:
+		pyODBpaths.setDefaultTower(old)
+	assert pyODBpaths.path(2,'enableLED1')==before
+
+def test_towers_in_order():
+	assert pyODBpaths.towers([1,'Tower03:1',2,('Tower02',5),'Tower03:2'])==['Tower01','Tower03','Tower02']
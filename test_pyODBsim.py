@@ -0,0 +1,79 @@
+#Tests for the simulated ODB itself
+
+import os
+import time
+import asyncio
+import threading
+import pytest
+
+import pyodbedit
+import pyODBsim
+import pyODBpaths
+
+BIAS=pyODBpaths.path(1,'chargeBias',0)
+READBACK=pyODBpaths.path(1,'chargeBiasReadback',0)
+
+def test_counts_calls():
+	sim=pyODBsim.SimBackend(pyODBsim.tower(1))
+	sim.write_many([(BIAS,'1.5'),(pyODBpaths.WRITE_DATA,'y')])
+	assert sim.read_values([BIAS,pyODBpaths.WRITE_DATA])==[1.5,True]
+	assert sim.counts['calls']==2
+	assert sim.counts['writes']==2
+	assert sim.counts['reads']==2
+
+def test_injected_write_failures():
+	sim=pyODBsim.SimBackend(pyODBsim.tower(1),failPaths='LED')
+	failed=sim.write_many([(pyODBpaths.path(1,'enableLED1'),'y'),(BIAS,'1')])
+	assert list(failed)==[pyODBpaths.path(1,'enableLED1')]
+	assert sim.counts['failures']==1
+	assert sim.read_values([BIAS])==[1]
+
+def test_transitions_take_transition_delay():
+	sim=pyODBsim.SimBackend(pyODBsim.tower(1),transitionDelay=0.2)
+	assert sim.runstart()==''
+	assert sim.read_values([pyODBpaths.RUN_STATE])==[pyodbedit.STATE_STOPPED]
+	time.sleep(0.25)
+	assert sim.read_values([pyODBpaths.RUN_STATE,pyODBpaths.RUN_NUMBER])==[pyodbedit.STATE_RUNNING,1]
+
+def test_injected_transition_failures():
+	sim=pyODBsim.SimBackend(pyODBsim.tower(1),transitionFailRate=1.0)
+	assert sim.runstart()=='simulated transition failure'
+	assert sim.read_values([pyODBpaths.RUN_STATE])==[pyodbedit.STATE_STOPPED]
+
+def test_readback_follows_the_setting():
+	sim=pyODBsim.SimBackend(pyODBsim.tower(1))
+	sim.write_many([(BIAS,'2')])
+	assert sim.read_values([READBACK])==[2.0]
+	sim=pyODBsim.SimBackend(pyODBsim.tower(1),readbackRate=10.0)
+	sim.write_many([(BIAS,'2')])
+	assert sim.read_values([READBACK])[0]<2.0
+	time.sleep(0.25)
+	assert sim.read_values([READBACK])==[2.0]
+
+def test_compressed_time():
+	t0=time.monotonic()
+	with pyODBsim.compressedTime(100):
+		s0=time.monotonic()
+		time.sleep(5)
+		asyncio.run(asyncio.sleep(5))
+		simulated=time.monotonic()-s0
+	assert simulated>=10
+	assert time.monotonic()-t0<1.0
+
+#Sessions in the pool run odbedit stand-ins side by side on one state file,
+#so no write may be lost between them
+def test_odbedit_sessions_on_the_stand_in(tmp_path,monkeypatch):
+	monkeypatch.setenv('PYODBSIM_STATE',str(tmp_path/'odb.json'))
+	odbedit=pyodbedit.OdbeditBackend(odbedit=os.path.abspath(pyODBsim.__file__),size=4)
+	try:
+		paths=[pyODBpaths.path(board,'enableLED1') for board in range(1,5)]
+		threads=[threading.Thread(target=odbedit.write_many,args=([(path,'y')],)) for path in paths]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		assert odbedit.read_values(paths)==[True]*4
+		with pytest.raises(KeyError):
+			odbedit.read_values(['/No/such/key'])
+	finally:
+		odbedit.close()
@@ -0,0 +1,310 @@
+#Tests for the pyScan engine against the simulated ODB
+
+import os
+import re
+import sys
+import time
+import asyncio
+import subprocess
+import pytest
+
+import pyodbedit
+import pyODBpaths
+import pyScan
+import pyRunLog
+
+BIAS=pyODBpaths.path(1,'chargeBias',0)
+
+#A small HV scan: ramp to 20 V, one run, ramp down, flash, cool
+def _steps(calFile,dataTime=5.0,flashTime=0.05):
+	return [pyScan.Settings({pyODBpaths.WRITE_DATA:'y'},'logger on'),
+		pyScan.Ramp(1,0.0,20.0,400.0,0.01,calFile,'set 1/1'),
+		pyScan.StartRun('set 1/1',0,0),
+		pyScan.TakeData(dataTime,'set 1/1'),
+		pyScan.StopRun('set 1/1'),
+		pyScan.Ramp(1,20.0,0.0,400.0,0.01,calFile,'set 1/1'),
+		pyScan.Flash([1,2],flashTime,'set 1/1'),
+		pyScan.Cool(0.01,'set 1/1')]
+
+#Background task aborting the scan once it gets to step index
+def _abortAt(index):
+	async def task(scan):
+		while scan.index!=index:
+			await asyncio.sleep(0.005)
+		await asyncio.sleep(0.02)
+		scan.abort('test')
+	return task
+
+def test_scan_runs_its_steps(sim,calFile):
+	scan=pyScan.Scan(_steps(calFile,0.1))
+	scan.run()
+	assert scan.liveTime==pytest.approx(0.1,abs=0.05)
+	assert scan.elapsed>=scan.liveTime
+	assert pyodbedit.read_values([pyODBpaths.WRITE_DATA,pyODBpaths.RUN_STATE,pyODBpaths.RUN_NUMBER])==[True,pyodbedit.STATE_STOPPED,1]
+	assert pyodbedit.read_value(BIAS)==pytest.approx(0.0)
+
+def test_estimate(calFile):
+	steps=[pyScan.Settings({pyODBpaths.WRITE_DATA:'y'}),pyScan.StartRun(),pyScan.TakeData(60),pyScan.StopRun(),pyScan.Cool(40)]
+	est=pyScan.Scan(steps).estimate()
+	assert est['duration']==100
+	assert est['live']==60
+	assert est['liveFraction']==0.6
+	assert est['runs']==1
+	assert (est['reads'],est['writes'])==(4,3)
+
+def test_background_tasks_are_stopped_at_the_end(sim):
+	ticks=[]
+	async def ticker(scan):
+		while True:
+			ticks.append(scan.index)
+			await asyncio.sleep(0.01)
+	pyScan.Scan([pyScan.Wait(0.1)],tasks=[ticker]).run()
+	count=len(ticks)
+	time.sleep(0.05)
+	assert len(ticks)==count>=5
+
+def test_poll_reads_past_the_cache(sim):
+	pyodbedit.enable_cache()
+	pyodbedit.read_value('/Playground/time')
+	sim.values['/Playground/time']=42
+	seen=[]
+	task=pyScan.poll(['/Playground/time'],0.01,lambda scan,values: seen.append(values['/Playground/time']))
+	pyScan.Scan([pyScan.Wait(0.1)],tasks=[task]).run()
+	assert seen and set(seen)=={42}
+
+@pytest.mark.parametrize('name',['runs.db','runs.csv'])
+def test_run_log_records_the_biases(sim,calFile,tmp_path,name):
+	runLog=str(tmp_path/name)
+	scan=pyScan.Scan(_steps(calFile,0.05),runLog=runLog,name='test')
+	scan.run()
+	records=pyRunLog.RunLog(runLog).find(board=1,name='HV',value=20.0)
+	assert len(records)==1
+	assert records[0]['run']==1
+	assert records[0]['label']=='set 1/1'
+	assert records[0]['live']==pytest.approx(0.05,abs=0.05)
+
+#A ramp whose writes don't take ends the scan, and isn't logged as done
+def test_failed_HV_write_stops_the_scan(sim,calFile,tmp_path):
+	sim.failPaths=re.compile('DCRC1/Charge')
+	journal=str(tmp_path/'scan.journal')
+	scan=pyScan.Scan(_steps(calFile,0.05),journal=journal)
+	with pytest.raises(pyodbedit.OdbeditError):
+		scan.run()
+	assert 'HV' not in scan.bias.get(pyODBpaths.name(1),{})
+	assert pyScan.resumeIndex(scan.steps,pyScan.Journal(journal).read())==1
+	assert pyodbedit.read_value('/Runinfo/Run number')==0
+
+def test_overlap_folds_allowed_steps_into_the_host(calFile):
+	steps=[pyScan.Cool(100),pyScan.HVPower(1,'ON'),pyScan.Ramp(1,0.0,10.0,1.0,1.0,calFile),pyScan.Wait(30),
+		pyScan.StartRun(),pyScan.TakeData(60),pyScan.StopRun()]
+	out=pyScan.overlapSteps(steps,[['cool','hvpower'],['cool','ramp'],['cool','wait']])
+	assert len(out)==4
+	assert isinstance(out[0],pyScan.Overlap)
+	assert out[0].chain==steps[1:4]
+	#5 s power + 10 s ramp + 30 s wait finish with the 100 s cooldown
+	assert out[0].duration==100
+	assert out[0].offset==55
+	assert pyScan.Scan(out).estimate()['duration']==pyScan.Scan(steps).estimate()['duration']-45
+	assert pyScan.substeps(out[0])==steps[:4]
+
+def test_overlap_longer_than_the_host(calFile):
+	out=pyScan.overlapSteps([pyScan.Cool(5),pyScan.Wait(30)],[['cool','wait']])
+	assert out[0].offset==0
+	assert out[0].duration==30
+
+def test_runs_never_overlap():
+	steps=[pyScan.Cool(100),pyScan.StartRun(),pyScan.TakeData(10),pyScan.StopRun(),pyScan.Wait(5)]
+	policy=[['cool','runstart'],['cool','data'],['runstart','data'],['data','runstop'],['runstop','wait']]
+	assert pyScan.overlapSteps(steps,policy)==steps
+
+def test_steps_on_the_same_HV_never_overlap(calFile):
+	steps=[pyScan.Ramp(1,0.0,10.0,1.0,1.0,calFile),pyScan.Ramp(1,10.0,0.0,1.0,1.0,calFile),
+		pyScan.Ramp(2,0.0,10.0,1.0,1.0,calFile)]
+	out=pyScan.overlapSteps(steps,[['ramp','ramp']])
+	assert out[0] is steps[0]
+	assert isinstance(out[1],pyScan.Overlap) and out[1].chain==[steps[2]]
+
+def test_overlap_chain_ends_with_the_host(sim):
+	ends={}
+	class Mark(pyScan.Wait):
+		kind='mark'
+		async def run(self,scan):
+			await pyScan.Wait.run(self,scan)
+			ends[self.label]=time.monotonic()
+	steps=pyScan.overlapSteps([Mark(0.3,'host'),Mark(0.1,'a'),Mark(0.1,'b')],[['mark','mark']])
+	assert len(steps)==1
+	scan=pyScan.Scan(steps)
+	scan.run()
+	assert scan.elapsed==pytest.approx(0.3,abs=0.05)
+	assert ends['b']-ends['a']==pytest.approx(0.1,abs=0.03)
+	assert ends['b']==pytest.approx(ends['host'],abs=0.03)
+
+def test_scan_runs_and_journals(sim,calFile,tmp_path):
+	journal=str(tmp_path/'scan.journal')
+	scan=pyScan.Scan(_steps(calFile,0.1),journal=journal)
+	scan.run()
+	records=scan.journal.read()
+	assert records[0]['event']=='scan'
+	done=[record['step'] for record in records if record.get('event')=='done']
+	assert done==list(range(len(scan.steps)))
+	assert [record['event'] for record in records].count('flash')==1
+	assert scan.liveTime==pytest.approx(0.1,abs=0.05)
+	assert pyodbedit.read_value(pyODBpaths.RUN_STATE)==pyodbedit.STATE_STOPPED
+	assert pyodbedit.read_value('/Runinfo/Run number')==1
+
+def test_journal_skips_a_torn_line_and_starts_again_on_a_new_scan(tmp_path):
+	journal=pyScan.Journal(str(tmp_path/'scan.journal'))
+	journal.write({'event':'scan','resume':False})
+	journal.write({'event':'done','step':0})
+	journal.write({'event':'scan','resume':False})
+	journal.write({'event':'done','step':0})
+	journal.write({'event':'scan','resume':True})
+	with open(journal.path,'a') as f:
+		f.write('{"event": "do')
+	assert [record['event'] for record in journal.read()]==['scan','done','scan']
+
+def test_resume_redoes_the_whole_run(calFile):
+	steps=_steps(calFile)
+	done=lambda n: [{'event':'done','step':i} for i in range(n)]
+	assert pyScan.resumeIndex(steps,done(0))==0
+	assert pyScan.resumeIndex(steps,done(2))==2
+	#Died taking data, or stopping the run: back to its StartRun
+	assert pyScan.resumeIndex(steps,done(3))==2
+	assert pyScan.resumeIndex(steps,done(4))==2
+	#The run is finished, carry on after it
+	assert pyScan.resumeIndex(steps,done(5))==5
+	assert pyScan.resumeIndex(steps,done(len(steps)))==len(steps)
+
+def test_recover_from_an_abort_during_a_run(sim,calFile,tmp_path):
+	journal=str(tmp_path/'scan.journal')
+	scan=pyScan.Scan(_steps(calFile),tasks=[_abortAt(3)],journal=journal)
+	with pytest.raises(pyScan.ScanAborted):
+		scan.run()
+	assert pyodbedit.read_value(pyODBpaths.RUN_STATE)==pyodbedit.STATE_RUNNING
+	#Someone has since moved the HV
+	pyodbedit.write(BIAS,0.5)
+
+	scan=pyScan.Scan(_steps(calFile,0.05),journal=journal)
+	k=scan.recover()
+	assert k==2
+	assert pyodbedit.read_value(pyODBpaths.RUN_STATE)==pyodbedit.STATE_STOPPED
+	assert pyodbedit.read_value(BIAS)==pytest.approx(1.0)
+	assert scan.bias=={'Tower01:1':{'HV':20.0}}
+	scan.run(k)
+	assert pyodbedit.read_value('/Runinfo/Run number')==2
+	assert pyodbedit.read_value(BIAS)==pytest.approx(0.0)
+
+def test_recover_finishes_an_interrupted_flash(sim,calFile,tmp_path):
+	journal=str(tmp_path/'scan.journal')
+	scan=pyScan.Scan(_steps(calFile,0.05,5.0),tasks=[_abortAt(6)],journal=journal)
+	with pytest.raises(pyScan.ScanAborted):
+		scan.run()
+	led=pyODBpaths.path(2,'enableLED1')
+	power=pyODBpaths.path(2,'enable15V')
+	assert pyodbedit.read_value(led) is True
+	assert pyodbedit.read_value(power) is True
+
+	scan=pyScan.Scan(_steps(calFile,0.05),journal=journal)
+	assert scan.recover()==6
+	assert pyodbedit.read_value(led) is False
+	assert pyodbedit.read_value(power) is False
+
+def test_recover_checks_the_journal_is_for_this_scan(sim,calFile,tmp_path):
+	journal=str(tmp_path/'scan.journal')
+	pyScan.Scan(_steps(calFile,0.05),journal=journal).run()
+	scan=pyScan.Scan(_steps(calFile,0.05)[:-1],journal=journal)
+	with pytest.raises(ValueError):
+		scan.recover()
+
+def test_resume_needs_a_journal():
+	result=subprocess.run([sys.executable,os.path.join(os.path.dirname(os.path.abspath(__file__)),'pyHVscan.py'),
+		'-iDCRC','4','-HVs','0,10','-HVcalFile','cal.txt','-tSeries','1','-DCRCs2Flash','1','-resume'],
+		stdout=subprocess.PIPE,stderr=subprocess.PIPE,universal_newlines=True)
+	assert result.returncode==2
+	assert '-resume needs the -journal' in result.stderr
+
+def test_pause_stops_the_data_clock(sim):
+	async def pauseFor(scan):
+		while not isinstance(scan.current,pyScan.TakeData):
+			await asyncio.sleep(0.005)
+		await asyncio.sleep(0.1)
+		scan.pause('test')
+		await asyncio.sleep(0.3)
+		scan.resume()
+	scan=pyScan.Scan([pyScan.StartRun(),pyScan.TakeData(0.3),pyScan.StopRun()],tasks=[pauseFor])
+	scan.run()
+	assert scan.elapsed>=0.6
+	assert scan.liveTime==pytest.approx(0.3,abs=0.05)
+
+def test_pause_holds_the_next_step(sim):
+	started={}
+	async def pauseFor(scan):
+		scan.pause('test')
+		await asyncio.sleep(0.2)
+		scan.resume()
+	class Mark(pyScan.Step):
+		async def run(self,scan):
+			started['time']=time.monotonic()-scan.started
+	pyScan.Scan([pyScan.Wait(0.05),Mark()],tasks=[pauseFor]).run()
+	assert started['time']>=0.2
+
+def test_watch_sees_changes(sim):
+	seen=[]
+	async def change(scan):
+		await asyncio.sleep(0.05)
+		await scan.odb(pyodbedit.write,'/Playground/time',7)
+	watch=pyScan.watch(['/Playground/time','/Equipment/Tower01/Variables/'],lambda scan,changes: seen.append(changes),0.01)
+	pyScan.Scan([pyScan.Wait(0.2)],tasks=[watch,change]).run()
+	assert seen[0]['/Playground/time']==(None,0)
+	assert seen[0]['/Equipment/Tower01/Variables/DCRC1/Charge/Bias (V)']==(None,[0.0,0.0])
+	assert {'/Playground/time':(0,7)} in seen
+
+def test_limit_aborts_the_scan(sim):
+	async def trip(scan):
+		await asyncio.sleep(0.05)
+		await scan.odb(pyodbedit.write,'/Playground/time',100)
+	limits=pyScan.limits([('/Playground/time',None,10,'abort')],0.01)
+	scan=pyScan.Scan([pyScan.Wait(5)],tasks=[limits,trip])
+	with pytest.raises(pyScan.ScanAborted) as e:
+		scan.run()
+	assert '/Playground/time = 100' in str(e.value)
+	assert scan.elapsed<1.0
+
+def test_limit_pauses_until_back_in_range(sim):
+	async def trip(scan):
+		await asyncio.sleep(0.05)
+		await scan.odb(pyodbedit.write,'/Playground/time',100)
+		await asyncio.sleep(0.3)
+		await scan.odb(pyodbedit.write,'/Playground/time',5)
+	limits=pyScan.limits([('/Playground/time',None,10,'pause')],0.01)
+	scan=pyScan.Scan([pyScan.Wait(0.1),pyScan.Wait(0.01)],tasks=[limits,trip])
+	scan.run()
+	assert scan.paused is None
+	assert len(scan.pauses)==1
+	assert scan.elapsed>=0.3
+
+def test_limit_actions_are_checked():
+	with pytest.raises(ValueError):
+		pyScan.limits([('/Playground/time',None,10,'ignore')])
+
+#A subtree that isn't there yet reads as None, like a missing key
+def test_watch_missing_subtree(sim):
+	seen=[]
+	async def create(scan):
+		await asyncio.sleep(0.05)
+		await scan.odb(pyodbedit.write,'/Equipment/HV/Variables/Current',1e-7)
+	watch=pyScan.watch(['/Equipment/HV/Variables/'],lambda scan,changes: seen.append(changes),0.01)
+	pyScan.Scan([pyScan.Wait(0.2)],tasks=[watch,create]).run()
+	assert seen[0]=={'/Equipment/HV/Variables':(None,None)}
+	assert {'/Equipment/HV/Variables/Current':(None,1e-7)} in seen
+
+def test_watch_that_cant_start_aborts_the_scan(sim,monkeypatch):
+	def broken(path):
+		raise pyodbedit.OdbeditError('reading '+path+': not connected')
+	monkeypatch.setattr(sim,'read_tree',broken)
+	watch=pyScan.watch(['/Equipment/HV/Variables/'],lambda scan,changes: None,0.01)
+	scan=pyScan.Scan([pyScan.Wait(5)],tasks=[watch])
+	with pytest.raises(pyScan.ScanAborted) as e:
+		scan.run()
+	assert 'can\'t watch /Equipment/HV/Variables/' in str(e.value)
+	assert scan.elapsed<1.0
@@ -0,0 +1,80 @@
+#Tests for pyScanPlan: compiling plan files into scans, and dry runs
+
+import os
+import json
+import pytest
+
+import pyScan
+import pyHVscan
+import pyQscan
+import pyScanPlan
+
+def _plan(tmp_path,plan,name='plan.json'):
+	path=str(tmp_path/name)
+	with open(path,'w') as f:
+		json.dump(plan,f)
+	return path
+
+def _hvPlan(calFile,**extra):
+	plan={'type':'HV','iDCRC':4,'HVs':[0,10,20],'HVcalFile':calFile,'tSeries':2,'NsubSeries':2,
+		'DCRCs2Flash':[1,2,3],'HVpreBias':'15/5','CoolDuration':10}
+	plan.update(extra)
+	return plan
+
+def _describe(steps):
+	return [step.describe() for step in steps]
+
+def test_HV_plan_is_the_command_line_scan(calFile):
+	steps=pyScanPlan.compilePlan(_hvPlan(calFile))
+	expected=pyHVscan.hvScanSteps(4,[0.0,10.0,20.0],calFile,60,['1','2','3'],2,HVpreBiasPercent=15.0,
+		HVpreBiasWait_sec=300,CoolDuration_sec=600)
+	assert _describe(steps)==_describe(expected)
+	assert [step.duration for step in steps]==[step.duration for step in expected]
+
+def test_Q_plan(calFile):
+	plan={'type':'Q','DCRC_S1S2':'3/1','Vs':[[0,0],[5,-5]],'tSeries':1,'DCRCs2Flash':'1,3'}
+	steps=pyScanPlan.compilePlan(plan)
+	expected=pyQscan.qScanSteps('3','1',[[0.0,0.0],[5.0,-5.0]],60,['1','3'])
+	assert _describe(steps)==_describe(expected)
+
+def test_plan_formats(tmp_path,calFile):
+	plan=_hvPlan(calFile)
+	assert pyScanPlan.loadPlan(_plan(tmp_path,plan))==plan
+	toml=str(tmp_path/'plan.toml')
+	with open(toml,'w') as f:
+		f.write('type = "HV"\niDCRC = 4\nHVs = [0, 10]\n')
+	assert pyScanPlan.loadPlan(toml)=={'type':'HV','iDCRC':4,'HVs':[0,10]}
+	with pytest.raises(pyScanPlan.PlanError):
+		pyScanPlan.loadPlan(str(tmp_path/'plan.txt'))
+
+def test_prebias_forms():
+	assert pyScanPlan._preBias('15/5')==(15.0,300)
+	assert pyScanPlan._preBias({'percent':10,'minutes':0.5})==(10.0,30)
+	assert pyScanPlan._preBias(None)==(None,0)
+
+def test_bad_plans(calFile):
+	with pytest.raises(pyScanPlan.PlanError):
+		pyScanPlan.compilePlan({'type':'HV','iDCRC':4})
+	with pytest.raises(pyScanPlan.PlanError):
+		pyScanPlan.compilePlan({'type':'LED'})
+	with pytest.raises(pyScanPlan.PlanError):
+		pyScanPlan.compilePlan(_hvPlan(calFile,HVrampUpdatePeriod=0.001))
+	with pytest.raises(pyScanPlan.PlanError):
+		pyScanPlan.compilePlan(_hvPlan(calFile,HVrampRate=2.0,HVmaxRate=1.0))
+
+def test_ramps_outside_the_calibration_are_found(calFile):
+	assert pyScanPlan.checkRamps(pyScanPlan.compilePlan(_hvPlan(calFile)))==[]
+	problems=pyScanPlan.checkRamps(pyScanPlan.compilePlan(_hvPlan(calFile,HVs=[0,90])))
+	#The 15% prebias goes past the 100 V end of the calibration
+	assert problems and all('outside' in problem for problem in problems)
+
+def test_dry_run_touches_nothing(sim,tmp_path,calFile,capsys):
+	path=_plan(tmp_path,_hvPlan(calFile))
+	scan=pyScanPlan.main([path,'--dry-run'])
+	out=capsys.readouterr().out
+	assert sim.counts['calls']==0
+	assert not os.path.exists(path+'.runs.db')
+	assert not os.path.exists(path+'.journal')
+	assert 'Runs:          6' in out
+	assert len(scan.steps)==len(pyScanPlan.compilePlan(_hvPlan(calFile)))
+	assert scan.estimate()['runs']==6
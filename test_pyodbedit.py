@@ -0,0 +1,211 @@
+#Tests for pyodbedit against the simulated ODB
+
+import re
+import sys
+import time
+import types
+import threading
+import pytest
+
+import pyodbedit
+
+LED='/Equipment/Tower01/Settings/DCRC1/LED/EnableLED1'
+BIAS='/Equipment/Tower01/Settings/DCRC1/Charge/Bias (V)'
+
+def test_write_many_is_one_round_trip(sim):
+	failed=pyodbedit.write_many({LED:True,'/Playground/time':5})
+	assert failed=={}
+	assert sim.counts['calls']==1
+	assert pyodbedit.read_values([LED,'/Playground/time'])==[True,5]
+
+def test_failed_writes_are_reported(sim):
+	sim.failPaths=re.compile('LED1')
+	failed=pyodbedit.write_many({LED:True,'/Playground/time':5})
+	assert list(failed)==[LED]
+	assert pyodbedit.read_value('/Playground/time')==5
+
+def test_transaction_sends_its_writes_together(sim):
+	with pyodbedit.Transaction() as t:
+		t.write(LED,'y')
+		t.write(BIAS+'[1]',2.5)
+		assert sim.counts['calls']==0
+	assert t.failures=={}
+	assert sim.counts['calls']==1
+	assert pyodbedit.read_values([LED,BIAS])==[True,[0.0,2.5]]
+
+def test_transaction_sends_nothing_on_an_exception(sim):
+	with pytest.raises(RuntimeError):
+		with pyodbedit.Transaction() as t:
+			t.write(LED,'y')
+			raise RuntimeError('test')
+	assert sim.counts['writes']==0
+
+def test_cache_answers_repeat_reads(sim):
+	pyodbedit.enable_cache()
+	pyodbedit.read_value(LED)
+	before=sim.counts['reads']
+	assert pyodbedit.read_value(LED) is False
+	assert sim.counts['reads']==before
+	assert pyodbedit.cache_stats()['hits']==1
+
+def test_cache_skips_unchanged_writes(sim):
+	pyodbedit.enable_cache()
+	pyodbedit.write(LED,True)
+	pyodbedit.write(LED,True)
+	assert sim.counts['writes']==1
+	assert pyodbedit.cache_stats()['skipped']==1
+
+def test_invalidate_forgets_array_elements(sim):
+	cache=pyodbedit.enable_cache()
+	pyodbedit.read_values([BIAS+'[0]',BIAS+'[1]',LED])
+	pyodbedit.invalidate(BIAS)
+	assert sorted(cache.entries)==[LED]
+	pyodbedit.invalidate()
+	assert cache.entries=={}
+
+def test_cache_expires(sim):
+	pyodbedit.enable_cache(ttl=0.05)
+	pyodbedit.read_value(LED)
+	sim.values[LED]=True
+	time.sleep(0.1)
+	assert pyodbedit.read_value(LED) is True
+
+def test_transitions_clear_the_cache(sim):
+	pyodbedit.enable_cache()
+	assert pyodbedit.read_value('/Runinfo/State')==pyodbedit.STATE_STOPPED
+	pyodbedit.runstart()
+	assert pyodbedit.read_value('/Runinfo/State')==pyodbedit.STATE_RUNNING
+
+def test_fresh_reads_skip_the_cache(sim):
+	pyodbedit.enable_cache()
+	pyodbedit.read_value(LED)
+	sim.values[LED]=True
+	assert pyodbedit.read_value(LED) is False
+	assert pyodbedit.read_value(LED,fresh=True) is True
+	assert pyodbedit.read_values([LED],fresh=True)==[True]
+
+def test_runstart_waits_for_the_new_run(sim):
+	sim.transitionDelay=0.3
+	transition=pyodbedit.runstart()
+	assert transition.run==1
+	assert transition.latency>=0.3
+	assert pyodbedit.read_value('/Runinfo/State')==pyodbedit.STATE_RUNNING
+	with pytest.raises(pyodbedit.TransitionError):
+		pyodbedit.runstart()
+	transition=pyodbedit.runstop()
+	assert transition.run==1
+	assert pyodbedit.read_value('/Runinfo/State')==pyodbedit.STATE_STOPPED
+
+def test_runstop_when_stopped_does_nothing(sim):
+	transition=pyodbedit.runstop()
+	assert transition.latency==0.0
+	assert sim.counts['transitions']==0
+
+def test_transition_that_never_happens(sim):
+	sim.transitionFailRate=1.0
+	with pytest.raises(pyodbedit.TransitionError):
+		pyodbedit.runstart(timeout=0.3)
+
+def test_percentile_is_nearest_rank():
+	assert pyodbedit.percentile([],50)==0.0
+	assert pyodbedit.percentile([1,2],50)==1
+	assert pyodbedit.percentile([1,2,3,4,5,6],50)==3
+	assert pyodbedit.percentile(list(range(1,101)),99)==99
+	assert pyodbedit.percentile(list(range(1,101)),100)==100
+	assert pyodbedit.percentile([7],0)==7
+
+def test_only_single_line_complaints_are_errors():
+	assert pyodbedit._complaint('Error: database is not open')
+	assert pyodbedit._complaint('Cannot connect to experiment')
+	assert not pyodbedit._complaint('Invalid\nError')
+	assert not pyodbedit._complaint('invalidated')
+	assert not pyodbedit._complaint('1.5')
+
+def test_trace_sees_calls_under_the_cache(sim):
+	pyodbedit.enable_cache()
+	pyodbedit.enable_trace()
+	try:
+		with pyodbedit.phase('ramp'):
+			pyodbedit.write(LED,True)
+			pyodbedit.write(LED,True)
+		calls=pyodbedit.trace_calls()
+		assert [(call.op,call.phase) for call in calls]==[('write','ramp')]
+		assert pyodbedit.trace_summary()['phases']['ramp']['calls']==1
+	finally:
+		pyodbedit.disable_trace()
+
+def test_empty_reads_while_tracing(sim):
+	pyodbedit.enable_trace()
+	try:
+		assert pyodbedit.read_values([])==[]
+		assert pyodbedit.trace_calls()==[]
+	finally:
+		pyodbedit.disable_trace()
+
+@pytest.mark.parametrize('name',['trace.jsonl','trace.json'])
+def test_trace_files_read_back(sim,tmp_path,name):
+	filename=str(tmp_path/name)
+	pyodbedit.enable_trace(filename)
+	try:
+		with pyodbedit.phase('flash'):
+			pyodbedit.write(LED,True)
+		pyodbedit.read_values([LED,'/Playground/time'])
+	finally:
+		pyodbedit.disable_trace()
+	calls=pyodbedit.load_trace(filename)
+	assert [(call.op,call.phase) for call in calls]==[('write','flash'),('read_values','')]
+	assert calls[1].path==[LED,'/Playground/time']
+	assert calls[1].value==[True,0]
+
+#Enough of midas.client for MidasBackend: hotlinks fire from communicate()
+class _MidasClient(object):
+	def __init__(self,name):
+		self.values={LED:False}
+		self.watches={}
+		self.changed=[]
+
+	def odb_get(self,path):
+		return self.values[path]
+
+	def odb_set(self,path,value):
+		self.values[path]=value
+		if path in self.watches:
+			self.changed.append(path)
+
+	def odb_watch(self,path,callback):
+		self.watches[path]=callback
+
+	def odb_stop_watching(self,path):
+		self.watches.pop(path,None)
+
+	def communicate(self,ms):
+		changed,self.changed=self.changed,[]
+		for path in changed:
+			self.watches[path](self,path,self.values[path])
+
+	def disconnect(self):
+		pass
+
+#A hotlink callback can use the ODB without deadlocking the listener
+def test_midas_hotlinks_can_use_the_odb(monkeypatch):
+	midas=types.ModuleType('midas')
+	midas.client=types.ModuleType('midas.client')
+	midas.client.MidasClient=_MidasClient
+	monkeypatch.setitem(sys.modules,'midas',midas)
+	monkeypatch.setitem(sys.modules,'midas.client',midas.client)
+	backend=pyodbedit.MidasBackend()
+	seen=[]
+	done=threading.Event()
+	def callback(path,value):
+		seen.append((value,backend.read_values([path])[0]))
+		backend.write_many([('/Playground/time','1')])
+		done.set()
+	backend.watch(LED,callback)
+	backend.write_many([(LED,'y')])
+	assert done.wait(2.0)
+	closing=threading.Thread(target=backend.close)
+	closing.start()
+	closing.join(2.0)
+	assert not closing.is_alive()
+	assert seen==[(True,True)]
+	assert backend.client.values['/Playground/time']==1
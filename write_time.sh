@@ -1,8 +1,5 @@
 ## A script to write the current time to the MIDAS ODB
 #N. Mast 2019
-while true;
-do
-#echo "$(echo "odbedit -c 'set \"/Playground/time\"") "$(date +%s)""$(echo "'")"";
-eval "$(echo "odbedit -c 'set \"/Playground/time\"") "$(date +%s)""$(echo "'")"";
-sleep 1;
-done
+#The loop that ran odbedit every second is now pyHeartbeat.py, which keeps one
+#ODB connection open and ticks on time. Options are passed on, e.g. -period 1
+exec python "$(dirname "$0")/pyHeartbeat.py" "$@"